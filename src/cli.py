@@ -0,0 +1,487 @@
+""" Headless certificate creation.
+
+Runs the `CertificateCreator` without tkinter, so batches can be created
+on servers or from cron. Every setting that isn't given on the command line
+is read from `config.ini`. Progress is printed to stdout as json lines, one
+event per line, ex.
+
+    {"event": "progress", "done": 10, "total": 250}
+
+Batches can also be spread over several machines. Start a coordinator with
+`--serve HOST:PORT` and a worker on each machine with `--worker HOST:PORT`.
+`--local-workers N` starts N workers next to the coordinator, or on their
+own, with a coordinator on a local port. The coordinator and the workers
+share the key of `--authkey` or the VICER_AUTHKEY environment variable;
+local workers on their own get a random one.
+
+`--send-schedule` sends the email campaign that was scheduled over the
+daily sending limit in the app, waiting for each sending window to open.
+Emails whose send was interrupted, ex. by a crash, may have been delivered,
+so they're reported as failed unless `--resend-interrupted` is given.
+
+Exit codes:
+    0: All the certificates were created.
+    1: Certificate creation failed.
+    2: Invalid arguments or input files.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sys
+import threading
+import time
+from configparser import ConfigParser
+from pathlib import Path
+from typing import Any
+
+from PIL import ImageFont
+
+from paths import *
+from services.campaign_scheduler import CampaignSchedule
+from services.campaign_setup import create_campaign
+from services.catalogue import CertificateCatalogue
+from services.certificate_creation import CertificateCreator
+from services.email_transport import EmailTransport
+from services.font_fallback import FontFallback
+from services.constants import *
+from services.data_filtering import file_to_ulist
+from services.outbox import EmailOutbox
+from services.progress import SilentProgress
+from services.imposition import SHEET_SIZES, ImpositionSink
+from services.distributed_rendering import (
+    RenderCoordinator,
+    make_render_settings,
+    needed_fallback_fonts,
+    parse_address,
+    run_worker,
+    start_local_workers
+)
+
+
+
+EXIT_OK = 0
+EXIT_FAILURE = 1
+EXIT_USAGE = 2
+
+
+def emit(event: str, **fields: Any) -> None:
+    """ Print a machine-readable event as a single json line. """
+    print(json.dumps({'event': event, **fields}), flush=True)
+
+
+class ProgressCounter(SilentProgress):
+    """ Stand-in for the progressbar IntVar, that reports progress
+    on stdout instead. """
+    def __init__(self, total: int) -> None:
+        super().__init__()
+        self.total = total
+
+    def set(self, value: int) -> None:
+        super().set(value)
+        emit('progress', done=value, total=self.total)
+
+
+def log(title: str, message: str, level: LogLevel) -> None:
+    """ Log function with the same signature as `Logger.log`. """
+    emit('log', level=level.name, title=title, message=message)
+
+
+def resolve_file(value: str, folder: Path) -> Path:
+    """ Return `value` as a path. Paths that don't exist are looked
+    up in `folder`, like the app does with the config file entries. """
+    path = Path(value)
+    if not path.exists():
+        path = folder / value
+    return path
+
+
+def resolve_font(value: str) -> Path:
+    """ Return the path of the font file. `value` is either a path to
+    a ttf file, or a font family from the fonts folder. """
+    path = Path(value)
+    if path.suffix == '.ttf' and path.exists():
+        return path
+    return FONTS / f'{value.replace(" ", "-")}.ttf'
+
+
+def parse_color(value: str) -> Hex:
+    """ Convert a hex color, with or without a leading `#`, to `#rrggbb`. """
+    value = value.lstrip('#')
+    if len(value) != 6:
+        raise ValueError(f'invalid hex color: {value}')
+    int(value, 16)
+    return f'#{value}'
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='vicer',
+        description='Create certificates without the gui. Options that '
+                    'are not given are read from the config file.'
+    )
+    parser.add_argument('--config', type=Path, default=CONFIG,
+        help='config file to read the defaults from')
+    parser.add_argument('--template',
+        help='template image, or its name in the templates folder')
+    parser.add_argument('--userlist',
+        help='userlist file, or its name in the userlists folder')
+    parser.add_argument('--font',
+        help='ttf font file, or a font family in the fonts folder')
+    parser.add_argument('--size', type=int, help='font size')
+    parser.add_argument('--color', help='font color in hex, ex. 000000')
+    parser.add_argument('--x', type=int, dest='xcoord', help='text x coord')
+    parser.add_argument('--y', type=int, dest='ycoord', help='text y coord')
+    parser.add_argument('--alignment', choices=[LEFT, MIDDLE, RIGHT],
+        help='text alignment')
+    parser.add_argument('--output', type=Path, default=CERTIFICATES,
+        help='folder to save the certificates in')
+    parser.add_argument('--processes', type=int,
+        help='number of processes to create certificates with, '
+             'sized by the available cpus and memory by default')
+    parser.add_argument('--threads', action='store_true', default=None,
+        help='create certificates with a thread pool, the default on '
+             'free-threaded python builds')
+    parser.add_argument('--no-fallback', action='store_true',
+        help='don\'t fall back to the other fonts of the fonts folder '
+             'for characters the font lacks')
+    parser.add_argument('--catalogue', type=Path,
+        help='sqlite catalogue to record the certificates in, '
+             'defaults to catalogue.sqlite in the output folder')
+    parser.add_argument('--compress-level', type=int, default=3,
+        choices=range(10), metavar='{0-9}', help='png compression level')
+
+    imposition = parser.add_argument_group('imposition')
+    imposition.add_argument('--impose', type=int, metavar='N',
+        help='place N certificates on each print sheet instead of '
+             'saving them as separate files')
+    imposition.add_argument('--sheets', type=Path,
+        help='pdf or tiff file to write the sheets to, '
+             'defaults to sheets.pdf in the output folder')
+    imposition.add_argument('--sheet-size', default='SRA3',
+        choices=SHEET_SIZES, help='size of the print sheets')
+    imposition.add_argument('--dpi', type=int, default=300,
+        help='resolution of the print sheets')
+
+    distributed = parser.add_argument_group('distributed rendering')
+    distributed.add_argument('--serve', type=parse_address, metavar='ADDRESS',
+        help='hand out the userlist to workers, listening on host:port '
+             'or a unix socket path')
+    distributed.add_argument('--worker', type=parse_address, metavar='ADDRESS',
+        help='create certificates for the coordinator at host:port '
+             'or a unix socket path')
+    distributed.add_argument('--local-workers', type=int, default=0,
+        help='number of workers to start next to the coordinator, '
+             'or on this machine only if --serve isn\'t given')
+    distributed.add_argument('--chunk-size', type=int, default=50,
+        help='number of users handed to a worker at a time')
+    distributed.add_argument('--worker-timeout', type=float, default=600,
+        help='seconds to wait without any connected worker before the '
+             'certificates left are reported as failed')
+    distributed.add_argument('--collect', action='store_true',
+        help='send certificates back to the coordinator\'s output folder')
+    distributed.add_argument('--authkey',
+        default=os.environ.get('VICER_AUTHKEY') or None,
+        help='key shared by the coordinator and the workers, required '
+             'by --serve and --worker, defaults to the VICER_AUTHKEY '
+             'environment variable')
+
+    emailing = parser.add_argument_group('emailing')
+    emailing.add_argument('--send-schedule', action='store_true',
+        help='send the email campaign scheduled in the app, waiting for '
+             'each sending window, instead of creating certificates')
+    emailing.add_argument('--resend-interrupted', action='store_true',
+        help='send again the emails whose send was interrupted, ex. by a '
+             'crash, instead of reporting them as failed. They may have '
+             'been delivered already')
+    return parser.parse_args(argv)
+
+
+def fill_from_config(args: argparse.Namespace) -> None:
+    """ Replace missing arguments with their config file values. """
+    config = ConfigParser()
+    config.read(args.config, encoding='UTF-8')
+
+    defaults = {
+        'template': ('certificateCreation', 'template', config.get),
+        'userlist': ('certificateCreation', 'userlist', config.get),
+        'font': ('font', 'family', config.get),
+        'size': ('font', 'size', config.getint),
+        'color': ('font', 'color', config.get),
+        'xcoord': ('certificateText', 'xcoord', config.getint),
+        'ycoord': ('certificateText', 'ycoord', config.getint),
+        'alignment': ('certificateText', 'alignment', config.get),
+    }
+
+    for name, (section, option, getter) in defaults.items():
+        if getattr(args, name) is None:
+            setattr(args, name, getter(section, option))
+
+
+def schedule_main(args: argparse.Namespace) -> int:
+    """ Send the scheduled email campaign. """
+    schedule = CampaignSchedule.load(SCHEDULE)
+    if schedule is None:
+        emit('error', message=f'no scheduled campaign in {SCHEDULE}')
+        return EXIT_USAGE
+
+    config = ConfigParser()
+    config.read(args.config, encoding='UTF-8')
+    outbox = EmailOutbox(OUTBOX)
+    email_transports: dict[str, EmailTransport] = {}
+
+    failed = []
+    def log_email(success: bool, index: int) -> None:
+        emit('email', index=index, sent=success)
+        if not success:
+            failed.append(index)
+
+    emit('start', total=schedule.pending(), windows=len(schedule.windows))
+    start = time.perf_counter()
+    try:
+        campaign = create_campaign(
+            config,
+            dict(schedule.settings, resend_interrupted=args.resend_interrupted),
+            outbox,
+            email_transports,
+            BASE_DIR,
+            discovery_cache=GMAIL_DISCOVERY,
+            metrics_folder=METRICS,
+            attachment_cache=ATTACHMENT_CACHE,
+            log_func=log
+        )
+        if not args.resend_interrupted and (interrupted := campaign.interrupted()):
+            log('Interrupted Emails', f'{interrupted} email(s) were interrupted '
+                'while sending and are reported as failed, run with '
+                '--resend-interrupted to send them again', LogLevel.WARNING)
+        schedule.run(
+            campaign,
+            ProgressCounter(schedule.pending()),
+            log_email,
+            log_func=log
+        )
+    except Exception as error:
+        emit('error', message=str(error))
+        return EXIT_FAILURE
+    finally:
+        for email_transport in email_transports.values():
+            email_transport.close()
+        outbox.close()
+
+    emit('done', seconds=round(time.perf_counter() - start, 3))
+    if failed:
+        emit('failed', users=failed)
+        return EXIT_FAILURE
+    return EXIT_OK
+
+
+def worker_main(args: argparse.Namespace) -> int:
+    """ Create certificates for a coordinator. """
+    emit('start', coordinator=str(args.worker), processes=args.processes)
+    try:
+        created = run_worker(
+            args.worker,
+            args.authkey.encode(),
+            args.output,
+            args.processes,
+            log_func=log,
+            catalogue_path=args.catalogue
+        )
+    except Exception as error:
+        emit('error', message=str(error))
+        return EXIT_FAILURE
+
+    emit('done', created=created)
+    return EXIT_OK
+
+
+def coordinator_main(
+    args: argparse.Namespace,
+    settings: dict[str, Any],
+    entries_list: list[User]
+) -> int:
+    """ Hand out `entries_list` to workers until every certificate is done. """
+    authkey = args.authkey.encode()
+    progress = ProgressCounter(len(entries_list))
+    lock = threading.Lock()
+
+    # Called from the thread serving each worker.
+    def progress_func(user: User, worker: str) -> None:
+        with lock:
+            progress.set(progress.get() + 1)
+
+    coordinator = RenderCoordinator(
+        args.serve,
+        authkey,
+        settings,
+        entries_list,
+        chunk_size=args.chunk_size,
+        worker_timeout=args.worker_timeout,
+        output_folder=args.output if args.collect else None,
+        log_func=log
+    )
+    emit('listening', address=str(coordinator.address))
+    coordinator.start(progress_func)
+
+    workers = start_local_workers(
+        coordinator.address,
+        authkey,
+        args.output,
+        args.local_workers,
+        # The local workers share the machine, so they don't size
+        # their pools by all of its cpus.
+        args.processes or 1,
+        args.catalogue
+    )
+    finished = False
+    try:
+        finished = coordinator.wait()
+    finally:
+        # The workers aren't daemons, stop them if the run didn't finish.
+        for worker in workers:
+            if not finished:
+                worker.terminate()
+            worker.join()
+
+    if coordinator.failed:
+        emit('failed', users=[user[0] for user in coordinator.failed])
+        return EXIT_FAILURE
+    return EXIT_OK
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = parse_args(argv)
+
+    # Connections unpickle what they receive, so anyone with
+    # the key can run code on the other end.
+    if args.authkey is None:
+        if args.serve is not None or args.worker is not None:
+            emit('error', message='--serve and --worker need a key, '
+                'set --authkey or the VICER_AUTHKEY environment variable')
+            return EXIT_USAGE
+        if args.local_workers > 0:
+            args.serve = ('localhost', 0)
+            args.authkey = os.urandom(32).hex()
+
+    if args.worker is not None:
+        return worker_main(args)
+
+    if args.send_schedule:
+        return schedule_main(args)
+
+    try:
+        fill_from_config(args)
+        template_path = resolve_file(args.template, TEMPLATES)
+        userlist_path = resolve_file(args.userlist, USERLISTS)
+        font_path = resolve_font(args.font)
+        color = parse_color(args.color)
+
+        for path in (template_path, userlist_path, font_path):
+            if not path.exists():
+                raise FileNotFoundError(f'no such file: {path}')
+
+        if args.alignment not in {LEFT, MIDDLE, RIGHT}:
+            raise ValueError(f'invalid alignment: {args.alignment}')
+
+        userlist = file_to_ulist(userlist_path)
+        image_font = ImageFont.truetype(str(font_path), args.size)
+        args.output.mkdir(parents=True, exist_ok=True)
+    except Exception as error:
+        emit('error', message=str(error))
+        return EXIT_USAGE
+
+    # Same (index, name, email) rows the data viewer hands to the creator,
+    # numbered from 1 like its rows, so both key users the same way.
+    entries_list = [
+        (str(index), name, email)
+        for index, (name, email) in enumerate(userlist, 1)
+    ]
+
+    emit(
+        'start',
+        total=len(entries_list),
+        template=str(template_path),
+        userlist=str(userlist_path),
+        font=str(font_path),
+        output=str(args.output),
+        processes=args.processes
+    )
+
+    start = time.perf_counter()
+    try:
+        if args.serve is not None:
+            settings = make_render_settings(
+                template_path,
+                font_path,
+                args.size,
+                color,
+                (args.xcoord, args.ycoord),
+                args.alignment,
+                args.compress_level,
+                None if args.no_fallback else needed_fallback_fonts(
+                    FontFallback(FONTS, FONT_COVERAGE), font_path, entries_list)
+            )
+            exit_code = coordinator_main(args, settings, entries_list)
+            if exit_code != EXIT_OK:
+                return exit_code
+            emit(
+                'done',
+                created=len(entries_list),
+                seconds=round(time.perf_counter() - start, 3)
+            )
+            return EXIT_OK
+
+        sink = None
+        if args.impose is not None:
+            sink = ImpositionSink(
+                args.sheets or args.output / 'sheets.pdf',
+                n_up=args.impose,
+                sheet_size=args.sheet_size,
+                dpi=args.dpi
+            )
+
+        catalogue = CertificateCatalogue(
+            args.catalogue or args.output / 'catalogue.sqlite')
+
+        certificate_creator = CertificateCreator(
+            image_path=template_path,
+            output_folder=args.output,
+            font=image_font,
+            font_color=color,
+            image_coords=(args.xcoord, args.ycoord),
+            word_position=args.alignment,
+            compress_level=args.compress_level,
+            log_func=log,
+            num_of_processes=args.processes,
+            sink=sink,
+            catalogue=catalogue,
+            use_threads=args.threads,
+            font_fallback=None if args.no_fallback
+                else FontFallback(FONTS, FONT_COVERAGE)
+        )
+        certificate_creator.create_certificates_from_list(
+            threading.Lock(),
+            ProgressCounter(len(entries_list)),
+            entries_list
+        )
+        catalogue.close()
+    except Exception as error:
+        emit('error', message=str(error))
+        return EXIT_FAILURE
+
+    failed = certificate_creator.failed
+    emit(
+        'done',
+        created=len(entries_list) - len(failed),
+        seconds=round(time.perf_counter() - start, 3)
+    )
+    if failed:
+        emit('failed', users=[user[0] for user in failed])
+        return EXIT_FAILURE
+    return EXIT_OK
+
+
+if __name__ == '__main__':
+    # Required for frozen executables that use multiprocessing
+    mp.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,100 @@
+""" Benchmark of building the campaign emails.
+
+Runs a whole campaign for synthetic users through the `MaildirTransport`,
+with the subject, body and template of `config.ini`, and prints the
+throughput as a json line. Nothing is sent, each message is written as an
+`.eml` file, so the output of two runs can be compared with `diff -r`.
+
+    python src/email_benchmark.py --count 50000 --output dry_run
+"""
+import argparse
+import json
+import multiprocessing as mp
+import sys
+import tempfile
+import time
+from configparser import ConfigParser
+from pathlib import Path
+
+from cli import resolve_file
+from paths import *
+from services.email_campaign import EmailCampaign
+from services.maildir_transport import MaildirTransport
+from services.progress import SilentProgress
+
+
+
+def run(count: int, concurrency: int, maildir: Path) -> dict:
+    """ Email `count` users into the `maildir` and return the measurements. """
+    config = ConfigParser()
+    config.read(CONFIG, encoding='UTF-8')
+
+    users = [(str(i), f'Benchmark User {i}', f'user{i}@example.com')
+        for i in range(count)]
+    # Every user gets the template as their certificate.
+    template = resolve_file(config.get('certificateCreation', 'template'), TEMPLATES)
+
+    campaign = EmailCampaign(
+        MaildirTransport(maildir),
+        config.get('emailing', 'testemail'),
+        config.get('emailing', 'subject'),
+        config.get('emailing', 'body'),
+        [],
+        concurrency=concurrency
+    )
+
+    failed = []
+    def log(success: bool, index: str) -> None:
+        if not success:
+            failed.append(index)
+
+    start = time.perf_counter()
+    campaign.send_certificates(
+        SilentProgress(),
+        log,
+        users,
+        [template] * count
+    )
+    seconds = time.perf_counter() - start
+
+    metrics = campaign.metrics.snapshot()
+    build_seconds = [
+        message['build_seconds'] for message in campaign.metrics.messages
+        if message['build_seconds'] is not None
+    ]
+    return {
+        'messages': count,
+        'failed': len(failed),
+        'seconds': round(seconds, 3),
+        'per_second': round(count / seconds, 2),
+        'mean_build_ms': round(1000 * sum(build_seconds) / len(build_seconds), 3)
+            if build_seconds else None,
+        'p95_write_ms': round(1000 * metrics['p95_latency_seconds'], 3)
+            if metrics['p95_latency_seconds'] is not None else None,
+        'bytes': metrics['bytes'],
+        'maildir': str(maildir)
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=1000,
+        help='number of emails to build')
+    parser.add_argument('--concurrency', type=int, default=4,
+        help='number of threads writing the emails')
+    parser.add_argument('--output', type=Path,
+        help='Maildir to keep the emails in, a temporary one by default')
+    args = parser.parse_args()
+
+    if args.output is not None:
+        print(json.dumps(run(args.count, args.concurrency, args.output)), flush=True)
+        return 0
+
+    with tempfile.TemporaryDirectory() as maildir:
+        print(json.dumps(run(args.count, args.concurrency, Path(maildir))), flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    mp.freeze_support()
+    sys.exit(main())
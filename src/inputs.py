@@ -217,3 +217,13 @@ class EmailInput(ttk.Labelframe):
             padding=9, width=18,
         )
         self.send_emails_button.grid(row=3, rowspan=2, column=2, sticky=E)
+
+        self.render_and_send_button = ttk.Button(
+            master=self,
+            bootstyle=(WARNING, OUTLINE),
+            text='Create & Send',
+            padding=9, width=18,
+        )
+        self.render_and_send_button.grid(row=5, column=2, pady=(6, 0), sticky=E)
+        msg = 'Create the certificates and email each one as soon as it\'s created.'
+        ToolTip(self.render_and_send_button, msg=msg, delay=1)
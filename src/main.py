@@ -1,8 +1,8 @@
 import os
 import threading
+import time
 import multiprocessing as mp
 from pathlib import Path
-from functools import partial
 
 import tkinter as tk
 from tkinter.messagebox import askyesno
@@ -16,8 +16,16 @@ from ttkbootstrap.dialogs.dialogs import Messagebox
 from folder_links import FolderLinks
 from inputs import InfoInput, EmailInput
 
+from services.campaign_scheduler import QUOTA_WINDOW, CampaignSchedule
+from services.campaign_setup import create_campaign, daily_limit
+from services.catalogue import CertificateCatalogue
 from services.certificate_creation import CertificateCreator
-from services.email_sender import EmailSender
+from services.email_campaign import EmailCampaign
+from services.email_transport import EmailTransport
+from services.font_fallback import FontFallback
+from services.outbox import EmailOutbox, message_key
+from services.render_and_send import RenderAndSend
+from services.sharded_campaign import ShardedCampaign
 from widgets.font_selector import FontSelector
 
 from widgets.logger import Logger
@@ -26,25 +34,15 @@ from widgets.email_creator import EmailCreator
 from widgets.user_viewer import UserViewer
 from widgets.constants import *
 
-from googleapiclient.errors import HttpError
-
 from services.data_filtering import file_to_ulist
 
 from PIL import ImageFont
 from configparser import ConfigParser
 import services.assets_manager as assets_manager
+from paths import *
 
 
 
-BASE_DIR = Path(__file__).parent.parent
-ASSETS = BASE_DIR / 'assets'
-CERTIFICATES = BASE_DIR / 'certificates'
-FONTS = BASE_DIR / 'fonts'
-TEMPLATES = BASE_DIR / 'templates'
-USERLISTS = BASE_DIR / 'userlists'
-CONFIG = BASE_DIR / 'config.ini'
-
-
 class MainWindow(object):
     def __init__(self, *args, **kwargs):
         self.root = ttk.Window(
@@ -89,6 +87,13 @@ class App(ttk.Frame):
         super().__init__(master)
 
         self.created_certificates = False
+        self.catalogue = CertificateCatalogue(CERTIFICATES / 'catalogue.sqlite')
+        self.font_fallback = FontFallback(FONTS, FONT_COVERAGE)
+        self.outbox = EmailOutbox(OUTBOX)
+        # Created on the first send and kept for the session, so their
+        # connections and access tokens are reused between sends. Keyed
+        # by the sending account, '' for the default one.
+        self.email_transports: dict[str, EmailTransport] = {}
 
         self.rowconfigure(2, weight=1)
         self.columnconfigure(0, weight=1, minsize=450)
@@ -177,6 +182,11 @@ class App(ttk.Frame):
             bootstyle=(DANGER)
         )
 
+        # The live delivery metrics of the campaign being sent.
+        self.email_stats_var = ttk.StringVar(value='')
+        self.email_stats = ttk.Label(self, textvariable=self.email_stats_var)
+        self.sending_campaign: EmailCampaign | None = None
+
         self.seperator = ttk.Separator(self)
         self.seperator.grid(row=1, column=0, columnspan=3, sticky=EW, pady=6)
 
@@ -208,6 +218,9 @@ class App(ttk.Frame):
         self.emailing_options.send_emails_button.configure(
             command=self.send_emails
         )
+        self.emailing_options.render_and_send_button.configure(
+            command=self.render_and_send
+        )
 
         self.image_viewer = ImageViewer(
             master=self.lframe,
@@ -275,8 +288,17 @@ class App(ttk.Frame):
         )
         self.font_configuration.pack(side=TOP, expand=TRUE, fill=BOTH)
 
+        # Set on exit, to stop a scheduled campaign waiting for its window.
+        self.schedule_stop = threading.Event()
+        self.after(500, self.resume_schedule)
+
     def save_state(self, callback, *args, **kwargs):
         try:
+            self.schedule_stop.set()
+            self.catalogue.close()
+            self.outbox.close()
+            for email_transport in self.email_transports.values():
+                email_transport.close()
             self.clean_temp_files()
             self.save_config()
         except:
@@ -365,14 +387,33 @@ class App(ttk.Frame):
     def hide_progressbar(self):
         """ Hide the progressbar and replace it with a seperator. """
         self.progressbar.grid_forget()
+        self.email_stats.grid_forget()
+        if self.sending_campaign is not None:
+            self.logger.log(self.sending_campaign.metrics.summary())
+            self.sending_campaign = None
         self.seperator.grid(row=1, column=0, columnspan=3, sticky=EW, pady=6)
 
-    def create_certificates(self):
+    def show_campaign_metrics(self, campaign: EmailCampaign | ShardedCampaign):
+        """ Show the live metrics of the `campaign` next to the progressbar
+        until it's hidden. """
+        self.sending_campaign = campaign
+        self.email_stats_var.set('')
+        self.progressbar.grid(row=1, column=0, columnspan=2, sticky=EW, pady=6)
+        self.email_stats.grid(row=1, column=2, sticky=E, padx=(6, 0))
+        self.update_campaign_metrics(campaign)
+
+    def update_campaign_metrics(self, campaign: EmailCampaign | ShardedCampaign):
+        if self.sending_campaign is not campaign:
+            return
+        self.email_stats_var.set(campaign.metrics.summary())
+        self.after(1000, self.update_campaign_metrics, campaign)
+
+    def create_certificate_creator(self) -> CertificateCreator:
         font = self.font_configuration.font
         font_path = FONTS / f'{font.cget("family").replace(" ", "-")}.ttf'
         image_font = ImageFont.truetype(str(font_path), font.cget('size'))
 
-        certificate_creator = CertificateCreator(
+        return CertificateCreator(
             image_path=self.certificate_options.image_path.get(),
             output_folder=CERTIFICATES,
             font=image_font,
@@ -380,9 +421,14 @@ class App(ttk.Frame):
             image_coords=self.image_viewer.get_saved_coords(),
             word_position=self.image_viewer.text_alignment_combobox.get(),
             compress_level=3,
-            log_func = self.logger.log
+            log_func = self.logger.log,
+            catalogue=self.catalogue,
+            font_fallback=self.font_fallback
         )
 
+    def create_certificates(self):
+        certificate_creator = self.create_certificate_creator()
+
         if self.certificate_options.test_mode.get():
             entries_list = [('x', 'Name Surname', 'what@gmail.com')]
         else:
@@ -406,22 +452,6 @@ class App(ttk.Frame):
         if not answer:
             return
 
-        email_sender = EmailSender(
-            BASE_DIR / 'client_secret.json',
-            BASE_DIR / 'gmail_token.json'
-        )
-
-        sender = self.emailing_options.real_email_entry.get()
-        email = self.email_creator.get_email()
-        attachments = self.email_creator.get_attachments()
-        subject = email['subject']
-        body = email['body']
-
-        if self.emailing_options.test_mode.get():
-            sender = self.emailing_options.test_email_entry.get()
-        else:
-            sender = self.emailing_options.real_email_entry.get()
-
         if not self.created_certificates:
             Messagebox.show_warning(
                 title='Certificate Emailing',
@@ -429,119 +459,227 @@ class App(ttk.Frame):
             )
             return
 
-        def log(success: bool, index: str):
-            entry = self.data_viewer.get_entry_from_index(index)
-            if success:
-                self.data_viewer._tree.item(entry, tags=['emailSuccess'])
-            else:
-                self.data_viewer._tree.item(entry, tags=['emailError'])
-
-        if self.emailing_options.test_mode.get():
-            userlist = []
-            for item in self.data_viewer.get_num_of_valid_entries(10):
-                item = list(item)
-                item[2] = self.emailing_options.test_email.get()
-                userlist.append(tuple(item))
-        else:
-            userlist = self.data_viewer.get_list_of_valid_entries()
+        settings = self.campaign_settings()
+        campaign = self.create_campaign(settings)
+        userlist = self.get_email_userlist()
+
+        certificate_paths = [
+            self.catalogue.certificate_path(user)
+            or CERTIFICATES / CertificateCreator.certificate_filename(user)
+            for user in userlist
+        ]
+
+        config = ConfigParser()
+        config.read(CONFIG, encoding='UTF-8')
+        limit = daily_limit(config, settings['test_mode'])
+        sent = campaign.sent_keys()
+        unsent = [
+            (user, path) for user, path in zip(userlist, certificate_paths)
+            if message_key(user) not in sent
+        ]
+        used = self.outbox.sent_since(time.time() - QUOTA_WINDOW)
+
+        if limit is not None and len(unsent) > limit - used:
+            answer = askyesno(
+                'Emailing',
+                f'Sending {len(unsent)} emails goes over the daily limit of '
+                f'{limit}, and {used} were sent in the last day already. Send '
+                'them over the next days instead? Each day\'s emails are sent '
+                'while the app is open, or by running the cli with --send-schedule.'
+            )
+            if not answer:
+                return
+
+            for user in userlist:
+                if message_key(user) in sent:
+                    self.log_email(True, int(user[0]))
+            schedule = CampaignSchedule.plan(
+                SCHEDULE,
+                settings,
+                [user for user, _ in unsent],
+                [path for _, path in unsent],
+                limit,
+                used
+            )
+            self.run_schedule(schedule, campaign, self.log_email)
+            return
 
         self.initialize_progressbar(len(userlist))
+        self.show_campaign_metrics(campaign)
 
         App.launch_independent_tread(
-            EmailSenderWrapper.send_certificates,
-            sender,
-            subject,
-            body,
-            attachments,
-            email_sender.create_message,
-            email_sender.send_message,
+            campaign.send_certificates,
             self.progressbar_var,
-            log,
-            self.hide_progressbar,
-            userlist
+            self.log_email,
+            userlist,
+            certificate_paths,
+            self.hide_progressbar
         )
 
-    @staticmethod
-    def launch_independent_tread(
-        target: Callable[..., Any],
-        *args
+    def render_and_send(self):
+        answer = askyesno(
+            'Emailing',
+            'You are about to create the certificates and send emails. Continue?'
+        )
+
+        if not answer:
+            return
+
+        campaign = self.create_campaign()
+        pipeline = RenderAndSend(self.create_certificate_creator(), campaign)
+        userlist = self.get_email_userlist()
+
+        self.created_certificates = True
+        self.initialize_progressbar(pipeline.steps(userlist))
+        self.show_campaign_metrics(campaign)
+
+        App.launch_independent_tread(
+            pipeline.run,
+            self.progressbar_var,
+            self.log_email,
+            userlist,
+            self.hide_progressbar
+        )
+
+    def run_schedule(
+        self,
+        schedule: CampaignSchedule,
+        campaign: EmailCampaign | ShardedCampaign,
+        log: Callable[[bool, int], Any]
     ):
-        independent_thread = threading.Thread(
-            target=target,
-            args=args,
-            daemon=True
+        """ Send the `schedule` with the `campaign` in the background,
+        until it's done or the app is closed. """
+        self.initialize_progressbar(schedule.pending())
+        self.show_campaign_metrics(campaign)
+
+        App.launch_independent_tread(
+            schedule.run,
+            campaign,
+            self.progressbar_var,
+            log,
+            self.hide_progressbar,
+            self.schedule_stop,
+            QUOTA_WINDOW,
+            self.logger.log
         )
-        independent_thread.start()
 
+    def resume_schedule(self):
+        """ Offer to resume the campaign that was scheduled over the daily
+        limit, if it isn't done. """
+        schedule = CampaignSchedule.load(SCHEDULE)
+        if schedule is None or schedule.next_start() is None:
+            return
 
-pdf_path = BASE_DIR / 'attachments' / 'schedule.pdf'
-class EmailSenderWrapper:
-    @staticmethod
-    def send_certificates(
-        sender: str,
-        subject: str,
-        body: str,
-        attachments: list[str],
-        create_message,
-        send_message,
-        progress_var: ttk.IntVar,
-        log : Callable[[], Any] | None,
-        cleanup_func : Callable[[], Any] | None,
-        userlist: list[User]
-    ) -> None:
-
-        func = partial(
-            EmailSenderWrapper.create_message,
-            sender,
-            subject,
-            body,
-            attachments,
-            create_message
+        next_start = time.strftime('%Y-%m-%d %H:%M', time.localtime(schedule.next_start()))
+        answer = askyesno(
+            'Emailing',
+            f'{schedule.pending()} emails of a scheduled campaign are left, '
+            f'the next ones are sent at {next_start}. Resume it?'
         )
+        if not answer:
+            return
 
-        pool = mp.Pool(processes=5)
-        message_list = pool.imap(
-            func,
-            userlist,
-            chunksize=15
+        self.run_schedule(
+            schedule,
+            self.create_campaign(schedule.settings),
+            self.log_scheduled_email
         )
 
-        for message in message_list:
-            try:
-                send_message(message[1])
-                log(True, int(message[0]))
-            except HttpError as error:
-                print('Couldn\'t send email, an http error has occured: ', error)
-                log(False, int(message[0]))
+    def log_scheduled_email(self, success: bool, index: int):
+        """ Log the email of a resumed campaign, whose users
+        may not be in the name list. """
+        if success:
+            self.logger.log('Emailed certificate', f'index: {index}', LogLevel.SUCCESS)
+        else:
+            self.logger.log('Couldn\'t email certificate', f'index: {index}', LogLevel.ERROR)
 
-            progress_var.set(progress_var.get() + 1)
+    def campaign_settings(self) -> dict[str, Any]:
+        """ Return the settings of the campaign of the email being edited. """
+        email = self.email_creator.get_email()
+        test_mode = self.emailing_options.test_mode.get()
 
-        pool.close()
-        pool.join()
+        if test_mode:
+            sender = self.emailing_options.test_email_entry.get()
+        else:
+            sender = self.emailing_options.real_email_entry.get()
 
-        if cleanup_func:
-            cleanup_func()
+        return {
+            'sender': sender,
+            'subject': email['subject'],
+            'body': email['body'],
+            'attachments': self.email_creator.get_attachments(),
+            'test_mode': test_mode
+        }
+
+    def create_campaign(
+        self,
+        settings: dict[str, Any] | None = None
+    ) -> EmailCampaign | ShardedCampaign:
+        """ Return the campaign with the `settings`, by default those of
+        the email being edited. If several Gmail accounts are listed in
+        the `accounts` of the [gmail] section of the config, real emails
+        are sharded over them. If some of its emails were interrupted while
+        sending, asks whether to send them again. """
+        config = ConfigParser()
+        config.read(CONFIG, encoding='UTF-8')
+        settings = settings or self.campaign_settings()
+
+        def campaign(settings: dict[str, Any]) -> EmailCampaign | ShardedCampaign:
+            return create_campaign(
+                config,
+                settings,
+                self.outbox,
+                self.email_transports,
+                BASE_DIR,
+                discovery_cache=GMAIL_DISCOVERY,
+                metrics_folder=METRICS,
+                attachment_cache=ATTACHMENT_CACHE,
+                log_func=self.logger.log
+            )
+
+        email_campaign = campaign(settings)
+        if interrupted := email_campaign.interrupted():
+            answer = askyesno(
+                'Emailing',
+                f'{interrupted} emails of this campaign were interrupted while '
+                'sending, ex. by a crash, and may have been delivered. Send them '
+                'again? Otherwise they are reported as failed.'
+            )
+            if answer:
+                email_campaign = campaign(dict(settings, resend_interrupted=True))
+        return email_campaign
+
+    def get_email_userlist(self) -> list[User]:
+        """ Return the users to email. In test mode, the first 10 users
+        with their email replaced by the test email. """
+        if not self.emailing_options.test_mode.get():
+            return self.data_viewer.get_list_of_valid_entries()
+
+        userlist = []
+        for item in self.data_viewer.get_num_of_valid_entries(10):
+            item = list(item)
+            item[2] = self.emailing_options.test_email.get()
+            userlist.append(tuple(item))
+        return userlist
+
+    def log_email(self, success: bool, index: str):
+        entry = self.data_viewer.get_entry_from_index(index)
+        if success:
+            self.data_viewer._tree.item(entry, tags=['emailSuccess'])
+        else:
+            self.data_viewer._tree.item(entry, tags=['emailError'])
 
     @staticmethod
-    def create_message(
-        sender: str,
-        subject: str,
-        body: str,
-        attachments: list[str],
-        create_message,
-        user: User
-    ) -> tuple[str, str]:
-        certificate_path = CERTIFICATES / str(user[1].replace(' ', '_') + '.png')
-        attachments.append(certificate_path)
-
-        message = create_message(
-            sender=sender,
-            to=user[2],
-            subject=subject,
-            msg_html=body,
-            attachments=attachments
+    def launch_independent_tread(
+        target: Callable[..., Any],
+        *args
+    ):
+        independent_thread = threading.Thread(
+            target=target,
+            args=args,
+            daemon=True
         )
-        return (user[0], message)
+        independent_thread.start()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,17 @@
+from pathlib import Path
+
+
+
+BASE_DIR = Path(__file__).parent.parent
+ASSETS = BASE_DIR / 'assets'
+CERTIFICATES = BASE_DIR / 'certificates'
+FONTS = BASE_DIR / 'fonts'
+TEMPLATES = BASE_DIR / 'templates'
+USERLISTS = BASE_DIR / 'userlists'
+CONFIG = BASE_DIR / 'config.ini'
+FONT_COVERAGE = FONTS / 'coverage.json'
+OUTBOX = BASE_DIR / 'outbox.sqlite'
+GMAIL_DISCOVERY = BASE_DIR / 'gmail_discovery.json'
+METRICS = BASE_DIR / 'metrics'
+ATTACHMENT_CACHE = BASE_DIR / 'attachment_cache'
+SCHEDULE = BASE_DIR / 'email_schedule.json'
@@ -0,0 +1,137 @@
+""" Benchmark of the certificate creation pools.
+
+Creates the same certificates with the process pool and with the thread
+pool, using the settings of `config.ini`, and prints the throughput of
+each as a json line. On free-threaded python builds the thread pool
+should match or beat the process pool; with the GIL it can't.
+
+    python src/render_benchmark.py --count 500 --workers 8
+
+With `--sheets N`, it imposes the template on N print sheets instead, and
+prints how long the first and the last tenth of the sheets took, which
+should be about the same however many sheets there are.
+
+    python src/render_benchmark.py --sheets 300 --format pdf
+"""
+import argparse
+import json
+import multiprocessing as mp
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from PIL import ImageFont
+
+from cli import fill_from_config, parse_args, parse_color, resolve_file, resolve_font
+from paths import *
+from services.certificate_creation import CertificateCreator, gil_disabled
+from services.imposition import ImpositionSink
+from services.progress import SilentProgress
+
+
+
+def run(use_threads: bool, count: int, workers: int | None) -> dict:
+    """ Create `count` certificates and return the measurements. """
+    args = parse_args([])
+    fill_from_config(args)
+
+    users = [(str(i), f'BENCHMARK USER {i}', 'benchmark@example.com')
+        for i in range(count)]
+
+    with tempfile.TemporaryDirectory() as output_folder:
+        creator = CertificateCreator(
+            image_path=resolve_file(args.template, TEMPLATES),
+            output_folder=Path(output_folder),
+            font=ImageFont.truetype(str(resolve_font(args.font)), args.size),
+            font_color=parse_color(args.color),
+            image_coords=(args.xcoord, args.ycoord),
+            word_position=args.alignment,
+            compress_level=args.compress_level,
+            log_func=lambda *_: None,
+            num_of_processes=workers,
+            use_threads=use_threads
+        )
+
+        start = time.perf_counter()
+        creator.create_certificates_from_list(threading.Lock(), SilentProgress(), users)
+        seconds = time.perf_counter() - start
+
+    return {
+        'pool': 'threads' if use_threads else 'processes',
+        'workers': creator.num_of_processes,
+        'certificates': count,
+        'failed': len(creator.failed),
+        'seconds': round(seconds, 3),
+        'per_second': round(count / seconds, 2)
+    }
+
+
+def impose(sheets: int, n_up: int, dpi: int, suffix: str) -> dict:
+    """ Impose the template on `sheets` sheets and return the measurements. """
+    args = parse_args([])
+    fill_from_config(args)
+    certificate = resolve_file(args.template, TEMPLATES).read_bytes()
+
+    sheet_seconds = []
+    with tempfile.TemporaryDirectory() as output_folder:
+        output_path = Path(output_folder) / f'sheets.{suffix}'
+        sink = ImpositionSink(output_path, n_up=n_up, dpi=dpi)
+        start = time.perf_counter()
+        for sheet in range(sheets):
+            sheet_start = time.perf_counter()
+            for i in range(n_up):
+                sink.add((str(sheet * n_up + i), 'BENCHMARK USER', ''), certificate)
+            sheet_seconds.append(time.perf_counter() - sheet_start)
+        close_start = time.perf_counter()
+        sink.close()
+        close_seconds = time.perf_counter() - close_start
+        seconds = time.perf_counter() - start
+        size = output_path.stat().st_size
+
+    tenth = max(1, sheets // 10)
+    return {
+        'format': suffix,
+        'sheets': sheets,
+        'dpi': dpi,
+        'seconds': round(seconds, 3),
+        'first_tenth_seconds': round(sum(sheet_seconds[:tenth]), 3),
+        'last_tenth_seconds': round(sum(sheet_seconds[-tenth:]), 3),
+        'close_seconds': round(close_seconds, 3),
+        'bytes': size
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=200,
+        help='number of certificates to create per pool')
+    parser.add_argument('--workers', type=int,
+        help='pool size, sized by the available cpus and memory by default')
+    parser.add_argument('--sheets', type=int,
+        help='number of print sheets to impose, instead of benchmarking the pools')
+    parser.add_argument('--n-up', type=int, default=2,
+        help='number of certificates per sheet')
+    parser.add_argument('--dpi', type=int, default=100,
+        help='resolution of the sheets')
+    parser.add_argument('--format', choices=['pdf', 'tif'], default='pdf',
+        help='format of the sheets')
+    args = parser.parse_args()
+
+    if args.sheets is not None:
+        print(json.dumps(impose(args.sheets, args.n_up, args.dpi, args.format)), flush=True)
+        return 0
+
+    print(json.dumps({
+        'python': sys.version.split()[0],
+        'gil_disabled': gil_disabled()
+    }), flush=True)
+    for use_threads in (False, True):
+        print(json.dumps(run(use_threads, args.count, args.workers)), flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    mp.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,147 @@
+""" Keeping the emailed certificates under a size budget.
+
+Certificates are saved as lossless pngs, which can be several MB each. That
+slows the uploads down and can go over the recipients' mailbox limits, so
+a certificate over the budget is emailed as a smaller variant instead:
+re-compressed, then converted to JPEG (or PDF) and downscaled to the
+target DPI until it fits. The variants are cached on disk, and the full
+resolution certificate is kept as it is.
+"""
+import hashlib
+import io
+import os
+import threading
+from pathlib import Path
+from typing import Iterator
+
+from PIL import Image, UnidentifiedImageError
+
+
+
+JPEG = 'JPEG'
+PDF = 'PDF'
+LOSSY_FORMATS = {JPEG: '.jpg', PDF: '.pdf'}
+# The print width of a certificate without dpi info, in inches (A4 landscape).
+PRINT_WIDTH = 11.69
+
+
+class AttachmentBudget:
+    """ Replaces the certificates that are over `max_bytes` with smaller
+    variants. Can be shared between threads.
+
+    Args:
+        max_bytes: The maximum size of a certificate attachment.
+        cache_folder: The folder the variants are cached in. Each is kept
+            in its own subfolder, so its file name matches the original's.
+        dpi: The resolution certificates are downscaled to, when
+            re-compressing them isn't enough.
+        lossy_format: `JPEG` or `PDF`, the format of the variants that
+            aren't lossless.
+        print_width: The print width in inches of the certificates that
+            have no dpi info, to find their resolution.
+    """
+    def __init__(
+        self,
+        max_bytes: int,
+        cache_folder: Path,
+        dpi: int = 150,
+        lossy_format: str = JPEG,
+        print_width: float = PRINT_WIDTH
+    ) -> None:
+        if lossy_format not in LOSSY_FORMATS:
+            raise ValueError(f'Unknown attachment format: {lossy_format}')
+
+        self.max_bytes = max_bytes
+        self.cache_folder = cache_folder
+        self.dpi = dpi
+        self.lossy_format = lossy_format
+        self.print_width = print_width
+
+    def minus(self, size: int) -> 'AttachmentBudget':
+        """ Return the budget left after `size` bytes of other attachments. """
+        return AttachmentBudget(
+            self.max_bytes - size,
+            self.cache_folder,
+            self.dpi,
+            self.lossy_format,
+            self.print_width
+        )
+
+    def fit(self, path: Path) -> Path:
+        """ Return the path of the certificate if it's within the budget,
+        or else the path of its smallest variant that is. If none is,
+        the smallest variant is returned anyway. """
+        path = Path(path)
+        stat = path.stat()
+        if stat.st_size <= self.max_bytes:
+            return path
+
+        folder = self.cache_folder / self._key(path, stat)
+        if folder.is_dir():
+            for cached in folder.iterdir():
+                if cached.stem == path.stem:
+                    return cached
+
+        try:
+            with Image.open(path) as image:
+                image.load()
+        except (UnidentifiedImageError, OSError):
+            # Not an image, it can't be made smaller.
+            return path
+
+        best: tuple[str, bytes] | None = None
+        for suffix, data in self._variants(image):
+            if best is None or len(data) < len(best[1]):
+                best = (suffix, data)
+            if len(data) <= self.max_bytes:
+                break
+
+        folder.mkdir(parents=True, exist_ok=True)
+        variant = folder / (path.stem + best[0])
+        # Written to a temporary file first, so a concurrent
+        # campaign never attaches half a variant.
+        temp_path = folder / f'{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp'
+        temp_path.write_bytes(best[1])
+        os.replace(temp_path, variant)
+        return variant
+
+    def _key(self, path: Path, stat: os.stat_result) -> str:
+        """ Return the key of the variant of the certificate at `path`.
+        It changes when the certificate or the budget changes. """
+        key = '\0'.join(map(str, (
+            path.resolve(),
+            stat.st_size,
+            stat.st_mtime_ns,
+            self.max_bytes,
+            self.dpi,
+            self.lossy_format
+        )))
+        return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+    def _variants(self, image: Image.Image) -> Iterator[tuple[str, bytes]]:
+        """ Yield the file suffix and data of each variant, from the
+        best looking to the smallest. """
+        yield '.png', _encode(image, 'PNG', optimize=True, compress_level=9)
+
+        source_dpi = image.info.get('dpi', (0, 0))[0] or image.width / self.print_width
+        scale = min(1.0, self.dpi / source_dpi)
+        image = image.convert('RGB')
+
+        steps = [(1.0, 85), (scale, 85), (scale, 70), (scale * 0.75, 70), (scale * 0.5, 60)]
+        for factor, quality in dict.fromkeys(steps):
+            resized = image if factor == 1.0 else image.resize(
+                (max(1, round(image.width * factor)), max(1, round(image.height * factor))),
+                Image.LANCZOS
+            )
+            dpi = round(source_dpi * factor)
+            if self.lossy_format == PDF:
+                data = _encode(resized, PDF, quality=quality, resolution=dpi)
+            else:
+                data = _encode(resized, JPEG, quality=quality, dpi=(dpi, dpi), optimize=True)
+            yield LOSSY_FORMATS[self.lossy_format], data
+
+
+def _encode(image: Image.Image, format: str, **options) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **options)
+    return buffer.getvalue()
@@ -0,0 +1,183 @@
+""" Delivery metrics of an email campaign.
+
+Every message of a campaign is recorded with the time it took to build,
+the latency of its send request, its size, its attempts and its outcome.
+Live counters are computed from the records while the campaign runs, and
+all of it can be saved as json once it's done.
+"""
+import json
+import smtplib
+import threading
+import time
+from collections import Counter, deque
+from pathlib import Path
+from typing import Any
+
+from googleapiclient.errors import HttpError
+
+
+
+SENT = 'sent'
+FAILED = 'failed'
+# The window of the live throughput, in seconds.
+RATE_WINDOW = 10
+
+
+def error_status(error: Exception) -> str:
+    """ Return the HTTP status or SMTP reply code of the error,
+    or its type if it has neither. """
+    if isinstance(error, HttpError):
+        return str(error.status_code)
+    if isinstance(error, smtplib.SMTPResponseException):
+        return str(error.smtp_code)
+    return type(error).__name__
+
+
+def _percentile(values: list[float], percent: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class CampaignMetrics:
+    """ Records the delivery of the messages of a campaign.
+    Can be shared between threads.
+
+    Args:
+        campaign_id: The id of the campaign.
+    """
+    def __init__(self, campaign_id: str) -> None:
+        self.campaign_id = campaign_id
+        self.started_at = time.time()
+        self.finished_at: float | None = None
+        self.messages: list[dict[str, Any]] = []
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._build_seconds: dict[str, float] = {}
+        self._latencies: list[float] = []
+        self._recent: deque[float] = deque()
+        self._attempts = 0
+        self._retries = 0
+        self._bytes = 0
+        self._errors: Counter[str] = Counter()
+        self._outcomes: Counter[str] = Counter()
+
+    def record_build(self, index: str, seconds: float) -> None:
+        """ Record that the message to the user with `index` took
+        `seconds` to build. """
+        with self._lock:
+            self._build_seconds[index] = seconds
+
+    def record_skipped(self) -> None:
+        """ Record a message that wasn't sent, since it already was. """
+        with self._lock:
+            self.skipped += 1
+
+    def record_attempt(
+        self,
+        index: str,
+        latency: float,
+        size: int,
+        attempt: int,
+        error: Exception | None,
+        retried: bool = False
+    ) -> None:
+        """ Record an attempt to send the message to the user with `index`.
+
+        Args:
+            index: The index of the user.
+            latency: The seconds the send request took.
+            size: The size of the message's payload in bytes.
+            attempt: The attempt, counting from 1.
+            error: The error of the attempt, or None if it was sent.
+            retried: Whether the message will be sent again.
+        """
+        status = None if error is None else error_status(error)
+        with self._lock:
+            self._attempts += 1
+            self._latencies.append(latency)
+            self._bytes += size
+            if status is not None:
+                self._errors[status] += 1
+            if retried:
+                self._retries += 1
+                return
+
+            outcome = SENT if error is None else FAILED
+            self._outcomes[outcome] += 1
+            self._recent.append(time.monotonic())
+            self.messages.append({
+                'index': index,
+                'build_seconds': self._build_seconds.pop(index, None),
+                'latency_seconds': latency,
+                'bytes': size,
+                'attempts': attempt,
+                'outcome': outcome,
+                'status': status
+            })
+
+    def finish(self) -> None:
+        with self._lock:
+            self.finished_at = time.time()
+
+    def snapshot(self) -> dict[str, Any]:
+        """ Return the live counters of the campaign. """
+        with self._lock:
+            now = time.monotonic()
+            while self._recent and self._recent[0] < now - RATE_WINDOW:
+                self._recent.popleft()
+            elapsed = (self.finished_at or time.time()) - self.started_at
+            done = self._outcomes[SENT] + self._outcomes[FAILED]
+            p50 = _percentile(self._latencies, 50)
+            p95 = _percentile(self._latencies, 95)
+            return {
+                'sent': self._outcomes[SENT],
+                'failed': self._outcomes[FAILED],
+                'skipped': self.skipped,
+                'attempts': self._attempts,
+                'retries': self._retries,
+                'bytes': self._bytes,
+                'seconds': round(elapsed, 3),
+                'messages_per_second': round(done / elapsed, 2) if elapsed else 0.0,
+                'recent_messages_per_second': round(
+                    len(self._recent) / min(RATE_WINDOW, elapsed or 1), 2),
+                'p50_latency_seconds': None if p50 is None else round(p50, 4),
+                'p95_latency_seconds': None if p95 is None else round(p95, 4),
+                'error_rate': round(sum(self._errors.values()) / self._attempts, 4)
+                    if self._attempts else 0.0,
+                'errors_by_status': dict(self._errors)
+            }
+
+    def summary(self) -> str:
+        """ Return the live counters in a single line. """
+        snapshot = self.snapshot()
+        text = f'{snapshot["recent_messages_per_second"]:.1f} msg/s'
+        if snapshot['p95_latency_seconds'] is not None:
+            text += f' | p95 {snapshot["p95_latency_seconds"] * 1000:.0f} ms'
+        text += f' | errors {snapshot["error_rate"]:.1%}'
+        if snapshot['errors_by_status']:
+            text += ' (' + ', '.join(
+                f'{status}: {count}' for status, count
+                in sorted(snapshot['errors_by_status'].items())
+            ) + ')'
+        return text
+
+    def save(self, folder: Path) -> Path:
+        """ Save the counters and the record of every message
+        in a json file in `folder`, and return its path. """
+        folder.mkdir(parents=True, exist_ok=True)
+        started = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))
+        milliseconds = int(self.started_at * 1000) % 1000
+        path = folder / f'campaign-{self.campaign_id}-{started}-{milliseconds:03d}.json'
+        with self._lock:
+            messages = list(self.messages)
+        with open(path, 'w', encoding='UTF-8') as file:
+            json.dump({
+                'campaign_id': self.campaign_id,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+                **self.snapshot(),
+                'messages': messages
+            }, file, indent=1)
+        return path
@@ -0,0 +1,266 @@
+""" Spreading a campaign over the daily sending limit.
+
+A list longer than what the account can send in a day is planned over
+quota windows: each window gets at most the daily limit of users, and
+opens a day after the previous one. The plan is saved as json, so when
+the app or the headless cli is started again, the campaign resumes
+where it stopped, and every window is sent once it opens. Within a window
+the emails go out as fast as the transport's rate limiter allows.
+"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable
+
+from services.constants import *
+from services.email_campaign import EmailCampaign
+from services.progress import SilentProgress
+from services.retrying import is_quota_error
+from services.sharded_campaign import ShardedCampaign
+
+if TYPE_CHECKING:
+    import ttkbootstrap as ttk
+
+
+
+# The period of the daily sending limits, in seconds. Gmail counts it
+# over a rolling day.
+QUOTA_WINDOW = 24 * 60 * 60
+
+
+class CampaignSchedule:
+    """ The plan of a campaign over quota windows, saved in a json file.
+    Create one with `plan`, or load a saved one with `load`.
+
+    Args:
+        path: The json file of the plan.
+        settings: The settings the campaign is created with, ex. its
+            subject and body, so it can be created again to resume it.
+        users: Each user of the campaign and the path of their certificate.
+        windows: Each window's start timestamp and the indexes of its users.
+        daily_limit: The most users of a window. Defaults to the number of
+            users of the largest window, for plans saved without it.
+    """
+    def __init__(
+        self,
+        path: Path,
+        settings: dict[str, Any],
+        users: list[tuple[User, Path]],
+        windows: list[dict[str, Any]],
+        daily_limit: int | None = None
+    ) -> None:
+        self.path = path
+        self.settings = settings
+        self.users = users
+        self.windows = windows
+        if daily_limit is None:
+            daily_limit = max((len(window['users']) for window in windows), default=1)
+        self.daily_limit = max(1, daily_limit)
+
+    @classmethod
+    def plan(
+        cls,
+        path: Path,
+        settings: dict[str, Any],
+        userlist: list[User],
+        certificate_paths: list[Path],
+        daily_limit: int,
+        used: int = 0,
+        now: float | None = None,
+        window: float = QUOTA_WINDOW
+    ) -> 'CampaignSchedule':
+        """ Plan the users over windows of `daily_limit` users, and save
+        the plan in `path`, replacing any earlier one.
+
+        Args:
+            path: The json file of the plan.
+            settings: See `CampaignSchedule`.
+            userlist: The users to email.
+            certificate_paths: The certificate of each user.
+            daily_limit: The emails the account can send per `window`.
+            used: The emails the account already sent in the last `window`,
+                they are taken from the first window.
+            now: The start of the first window, defaults to now.
+            window: The seconds between the start of two windows.
+        """
+        now = time.time() if now is None else now
+        daily_limit = max(1, daily_limit)
+
+        schedule = cls(
+            path,
+            settings,
+            [(user, Path(certificate_path)) for user, certificate_path
+                in zip(userlist, certificate_paths)],
+            cls._fill_windows(
+                [str(user[0]) for user in userlist],
+                now,
+                max(0, daily_limit - used),
+                daily_limit,
+                window
+            ),
+            daily_limit
+        )
+        schedule.save()
+        return schedule
+
+    @staticmethod
+    def _fill_windows(
+        indexes: list[str],
+        start: float,
+        capacity: int,
+        daily_limit: int,
+        window: float
+    ) -> list[dict[str, Any]]:
+        """ Return the windows of the `indexes`, the first opening at
+        `start` with room for `capacity` users, and each next one a
+        `window` later with room for `daily_limit`. """
+        windows = []
+        while indexes:
+            windows.append({'start': start, 'users': indexes[:capacity]})
+            indexes = indexes[capacity:]
+            start, capacity = start + window, daily_limit
+        return [window for window in windows if window['users']]
+
+    @classmethod
+    def load(cls, path: Path) -> 'CampaignSchedule | None':
+        """ Return the plan saved in `path`, or None if there is none. """
+        try:
+            with open(path, encoding='UTF-8') as file:
+                data = json.load(file)
+            return cls(
+                path,
+                data['settings'],
+                [(tuple(user), Path(certificate_path))
+                    for *user, certificate_path in data['users']],
+                data['windows'],
+                data.get('daily_limit')
+            )
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self) -> None:
+        # Written to a temporary file first, so a crash while saving
+        # doesn't lose the plan.
+        temp_path = self.path.with_suffix('.tmp')
+        with open(temp_path, 'w', encoding='UTF-8') as file:
+            json.dump({
+                'settings': self.settings,
+                'users': [[*user, str(certificate_path)]
+                    for user, certificate_path in self.users],
+                'windows': self.windows,
+                'daily_limit': self.daily_limit
+            }, file, indent=1)
+        os.replace(temp_path, self.path)
+
+    def pending(self) -> int:
+        """ Return the number of users left to email. """
+        return sum(len(window['users']) for window in self.windows)
+
+    def next_start(self) -> float | None:
+        """ Return the start timestamp of the next window,
+        or None if the campaign is done. """
+        return self.windows[0]['start'] if self.windows else None
+
+    def run(
+        self,
+        campaign: EmailCampaign | ShardedCampaign,
+        progress_var: 'ttk.IntVar',
+        log: Callable[[bool, int], Any],
+        cleanup_func: Callable[[], Any] | None = None,
+        stop: threading.Event | None = None,
+        window: float = QUOTA_WINDOW,
+        log_func: Callable[..., Any] | None = None
+    ) -> bool:
+        """ Send each window of the plan with the `campaign` once it opens,
+        waiting for it if it hasn't. The users that couldn't be sent because
+        the quota ran out anyway, ex. because of emails sent by other apps,
+        are planned again with the users of the later windows, ahead of
+        them, so no window gets more than the daily limit. The plan is
+        saved after every window, and deleted once the campaign is done.
+
+        Args:
+            campaign: The campaign created with the plan's settings.
+            progress_var: An IntVar that represents the amount of emails
+                sent. Its maximum should be `pending()`.
+            log: Called with whether the email was sent and the user's index.
+            cleanup_func: If given, run after all the emails have been sent,
+                or when stopped.
+            stop: If given, setting it stops waiting for the next window.
+            window: The seconds between the start of two windows.
+            log_func: Log func with the signature of `Logger.log`, for the
+                waits and the users moved to the next window.
+
+        Returns:
+            Whether the campaign is done, False if it was stopped.
+        """
+        stop = stop or threading.Event()
+        users = {str(user[0]): (user, path) for user, path in self.users}
+        lock = threading.Lock()
+
+        try:
+            while self.windows and not stop.is_set():
+                current = self.windows[0]
+                if (wait := current['start'] - time.time()) > 0:
+                    if log_func is not None:
+                        log_func(
+                            'Waiting For Sending Window',
+                            time.strftime('%Y-%m-%d %H:%M', time.localtime(current['start'])),
+                            LogLevel.INFO
+                        )
+                    if stop.wait(wait):
+                        break
+
+                over_quota: list[str] = []
+
+                # Called by the campaign after recording the error in `failed`.
+                def window_log(success: bool, index: int) -> None:
+                    error = campaign.failed.get(str(index))
+                    if not success and error is not None and is_quota_error(error):
+                        over_quota.append(str(index))
+                        return
+                    with lock:
+                        log(success, index)
+                        progress_var.set(progress_var.get() + 1)
+
+                entries = [users[index] for index in current['users'] if index in users]
+                # The schedule reports the progress itself.
+                campaign.send_certificates(
+                    SilentProgress(),
+                    window_log,
+                    [user for user, _ in entries],
+                    [path for _, path in entries]
+                )
+
+                self.windows.pop(0)
+                if over_quota:
+                    if log_func is not None:
+                        log_func(
+                            'Moving Emails',
+                            f'{len(over_quota)} email(s) to the next sending window',
+                            LogLevel.WARNING
+                        )
+                    # The quota frees up as the window's first sends
+                    # get a day old, unless the window is over already.
+                    start = self.windows[0]['start'] if self.windows \
+                        else current['start'] + window
+                    if start <= time.time():
+                        start = time.time() + window
+                    self.windows = self._fill_windows(
+                        over_quota + [index for later in self.windows
+                            for index in later['users']],
+                        start,
+                        self.daily_limit,
+                        self.daily_limit,
+                        window
+                    )
+                self.save()
+        finally:
+            if cleanup_func:
+                cleanup_func()
+
+        if self.windows:
+            return False
+        self.path.unlink(missing_ok=True)
+        return True
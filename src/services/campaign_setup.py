@@ -0,0 +1,164 @@
+""" Creating the email campaigns configured in the config file.
+
+Shared by the app and the headless cli, so a campaign scheduled in one
+is sent the same way by the other.
+"""
+import os
+from configparser import ConfigParser
+from pathlib import Path
+from typing import Any, Callable
+
+from services.attachment_budget import AttachmentBudget
+from services.email_campaign import EmailCampaign
+from services.email_sender import EmailSender
+from services.email_transport import EmailTransport
+from services.maildir_transport import MaildirTransport
+from services.outbox import EmailOutbox
+from services.sharded_campaign import ShardedCampaign
+from services.smtp_transport import SmtpTransport
+
+
+
+# The daily sending limit of a Gmail account. Workspace accounts can
+# send 2000 emails a day, they can set it in the [gmail] section.
+GMAIL_DAILY_LIMIT = 500
+
+
+def create_email_transport(
+    config: ConfigParser,
+    folder: Path,
+    account: str = '',
+    discovery_cache: Path | None = None
+) -> EmailTransport:
+    """ Return the SMTP relay configured in the [smtp] section of the
+    config, or the Gmail API if there is none. The password of the
+    relay is read from the VICER_SMTP_PASSWORD environment variable.
+    If the [maildir] section has a path, the emails are written to
+    that Maildir instead of being sent, for dry runs.
+
+    Args:
+        config: The config file.
+        folder: The folder of the client secret and token files. A relative
+            Maildir path is relative to it too.
+        account: The Gmail account to send from. Each account has its
+            own token file, the default one's is gmail_token.json.
+        discovery_cache: The file the Gmail discovery document is cached in.
+    """
+    if maildir := config.get('maildir', 'path', fallback=''):
+        return MaildirTransport(folder / maildir)
+
+    if not (host := config.get('smtp', 'host', fallback='')):
+        return EmailSender(
+            folder / 'client_secret.json',
+            folder / (f'gmail_token-{account}.json' if account else 'gmail_token.json'),
+            discovery_cache=discovery_cache,
+            refresh_in_background=True
+        )
+
+    return SmtpTransport(
+        host,
+        port=config.getint('smtp', 'port', fallback=587),
+        security=config.get('smtp', 'security', fallback='starttls'),
+        username=config.get('smtp', 'username', fallback='') or None,
+        password=os.environ.get('VICER_SMTP_PASSWORD')
+    )
+
+
+def email_accounts(config: ConfigParser, test_mode: bool = False) -> list[str]:
+    """ Return the Gmail accounts listed in the `accounts` of the [gmail]
+    section, that real emails are sharded over. Empty if there are less
+    than two, or if the emails aren't sent through the Gmail API. """
+    accounts = [
+        account.strip() for account
+        in config.get('gmail', 'accounts', fallback='').split(',')
+        if account.strip()
+    ]
+    if len(accounts) < 2 or test_mode or config.get('maildir', 'path', fallback='') \
+            or config.get('smtp', 'host', fallback=''):
+        return []
+    return accounts
+
+
+def daily_limit(config: ConfigParser, test_mode: bool = False) -> int | None:
+    """ Return the emails that can be sent per day, or None if there is no
+    limit. It's read from the `dailylimit` of the [smtp] section for a relay,
+    and of the [gmail] section for each Gmail account. """
+    if config.get('maildir', 'path', fallback=''):
+        return None
+    if config.get('smtp', 'host', fallback=''):
+        return config.getint('smtp', 'dailyLimit', fallback=0) or None
+    limit = config.getint('gmail', 'dailyLimit', fallback=GMAIL_DAILY_LIMIT)
+    return limit * max(1, len(email_accounts(config, test_mode)))
+
+
+def create_campaign(
+    config: ConfigParser,
+    settings: dict[str, Any],
+    outbox: EmailOutbox,
+    email_transports: dict[str, EmailTransport],
+    folder: Path,
+    discovery_cache: Path | None = None,
+    metrics_folder: Path | None = None,
+    attachment_cache: Path | None = None,
+    log_func: Callable[..., Any] | None = None
+) -> EmailCampaign | ShardedCampaign:
+    """ Return the campaign of the email, sharded over the Gmail accounts
+    of the config, if there are several.
+
+    Args:
+        config: The config file.
+        settings: The sender, subject, body, attachments and test_mode of
+            the campaign. If `resend_interrupted` is true, the messages whose
+            send was interrupted are sent again.
+        outbox: The outbox the campaign is recorded in.
+        email_transports: The transports created so far, by account, ''
+            for the default one. The missing ones are created and added.
+        folder: See `create_email_transport`.
+        discovery_cache: See `create_email_transport`.
+        metrics_folder: If given, the metrics of every run of the campaign
+            are saved in it as json.
+        attachment_cache: The folder the variants of the certificates over
+            the attachment budget are cached in. If None, the certificates
+            are sent as they are.
+        log_func: Log func with the signature of `Logger.log`.
+    """
+    # The budget is in MB, 0 sends the certificates as they are.
+    budget = config.getfloat('emailing', 'attachmentBudget', fallback=5)
+    attachment_budget = AttachmentBudget(int(budget * 1024 * 1024), attachment_cache) \
+        if budget > 0 and attachment_cache is not None else None
+
+    def account_campaign(account: str, sender: str) -> EmailCampaign:
+        if account not in email_transports:
+            email_transports[account] = create_email_transport(
+                config, folder, account, discovery_cache)
+        email_sender = email_transports[account]
+
+        # Dry runs aren't recorded in the outbox, or the real campaign
+        # would skip their users. Neither are test emails, which are
+        # sent again every time, like before there was an outbox.
+        recorded = not isinstance(email_sender, MaildirTransport) \
+            and not settings.get('test_mode', False)
+
+        return EmailCampaign(
+            email_sender,
+            sender,
+            settings['subject'],
+            settings['body'],
+            settings['attachments'],
+            concurrency=4,
+            batch_size=10,
+            outbox=outbox if recorded else None,
+            resend_interrupted=settings.get('resend_interrupted', False),
+            metrics_folder=metrics_folder,
+            attachment_budget=attachment_budget,
+            log_func=log_func
+        )
+
+    accounts = email_accounts(config, settings.get('test_mode', False))
+    if not accounts:
+        return account_campaign('', settings['sender'])
+    return ShardedCampaign(
+        [account_campaign(account, account) for account in accounts],
+        metrics_folder=metrics_folder,
+        log_func=log_func
+    )
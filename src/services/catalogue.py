@@ -0,0 +1,130 @@
+""" SQLite catalogue of the created certificates.
+
+Every certificate the `CertificateCreator` creates is recorded with the
+hash of the inputs that produced it, where it was saved, its size, how
+long it took and whether it succeeded. The emailing uses the catalogue to
+find each user's certificate instead of guessing its filename.
+"""
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+from services.constants import *
+
+
+
+CREATED = 'created'
+FAILED = 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS certificates (
+    row_key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    output_path TEXT,
+    size INTEGER,
+    render_seconds REAL,
+    status TEXT NOT NULL,
+    error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS certificates_email ON certificates (email);
+"""
+
+
+class CertificateCatalogue:
+    """ Records created certificates in a SQLite database. Rows are keyed
+    by the user's row key (the index of the user in the userlist) and
+    indexed by email. Can be shared between threads.
+
+    Args:
+        path: The database file. Created if it doesn't exist.
+        commit_every: Number of recorded certificates between commits.
+    """
+    def __init__(self, path: Path, commit_every: int = 100) -> None:
+        self.path = path
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(_SCHEMA)
+
+    def record(
+        self,
+        user: User,
+        input_hash: str,
+        output_path: Path | None,
+        size: int | None,
+        render_seconds: float,
+        status: str = CREATED,
+        error: str | None = None
+    ) -> None:
+        """ Record the certificate of `user`, replacing any earlier one. """
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO certificates VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    str(user[0]),
+                    user[1],
+                    user[2],
+                    input_hash,
+                    None if output_path is None else str(output_path),
+                    size,
+                    render_seconds,
+                    status,
+                    error,
+                    time.time()
+                )
+            )
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self._commit()
+
+    def get(self, row_key: str) -> dict[str, Any] | None:
+        """ Return the catalogue row of the user with `row_key`. """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT * FROM certificates WHERE row_key = ?',
+                (str(row_key),)
+            ).fetchone()
+        return None if row is None else dict(row)
+
+    def find_by_email(self, email: str) -> list[dict[str, Any]]:
+        """ Return the catalogue rows of the users with `email`. """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT * FROM certificates WHERE email = ?',
+                (email,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def certificate_path(self, user: User) -> Path | None:
+        """ Return the path of the `user`'s certificate, or None if it
+        wasn't created or was created for a different name. """
+        row = self.get(user[0])
+        if row is None or row['status'] != CREATED or row['output_path'] is None:
+            return None
+        # Only the name is drawn on the certificate, the email can differ,
+        # ex. when test emails are sent.
+        if row['name'] != user[1]:
+            return None
+        return Path(row['output_path'])
+
+    def commit(self) -> None:
+        with self._lock:
+            self._commit()
+
+    def _commit(self) -> None:
+        self._conn.commit()
+        self._uncommitted = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._commit()
+            self._conn.close()
@@ -1,15 +1,136 @@
 from functools import partial
+from io import BytesIO
+import hashlib
 from pathlib import Path
-from time import sleep
+from time import perf_counter, sleep
 
 import multiprocessing as mp
+import queue
+import sys
 import threading
-from typing import Any, Callable
+from multiprocessing.pool import ThreadPool
+from typing import TYPE_CHECKING, Any, Callable
 
 from PIL import Image, ImageDraw, ImageFont
-from widgets.constants import *
-import ttkbootstrap as ttk
+from services.catalogue import CREATED, FAILED, CertificateCatalogue
+from services.constants import *
+from services.font_fallback import FontFallback
+from services.worker_sizing import choose_num_of_processes
 
+# The creator is also used by the headless cli, so tkinter
+# must not be imported at runtime.
+if TYPE_CHECKING:
+    import ttkbootstrap as ttk
+
+
+
+def gil_disabled() -> bool:
+    """ Return true on free-threaded python builds running without the GIL. """
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return is_gil_enabled is not None and not is_gil_enabled()
+
+
+class CertificateSink:
+    """ Receives the certificates of a `CertificateCreator` as they are
+    created, instead of them being saved in the output folder. """
+    def add(self, user: User, data: bytes) -> None:
+        """ Receive the `user`'s certificate, encoded as a png. """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """ Called after the last certificate has been added. """
+
+
+class CertificateWriter(CertificateSink):
+    """ Saves certificates in `output_folder` from a background thread.
+
+    The pool workers only encode the certificates, so a slow output disk
+    doesn't keep them from encoding. The queue is bounded, so when the disk
+    can't keep up, adding certificates blocks instead of buffering them
+    without limit.
+
+    Args:
+        output_folder: The folder to save the certificates in.
+        max_queued: The number of certificates that can wait to be saved,
+            before `add` blocks.
+        batch_size: The maximum number of certificates saved per wake up
+            of the writer thread.
+        error_func: Called from the writer thread with the user and the
+            error, for every certificate that couldn't be saved.
+        saved_func: Called from the writer thread with the user and the
+            path, for every certificate that was saved.
+    """
+    def __init__(
+        self,
+        output_folder: Path,
+        max_queued: int = 64,
+        batch_size: int = 16,
+        error_func: Callable[[User, str], Any] | None = None,
+        saved_func: Callable[[User, Path], Any] | None = None
+    ) -> None:
+        self.output_folder = output_folder
+        self.batch_size = batch_size
+        self.error_func = error_func
+        self.saved_func = saved_func
+        self._queue: queue.Queue[tuple[User, bytes] | None] = queue.Queue(max_queued)
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def add(self, user: User, data: bytes) -> None:
+        """ Queue the certificate to be saved. Blocks while the queue is full. """
+        self._queue.put((user, data))
+
+    def close(self) -> None:
+        """ Block until every queued certificate has been saved. """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _write_loop(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for item in batch:
+                if item is None:
+                    return
+                self._write(*item)
+
+    def _write(self, user: User, data: bytes) -> None:
+        path = self.output_folder / CertificateCreator.certificate_filename(user)
+        try:
+            with open(path, 'wb') as file:
+                file.write(data)
+        except OSError as error:
+            if self.error_func is not None:
+                self.error_func(user, f'{type(error).__name__}: {error}')
+            return
+
+        if self.saved_func is not None:
+            self.saved_func(user, path)
+
+
+def _timed_call(
+    func: Callable[[User], Any],
+    user: User
+) -> tuple[User, Any, float, str | None]:
+    """ Call `func` with `user` in a pool worker. Errors are returned
+    instead of raised, so that one bad user doesn't stop the batch.
+
+    Returns:
+        The user, the result of the func, the seconds it took and the error.
+    """
+    start = perf_counter()
+    try:
+        result = func(user)
+        error = None
+    except Exception as exception:
+        result = None
+        error = f'{type(exception).__name__}: {exception}'
+    return user, result, perf_counter() - start, error
 
 
 class CertificateCreator:
@@ -24,9 +145,13 @@ class CertificateCreator:
         word_position: str,
         compress_level: int,
         log_func,
-        num_of_processes: int = mp.cpu_count() - 1
+        num_of_processes: int | None = None,
+        sink: CertificateSink | None = None,
+        catalogue: CertificateCatalogue | None = None,
+        use_threads: bool | None = None,
+        font_fallback: FontFallback | None = None,
+        saved_func: Callable[[User, Path], Any] | None = None
     ) -> None:
-        self.num_of_processes = num_of_processes
         self.image = Image.open(image_path)
         self.output_folder = output_folder
         self.font = font
@@ -43,11 +168,46 @@ class CertificateCreator:
             self.align = 'right'
         self.compress_level = compress_level
         self.log_func = log_func
+        # If a sink is given, certificates are handed to it instead
+        # of being saved in the output folder.
+        self.sink = sink
+        # Called with each certificate saved in the output folder,
+        # ex. to email it right away.
+        self.saved_func = saved_func
+        self.catalogue = catalogue
+        self.font_fallback = font_fallback
+        # Fallback font of each character of the batch that the font lacks
+        self.fallbacks: dict[str, ImageFont.FreeTypeFont] = {}
+        self.settings_hash = self._hash_settings()
+        # Users whose certificates couldn't be created in the last batch
+        self.failed: list[User] = []
+
+        # Without the GIL, threads that share the template are as fast as
+        # processes, without the pickling and the per process templates.
+        if use_threads is None:
+            use_threads = gil_disabled()
+        self.use_threads = use_threads
+        # FreeType faces can't be used by several threads at once,
+        # so every thread gets its own variant of the font.
+        self._thread_fonts = threading.local()
+
+        # Size the pool by the available cpus and memory, unless told otherwise
+        if num_of_processes is None:
+            num_of_processes, reason = choose_num_of_processes(
+                self.image, threads=self.use_threads)
+            if self.log_func is not None:
+                kind = 'thread(s)' if self.use_threads else 'process(es)'
+                self.log_func(
+                    'Process Pool',
+                    f'Using {num_of_processes} {kind}: {reason}',
+                    LogLevel.INFO
+                )
+        self.num_of_processes = num_of_processes
 
     def create_certificates_from_list(
         self,
         lock: threading.Lock,
-        progress_var: ttk.IntVar,
+        progress_var: 'ttk.IntVar',
         user_list: list[User],
         cleanup_func: Callable[[], Any] | None = None
     ):
@@ -56,42 +216,225 @@ class CertificateCreator:
         Args:
             lock: A threading lock.
             progress_var: An IntVar that represents the amount of certificates done.
-                The IntVar is linked to a progressbar.
+                The IntVar is linked to a progressbar. Any object with the
+                same `get` and `set` methods can be used instead.
             user_list: The list of Users.
             cleanup_func: The cleanup func is optional and if given, will be run
                 at the end, after all the certificates have been created.
         """
 
-        func = partial(
+        self.failed = []
+        self.resolve_fallbacks(user_list)
+        if self.use_threads:
+            # Load the shared template once, before the threads use it.
+            self.image.load()
+            func = partial(_timed_call, self._encode_in_thread)
+        else:
+            func = partial(_timed_call, self.get_certificate_func(in_memory=True))
+
+        # Without a sink, the certificates are saved by the writer thread.
+        sink = self.sink
+        if sink is None:
+            sink = CertificateWriter(
+                self.output_folder,
+                error_func=self._write_failed,
+                saved_func=self.saved_func
+            )
+
+        # Bound the certificates that are being encoded or waiting for the
+        # sink, so a slow sink holds the pool back instead of piling up
+        # encoded certificates in memory.
+        chunksize = 15
+        in_flight = threading.Semaphore(self.num_of_processes * chunksize * 4)
+
+        stopped = threading.Event()
+
+        def throttled_user_list():
+            for user in user_list:
+                in_flight.acquire()
+                if stopped.is_set():
+                    return
+                yield user
+
+        if self.use_threads:
+            pool = ThreadPool(processes=self.num_of_processes)
+        else:
+            pool = mp.Pool(processes=self.num_of_processes)
+        results = pool.imap(
+            func,
+            throttled_user_list(),
+            chunksize=chunksize
+        )
+
+        completed = False
+        try:
+            for user, result, seconds, error in results:
+                if error is not None:
+                    self.log_func('Certificate Failed', f'{user[0]}. name: {user[1]} '
+                        f'| email: {user[2]} | {error}', LogLevel.ERROR)
+                    self._record(user, None, None, seconds, FAILED, error)
+                    self.failed.append(user)
+                else:
+                    _, data = result
+                    path = None
+                    if self.sink is None:
+                        path = self.output_folder / self.certificate_filename(user)
+                    # Recorded before it is handed over, so a failed
+                    # write can replace the record.
+                    self._record(user, path, len(data), seconds)
+                    sink.add(user, data)
+                in_flight.release()
+
+                with lock:
+                    progress_var.set(progress_var.get() + 1)
+                    if error is None:
+                        self.log(user)
+            completed = True
+        finally:
+            if completed:
+                pool.close()
+            else:
+                # The pool hands out the users from its own thread, which
+                # may be waiting for a slot. Free it so the pool can stop.
+                stopped.set()
+                in_flight.release(len(user_list))
+                pool.terminate()
+            pool.join()
+
+            # The certificates saved so far are kept, but a given sink
+            # is only closed once it got every certificate.
+            if completed or self.sink is None:
+                sink.close()
+
+        if self.catalogue is not None:
+            self.catalogue.commit()
+
+        if cleanup_func is not None:
+            sleep(0.5)
+            cleanup_func()
+
+    def get_certificate_func(
+        self,
+        in_memory: bool = False
+    ) -> Callable[[User], User | tuple[User, bytes]]:
+        """ Return `create_certificate` with every argument except the
+        user bound to the creator's settings. The returned func can be
+        pickled, so it can be mapped over a process pool.
+
+        Args:
+            in_memory: If true, return `encode_certificate` instead, that
+                returns the certificates instead of saving them.
+        """
+        if in_memory:
+            return partial(
+                self.encode_certificate,
+                self.image,
+                self.coords,
+                self.font,
+                self.fallbacks,
+                self.font_color,
+                self.anchor,
+                self.align,
+                self.compress_level
+            )
+
+        return partial(
             self.create_certificate,
             self.image,
             self.output_folder,
             self.coords,
             self.font,
+            self.fallbacks,
             self.font_color,
             self.anchor,
             self.align,
             self.compress_level
         )
 
-        pool = mp.Pool(processes=self.num_of_processes)
-        log_list = pool.imap(
-            func,
-            user_list,
-            chunksize=15
+    def _encode_in_thread(self, user: User) -> tuple[User, bytes]:
+        """ `encode_certificate` for thread pools. Shares the template
+        between threads, but uses a font per thread. """
+        fonts = getattr(self._thread_fonts, 'fonts', None)
+        if fonts is None:
+            variants = {}
+            for font in [self.font, *self.fallbacks.values()]:
+                if id(font) not in variants:
+                    variants[id(font)] = font.font_variant()
+            fonts = self._thread_fonts.fonts = (
+                variants[id(self.font)],
+                {char: variants[id(font)] for char, font in self.fallbacks.items()}
+            )
+
+        return self.encode_certificate(
+            self.image,
+            self.coords,
+            fonts[0],
+            fonts[1],
+            self.font_color,
+            self.anchor,
+            self.align,
+            self.compress_level,
+            user
         )
 
-        for log in log_list:
-            lock.acquire()
-            progress_var.set(progress_var.get() + 1)
-            self.log(log)
-            lock.release()
-        pool.close()
-        pool.join()
+    @staticmethod
+    def draw_certificate(
+        image: Image.Image,
+        coords: tuple[int, int],
+        font: ImageFont.FreeTypeFont,
+        fallbacks: dict[str, ImageFont.FreeTypeFont],
+        font_color: tuple[int, int, int],
+        anchor: str,
+        align: str,
+        user: User
+    ) -> Image.Image:
+        """ Return a copy of `image` with the `user`'s name drawn on it.
+        See `create_certificate` for the arguments. """
+        # NEED to have a temp copy of image, else the base template
+        # is going to get replaced!!
+        # Draw the message on the background
+        image_copy = image.copy()
+        draw = ImageDraw.Draw(image_copy)
+        name = user[1]
 
-        if cleanup_func is not None:
-            sleep(0.5)
-            cleanup_func()
+        if not fallbacks or not any(char in fallbacks for char in name):
+            draw.text(
+                coords,
+                name,
+                fill=font_color,
+                font=font,
+                anchor=anchor,
+                align=align
+            )
+            return image_copy
+
+        # Split the name in runs of characters that use the same font,
+        # and lay them out on the baseline of the anchor by hand.
+        runs: list[tuple[str, ImageFont.FreeTypeFont]] = []
+        for char in name:
+            char_font = fallbacks.get(char, font)
+            if runs and runs[-1][1] is char_font:
+                runs[-1] = (runs[-1][0] + char, char_font)
+            else:
+                runs.append((char, char_font))
+
+        width = sum(run_font.getlength(text) for text, run_font in runs)
+        x, y = coords
+        if anchor[0] == 'm':
+            x -= width / 2
+        elif anchor[0] == 'r':
+            x -= width
+
+        for text, run_font in runs:
+            draw.text(
+                (x, y),
+                text,
+                fill=font_color,
+                font=run_font,
+                anchor='l' + anchor[1]
+            )
+            x += run_font.getlength(text)
+        return image_copy
 
     @staticmethod
     def create_certificate(
@@ -99,6 +442,7 @@ class CertificateCreator:
         output_folder: Path,
         coords: tuple[int, int],
         font: ImageFont.FreeTypeFont,
+        fallbacks: dict[str, ImageFont.FreeTypeFont],
         font_color: tuple[int, int, int],
         anchor: str,
         align: str,
@@ -112,6 +456,8 @@ class CertificateCreator:
             image: The image draw on.
             coords: The image coords to start drawing on.
             font: The font to use.
+            fallbacks: The fallback font of each character that the `font`
+                lacks. Can be empty.
             font_color: The font color to use.
             anchor: The text anchor.
             align: The text alignment.
@@ -123,27 +469,114 @@ class CertificateCreator:
         Returns:
             The passed `user`. This is done for logging purposes.
         """
-        # NEED to have a temp copy of image, else the base template
-        # is going to get replaced!!
-        # Draw the message on the background
-        image_copy = image.copy()
-        draw = ImageDraw.Draw(image_copy)
-        draw.text(
-            coords,
-            user[1],
-            fill=font_color,
-            font=font,
-            anchor=anchor,
-            align=align
-        )
-        image_format = 'png'
+        image_copy = CertificateCreator.draw_certificate(
+            image, coords, font, fallbacks, font_color, anchor, align, user)
         # Save the edited image
-        name = user[1].replace(' ', '_')
-        image_name = f'{name}.{image_format}'
-        image_location = output_folder / image_name
+        image_location = output_folder / CertificateCreator.certificate_filename(user)
         image_copy.save(image_location, format='png', compress_level=compress_level)
         return user
 
+    @staticmethod
+    def encode_certificate(
+        image: Image.Image,
+        coords: tuple[int, int],
+        font: ImageFont.FreeTypeFont,
+        fallbacks: dict[str, ImageFont.FreeTypeFont],
+        font_color: tuple[int, int, int],
+        anchor: str,
+        align: str,
+        compress_level: int,
+        user: User
+    ) -> tuple[User, bytes]:
+        """ Creates a certificate in memory. See `create_certificate`
+        for the arguments.
+
+        Returns:
+            The passed `user` and the certificate encoded as a png.
+        """
+        image_copy = CertificateCreator.draw_certificate(
+            image, coords, font, fallbacks, font_color, anchor, align, user)
+        buffer = BytesIO()
+        image_copy.save(buffer, format='png', compress_level=compress_level)
+        return user, buffer.getvalue()
+
+    def resolve_fallbacks(self, user_list: list[User]) -> None:
+        """ Pick a fallback font for every character of the names in
+        `user_list` that the font lacks, and warn about the users whose
+        names have characters that no font covers. """
+        self.fallbacks = {}
+        self._thread_fonts = threading.local()
+        if self.font_fallback is None or not isinstance(self.font.path, (str, Path)):
+            return
+
+        chars = set().union(*(user[1] for user in user_list))
+        fallbacks, missing = self.font_fallback.resolve(chars, Path(self.font.path))
+
+        variants: dict[Path, ImageFont.FreeTypeFont] = {}
+        for char, path in fallbacks.items():
+            if path not in variants:
+                variants[path] = self.font.font_variant(font=str(path))
+            self.fallbacks[char] = variants[path]
+
+        if missing and self.log_func is not None:
+            for user in user_list:
+                if lacking := missing.intersection(user[1]):
+                    self.log_func('Missing Glyphs', f'{user[0]}. name: {user[1]} '
+                        f'| no font has: {" ".join(sorted(lacking))}', LogLevel.WARNING)
+
+    def _write_failed(self, user: User, error: str) -> None:
+        """ Called by the writer thread when a certificate couldn't be saved. """
+        self.log_func('Certificate Failed', f'{user[0]}. name: {user[1]} '
+            f'| email: {user[2]} | {error}', LogLevel.ERROR)
+        self._record(user, None, None, 0.0, FAILED, error)
+        self.failed.append(user)
+
+    def _hash_settings(self) -> str:
+        """ Return a hash of every input of the certificates except the user. """
+        settings = hashlib.sha256(self.image.tobytes())
+        settings.update(repr((
+            self.font.getname(),
+            self.font.size,
+            self.font_color,
+            self.coords,
+            self.anchor,
+            self.align
+        )).encode('utf-8'))
+        return settings.hexdigest()
+
+    def input_hash(self, user: User) -> str:
+        """ Return a hash of every input of the `user`'s certificate. """
+        return hashlib.sha256(
+            f'{self.settings_hash}:{user[1]}'.encode('utf-8')
+        ).hexdigest()
+
+    def _record(
+        self,
+        user: User,
+        path: Path | None,
+        size: int | None,
+        seconds: float,
+        status: str = CREATED,
+        error: str | None = None
+    ) -> None:
+        """ Record the certificate in the catalogue, if there is one. """
+        if self.catalogue is not None:
+            self.catalogue.record(
+                user,
+                self.input_hash(user),
+                path,
+                size,
+                seconds,
+                status,
+                error
+            )
+
+    @staticmethod
+    def certificate_filename(user: User) -> str:
+        """ Return the filename of the `user`'s certificate. """
+        name = user[1].replace(' ', '_')
+        return f'{name}.png'
+
     def log(self, entry_info):
         self.log_func('Created Certificate', '{}. name: {} | email: {}'
             .format(entry_info[0], entry_info[1], entry_info[2]), LogLevel.WARNING)
@@ -1,5 +1,5 @@
 from pathlib import Path
-from widgets.constants import *
+from services.constants import *
 import pandas as pd
 import unicodedata
 
@@ -0,0 +1,100 @@
+""" Gmail API discovery document, cached on disk.
+
+Building the Gmail service needs the API's discovery document. Instead of
+downloading it every time a sender is created, it's kept in a cache file
+and only downloaded again once it's older than the TTL. If it can't be
+downloaded, the stale cache or the document bundled with
+googleapiclient is used, so creating a sender works offline.
+"""
+import json
+import os
+import time
+from pathlib import Path
+
+import httplib2
+from googleapiclient.discovery import V2_DISCOVERY_URI
+from googleapiclient.discovery_cache import get_static_doc
+
+
+
+DISCOVERY_TTL = 24 * 60 * 60
+DOWNLOAD_TIMEOUT = 10
+
+
+def _read(path: Path) -> str | None:
+    try:
+        document = path.read_text(encoding='UTF-8')
+        json.loads(document)
+        return document
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path: Path, document: str) -> None:
+    # Written to a temporary file first, so a concurrent
+    # reader never sees half a document.
+    temp_path = path.with_suffix('.tmp')
+    try:
+        temp_path.write_text(document, encoding='UTF-8')
+        os.replace(temp_path, path)
+    except OSError:
+        # The cache is only an optimization.
+        pass
+
+
+def _download(api_name: str, api_version: str) -> str:
+    uri = V2_DISCOVERY_URI.format(api=api_name, apiVersion=api_version)
+    response, content = httplib2.Http(timeout=DOWNLOAD_TIMEOUT).request(uri)
+    if response.status != 200:
+        raise httplib2.HttpLib2Error(
+            f'Discovery document download failed with status {response.status}')
+    document = content.decode('utf-8')
+    json.loads(document)
+    return document
+
+
+def discovery_document(
+    api_name: str,
+    api_version: str,
+    cache_path: Path | None = None,
+    ttl: float = DISCOVERY_TTL
+) -> str:
+    """ Return the discovery document of the API.
+
+    Args:
+        api_name: The name of the API, ex. gmail.
+        api_version: The version of the API, ex. v1.
+        cache_path: The file the document is cached in. If None, the
+            document bundled with googleapiclient is used.
+        ttl: The seconds after which the cached document is downloaded again.
+
+    Raises:
+        FileNotFoundError: There is no cached or bundled document, and it
+            couldn't be downloaded.
+    """
+    if cache_path is not None:
+        try:
+            age = time.time() - cache_path.stat().st_mtime
+        except OSError:
+            age = None
+
+        if age is not None and age < ttl \
+                and (document := _read(cache_path)) is not None:
+            return document
+
+        try:
+            document = _download(api_name, api_version)
+        except (httplib2.HttpLib2Error, OSError, ValueError):
+            # Try again after the TTL, instead of on every call
+            # while the network is down.
+            document = _read(cache_path) or get_static_doc(api_name, api_version)
+
+        if document is not None:
+            _write(cache_path, document)
+            return document
+
+    document = get_static_doc(api_name, api_version)
+    if document is None:
+        raise FileNotFoundError(
+            f'No discovery document for the {api_name}-{api_version} API.')
+    return document
@@ -0,0 +1,524 @@
+""" Distributed certificate creation.
+
+A `RenderCoordinator` shards the userlist into chunks and hands them out
+to workers that connect to it over a tcp or unix socket. Workers, started
+with `run_worker`, create the certificates of each chunk with their own
+process pool and acknowledge every certificate as soon as it is done, so
+when a worker dies or stops responding, only the unacknowledged users of
+its chunk are handed out again.
+
+Messages are pickled, so the coordinator and the workers authenticate each
+other with a shared `authkey`. Only run them on networks you trust.
+"""
+import io
+import multiprocessing as mp
+import os
+import queue
+import socket
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Connection, Listener
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable
+
+from PIL import ImageFont
+
+from services.catalogue import CertificateCatalogue
+from services.certificate_creation import CertificateCreator
+from services.constants import *
+from services.font_fallback import FontFallback
+from services.progress import SilentProgress
+
+
+
+Address = tuple[str, int] | str
+RenderSettings = dict[str, Any]
+
+
+def parse_address(value: str) -> Address:
+    """ Convert `host:port` to a tcp address. Anything else is
+    treated as the path of a unix socket. """
+    host, _, port = value.rpartition(':')
+    if host and port.isdigit():
+        return (host, int(port))
+    return value
+
+
+def needed_fallback_fonts(
+    font_fallback: FontFallback,
+    font_path: Path,
+    user_list: list[User]
+) -> list[Path]:
+    """ Return the fallback fonts of the characters of the names in
+    `user_list` that the font lacks. """
+    chars = set().union(*(user[1] for user in user_list))
+    fallbacks, _ = font_fallback.resolve(chars, Path(font_path))
+    return sorted(set(fallbacks.values()))
+
+
+def make_render_settings(
+    template_path: Path,
+    font_path: Path,
+    font_size: int,
+    font_color: RGB | Hex,
+    coords: tuple[int, int],
+    word_position: str,
+    compress_level: int,
+    fallback_fonts: list[Path] | None = None
+) -> RenderSettings:
+    """ Bundle everything a worker needs to create certificates. The
+    template and the fonts are sent by content, so workers on other
+    hosts don't need a copy of them.
+
+    Args:
+        fallback_fonts: The fonts of the characters the font lacks, see
+            `needed_fallback_fonts`. If None, the workers draw every
+            character with the font.
+    """
+    return {
+        'template': Path(template_path).read_bytes(),
+        'font': Path(font_path).read_bytes(),
+        'font_size': font_size,
+        'font_color': font_color,
+        'coords': coords,
+        'word_position': word_position,
+        'compress_level': compress_level,
+        'fallback_fonts': None if fallback_fonts is None else {
+            Path(path).name: Path(path).read_bytes() for path in fallback_fonts
+        },
+        'send_results': False
+    }
+
+
+def creator_from_settings(
+    settings: RenderSettings,
+    output_folder: Path,
+    font_path: Path,
+    log_func: Callable[..., Any] | None = None,
+    num_of_processes: int | None = None,
+    catalogue: CertificateCatalogue | None = None
+) -> CertificateCreator:
+    """ Create a `CertificateCreator` from the coordinator's settings.
+
+    The font is written to `font_path` first, and the fallback fonts to
+    a folder next to it. Fonts loaded from memory can't be pickled to the
+    process pool, since only their path is.
+    """
+    font_path.write_bytes(settings['font'])
+    font = ImageFont.truetype(str(font_path), settings['font_size'])
+
+    font_fallback = None
+    if settings['fallback_fonts'] is not None:
+        fallback_folder = font_path.parent / 'fallback'
+        fallback_folder.mkdir(exist_ok=True)
+        for filename, data in settings['fallback_fonts'].items():
+            (fallback_folder / filename).write_bytes(data)
+        font_fallback = FontFallback(fallback_folder, fallback_folder / 'coverage.json')
+
+    return CertificateCreator(
+        image_path=io.BytesIO(settings['template']),
+        output_folder=output_folder,
+        font=font,
+        font_color=settings['font_color'],
+        image_coords=settings['coords'],
+        word_position=settings['word_position'],
+        compress_level=settings['compress_level'],
+        log_func=log_func,
+        num_of_processes=num_of_processes,
+        catalogue=catalogue,
+        font_fallback=font_fallback
+    )
+
+
+class RenderCoordinator:
+    """ Hands out chunks of the userlist to connected workers.
+
+    Args:
+        address: The address to listen on. Use port 0 to pick a free port.
+        authkey: The key shared with the workers.
+        settings: The render settings, see `make_render_settings`.
+        user_list: The list of Users.
+        chunk_size: The number of users in a chunk.
+        timeout: Seconds a worker can stay silent while it has a chunk,
+            before it is considered dead.
+        worker_timeout: Seconds the coordinator waits without any connected
+            worker, before the users left are reported as failed. None to
+            wait for workers forever.
+        max_attempts: How many times a chunk is handed out before
+            its users are reported as failed.
+        output_folder: If given, workers send every certificate back and
+            the coordinator saves it in this folder. Otherwise certificates
+            are saved in the workers' output folders.
+        log_func: Log func with the signature of `Logger.log`.
+    """
+    def __init__(
+        self,
+        address: Address,
+        authkey: bytes,
+        settings: RenderSettings,
+        user_list: list[User],
+        chunk_size: int = 50,
+        timeout: float = 120.0,
+        worker_timeout: float | None = 600.0,
+        max_attempts: int = 3,
+        output_folder: Path | None = None,
+        log_func: Callable[..., Any] | None = None
+    ) -> None:
+        self.settings = dict(settings, send_results=output_folder is not None)
+        self.authkey = authkey
+        self.timeout = timeout
+        self.worker_timeout = worker_timeout
+        self.max_attempts = max_attempts
+        self.output_folder = output_folder
+        self.log_func = log_func
+        self.progress_func: Callable[[User, str], Any] | None = None
+
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._pending: queue.Queue[int] = queue.Queue()
+        # Users of each chunk that haven't been acknowledged yet.
+        self._remaining: dict[int, dict[str, User]] = {}
+        self._attempts: dict[int, int] = {}
+        # Raised by `wait`, ex. when the progress func failed.
+        self._error: BaseException | None = None
+        self._workers = 0
+        # When the last worker disconnected, or the coordinator started.
+        self._idle_since = time.monotonic()
+        self.failed: list[User] = []
+
+        for chunk_id, start in enumerate(range(0, len(user_list), chunk_size)):
+            chunk = user_list[start:start + chunk_size]
+            self._remaining[chunk_id] = {user[0]: user for user in chunk}
+            self._attempts[chunk_id] = 0
+            self._pending.put(chunk_id)
+
+        if not self._remaining:
+            self._done.set()
+
+        self._listener = Listener(address, authkey=authkey)
+
+    @property
+    def address(self) -> Address:
+        """ The address the coordinator listens on. """
+        return self._listener.address
+
+    def start(
+        self,
+        progress_func: Callable[[User, str], Any] | None = None
+    ) -> None:
+        """ Start accepting workers in the background.
+
+        Args:
+            progress_func: Called with the user and the worker's name
+                for every certificate that is done.
+        """
+        self.progress_func = progress_func
+        self._idle_since = time.monotonic()
+        threading.Thread(target=self._accept_workers, daemon=True).start()
+        if self.worker_timeout is not None:
+            threading.Thread(target=self._watch_workers, daemon=True).start()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """ Block until every chunk is done. Returns false on timeout.
+        Raises the error that stopped the run early, if any. """
+        finished = self._done.wait(timeout)
+        if finished:
+            self._listener.close()
+        if self._error is not None:
+            raise self._error
+        return finished
+
+    def run(
+        self,
+        progress_func: Callable[[User, str], Any] | None = None
+    ) -> list[User]:
+        """ Start the coordinator and block until every chunk is done.
+
+        Returns:
+            The users whose certificates couldn't be created.
+        """
+        self.start(progress_func)
+        self.wait()
+        return self.failed
+
+    def _log(self, title: str, message: str, level: LogLevel) -> None:
+        if self.log_func is not None:
+            self.log_func(title, message, level)
+
+    def _accept_workers(self) -> None:
+        while not self._done.is_set():
+            try:
+                conn = self._listener.accept()
+            except mp.AuthenticationError:
+                self._log('Worker Rejected', 'wrong authkey', LogLevel.ERROR)
+                continue
+            except OSError:
+                # The listener is closed when all the chunks are done.
+                return
+            threading.Thread(
+                target=self._serve_worker,
+                args=(conn,),
+                daemon=True
+            ).start()
+
+    def _watch_workers(self) -> None:
+        """ Fail the users left once no worker has been connected for
+        `worker_timeout` seconds, ex. because all of them died. """
+        while not self._done.wait(1.0):
+            with self._lock:
+                if self._workers or \
+                        time.monotonic() - self._idle_since < self.worker_timeout:
+                    continue
+                for remaining in self._remaining.values():
+                    self.failed.extend(remaining.values())
+                self._remaining.clear()
+
+            self._log(
+                'No Workers',
+                f'no worker connected for {self.worker_timeout:g} seconds',
+                LogLevel.ERROR
+            )
+            self._done.set()
+            return
+
+    def _serve_worker(self, conn: Connection) -> None:
+        with self._lock:
+            self._workers += 1
+        try:
+            self._serve(conn)
+        except BaseException as error:
+            self._stop(error)
+            conn.close()
+        finally:
+            with self._lock:
+                self._workers -= 1
+                if not self._workers:
+                    self._idle_since = time.monotonic()
+
+    def _serve(self, conn: Connection) -> None:
+        try:
+            _, name = conn.recv()
+            conn.send(('settings', self.settings))
+        except (EOFError, OSError):
+            conn.close()
+            return
+
+        self._log('Worker Connected', name, LogLevel.INFO)
+
+        while not self._done.is_set():
+            try:
+                chunk_id = self._pending.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            with self._lock:
+                users = list(self._remaining.get(chunk_id, {}).values())
+                self._attempts[chunk_id] += 1
+            if not users:
+                continue
+
+            try:
+                conn.send(('chunk', chunk_id, users))
+                self._receive_chunk(conn, chunk_id, name)
+            except (EOFError, OSError, TimeoutError) as error:
+                self._log(
+                    'Worker Lost',
+                    f'{name}: {str(error) or type(error).__name__}',
+                    LogLevel.ERROR
+                )
+                self._requeue(chunk_id)
+                conn.close()
+                return
+            except RuntimeError as error:
+                self._log('Chunk Failed', f'{name}: {error}', LogLevel.ERROR)
+                self._requeue(chunk_id)
+
+        try:
+            conn.send(('stop',))
+        except OSError:
+            pass
+        conn.close()
+
+    def _receive_chunk(self, conn: Connection, chunk_id: int, name: str) -> None:
+        """ Receive acknowledgements until the worker is done with the chunk. """
+        while True:
+            if not conn.poll(self.timeout):
+                raise TimeoutError(f'no response for {self.timeout} seconds')
+
+            message = conn.recv()
+            if message[0] == 'certificate':
+                _, _, user, filename, data = message
+                if data is not None:
+                    (self.output_folder / filename).write_bytes(data)
+                self._complete(chunk_id, user, name)
+            elif message[0] == 'chunk_done':
+                self._requeue(chunk_id)
+                return
+            elif message[0] == 'error':
+                raise RuntimeError(message[2])
+
+    def _complete(self, chunk_id: int, user: User, name: str) -> None:
+        with self._lock:
+            remaining = self._remaining.get(chunk_id)
+            if remaining is None or remaining.pop(user[0], None) is None:
+                # Already acknowledged by a worker that was presumed dead.
+                return
+            self._finish_chunk_if_empty(chunk_id)
+
+        if self.progress_func is not None:
+            try:
+                self.progress_func(user, name)
+            except BaseException as error:
+                self._stop(error)
+
+    def _stop(self, error: BaseException) -> None:
+        """ Stop the run with an error that isn't the worker's fault,
+        ex. the log or the progress func failed, instead of handing out
+        its chunk again. """
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._done.set()
+
+    def _requeue(self, chunk_id: int) -> None:
+        """ Hand out the unacknowledged users of the chunk again. """
+        with self._lock:
+            remaining = self._remaining.get(chunk_id)
+            if not remaining:
+                return
+
+            if self._attempts[chunk_id] >= self.max_attempts:
+                self.failed.extend(remaining.values())
+                remaining.clear()
+                self._finish_chunk_if_empty(chunk_id)
+                return
+
+        self._pending.put(chunk_id)
+
+    def _finish_chunk_if_empty(self, chunk_id: int) -> None:
+        """ Must be called while holding the lock. """
+        if not self._remaining[chunk_id]:
+            del self._remaining[chunk_id]
+            if not self._remaining:
+                self._done.set()
+
+
+def run_worker(
+    address: Address,
+    authkey: bytes,
+    output_folder: Path,
+    num_of_processes: int | None = None,
+    name: str | None = None,
+    log_func: Callable[..., Any] | None = None,
+    catalogue_path: Path | None = None
+) -> int:
+    """ Connect to a coordinator and create certificates until it runs
+    out of chunks.
+
+    Args:
+        address: The coordinator's address.
+        authkey: The key shared with the coordinator.
+        output_folder: The folder to save the certificates in.
+        num_of_processes: The size of the worker's process pool. If None,
+            it is sized by the worker's available cpus and memory.
+        name: The name the coordinator logs the worker with.
+        log_func: Log func with the signature of `Logger.log`.
+        catalogue_path: The sqlite catalogue to record the certificates in,
+            catalogue.sqlite in the output folder by default.
+
+    Returns:
+        The number of certificates created.
+    """
+    if name is None:
+        name = f'{socket.gethostname()}-{os.getpid()}'
+    if log_func is None:
+        log_func = lambda *_: None
+
+    conn = Client(address, authkey=authkey)
+    conn.send(('hello', name))
+    _, settings = conn.recv()
+
+    output_folder.mkdir(parents=True, exist_ok=True)
+    # Local workers share the catalogue, so none of them keeps
+    # it locked with uncommitted certificates.
+    catalogue = CertificateCatalogue(
+        catalogue_path or output_folder / 'catalogue.sqlite', commit_every=1)
+    created = 0
+    # Set by the writer thread if a certificate couldn't be acknowledged.
+    lost = threading.Event()
+
+    def acknowledge(chunk_id: int, user: User, path: Path) -> None:
+        nonlocal created
+        if lost.is_set():
+            return
+        data = path.read_bytes() if settings['send_results'] else None
+        try:
+            conn.send(('certificate', chunk_id, user, path.name, data))
+        except OSError:
+            lost.set()
+            return
+        created += 1
+
+    try:
+        with tempfile.TemporaryDirectory() as temp_folder:
+            creator = creator_from_settings(
+                settings,
+                output_folder,
+                Path(temp_folder) / 'font.ttf',
+                log_func,
+                num_of_processes,
+                catalogue
+            )
+
+            while not lost.is_set():
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    break
+
+                if message[0] == 'stop':
+                    break
+
+                # The same creation as a local run, with the font fallback
+                # and the catalogue. Certificates that failed aren't
+                # acknowledged, so the coordinator hands them out again.
+                _, chunk_id, users = message
+                creator.saved_func = partial(acknowledge, chunk_id)
+                try:
+                    creator.create_certificates_from_list(
+                        threading.Lock(), SilentProgress(), users)
+                    if not lost.is_set():
+                        conn.send(('chunk_done', chunk_id))
+                except (EOFError, OSError):
+                    break
+                except Exception as error:
+                    conn.send(('error', chunk_id, str(error)))
+    finally:
+        catalogue.close()
+        conn.close()
+
+    return created
+
+
+def start_local_workers(
+    address: Address,
+    authkey: bytes,
+    output_folder: Path,
+    num_of_workers: int,
+    num_of_processes: int = 1,
+    catalogue_path: Path | None = None
+) -> list[mp.Process]:
+    """ Start `num_of_workers` worker processes on this machine. """
+    workers = []
+    for index in range(num_of_workers):
+        worker = mp.Process(
+            target=run_worker,
+            args=(address, authkey, output_folder, num_of_processes),
+            kwargs={'name': f'local-{index}', 'catalogue_path': catalogue_path},
+            daemon=False
+        )
+        worker.start()
+        workers.append(worker)
+    return workers
@@ -0,0 +1,509 @@
+""" Emailing each user their certificate. """
+import os
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from email.mime.base import MIMEBase
+from pathlib import Path
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator
+
+from services.attachment_budget import AttachmentBudget
+from services.campaign_metrics import CampaignMetrics
+from services.constants import *
+from services.email_transport import EmailTransport
+from services.merge_template import MergeTemplate, user_values
+from services.outbox import SENDING, SENT, EmailOutbox, campaign_id, message_key
+from services.rate_limiting import TokenBucket
+from services.retrying import RetryPolicy
+
+if TYPE_CHECKING:
+    import ttkbootstrap as ttk
+
+Job = list[tuple[User, dict[str, str]]]
+
+
+
+class _JobQueue:
+    """ Submits send jobs to the executor and resubmits the jobs the
+    send function returns for a retry, once their backoff has passed.
+    Waiting jobs are held by timers, not by sending threads, so a retry
+    never blocks other sends.
+
+    Args:
+        executor: The executor of the sending threads.
+        send: Called with a job and its attempt, returns the messages
+            of the job to retry and the seconds to wait before that.
+    """
+    def __init__(
+        self,
+        executor: ThreadPoolExecutor,
+        send: Callable[[Job, int], tuple[Job, float]]
+    ) -> None:
+        self._executor = executor
+        self._send = send
+        # Jobs that are being sent or waiting for a retry.
+        self._pending = 0
+        self._condition = threading.Condition()
+
+    def submit(self, job: Job, attempt: int = 1, delay: float = 0) -> Future | None:
+        """ Send the `job` after `delay` seconds. Returns the future
+        of the send, or None if it's delayed. """
+        with self._condition:
+            self._pending += 1
+
+        if delay > 0:
+            timer = threading.Timer(delay, self._submit, (job, attempt))
+            timer.daemon = True
+            timer.start()
+            return None
+        return self._submit(job, attempt)
+
+    def _submit(self, job: Job, attempt: int) -> Future:
+        return self._executor.submit(self._run, job, attempt)
+
+    def _run(self, job: Job, attempt: int) -> None:
+        try:
+            retry, delay = self._send(job, attempt)
+            if retry:
+                self.submit(retry, attempt + 1, delay)
+        finally:
+            with self._condition:
+                self._pending -= 1
+                self._condition.notify_all()
+
+    def join(self) -> None:
+        """ Block until every job, including its retries, is done. """
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending == 0)
+
+
+class EmailCampaign:
+    """ Sends every user an email with their certificate attached.
+
+    Messages are sent from `concurrency` threads. Every send call takes
+    its quota units from the `rate_limiter` first, so the throughput is
+    limited by the quota of the backend, ex. Gmail's, instead of the
+    latency of each request, without the backend answering with 429s.
+
+    Args:
+        email_sender: The transport to send the messages with, ex. an
+            EmailSender for the Gmail API or an SmtpTransport.
+        sender: The email address the messages are sent from.
+        subject: The subject line of the emails. Can contain merge fields,
+            ex. {name}, that are replaced with each user's values.
+        body: The HTML body of the emails. Can contain merge fields, their
+            values are escaped for HTML.
+        attachments: The file paths of the attachments shared by every email.
+        concurrency: The number of threads that send messages.
+        batch_size: The number of messages per request. If greater than 1,
+            messages are sent in batch requests.
+        rate_limiter: A token bucket of the transport's quota units.
+            Defaults to the transport's own rate limiter, if it has one.
+        retry_policy: Decides which failed sends are retried and when.
+            Transient failures are put back in the queue, permanent ones
+            are reported right away.
+        outbox: If given, the state of every message is recorded in it,
+            and sending the campaign again only sends the messages that
+            weren't sent yet.
+        resend_interrupted: Whether to send again the messages whose send
+            was interrupted, ex. by a crash. Those may have been delivered,
+            so by default they are reported as failed instead.
+        metrics_folder: If given, the metrics of every run of the campaign
+            are saved in it as json.
+        attachment_budget: If given, the maximum size of the attachments
+            of an email. Certificates that would go over it are replaced
+            by smaller variants.
+        log_func: Log func with the signature of `Logger.log`, for the
+            retries and the failed emails.
+
+    Attributes:
+        metrics (CampaignMetrics): The delivery metrics of the current, or
+            last, run. Can be read while the campaign runs.
+        failed (dict[str, Exception]): The index of each user whose email
+            failed in the last run, and the error.
+    """
+    def __init__(
+        self,
+        email_sender: EmailTransport,
+        sender: str,
+        subject: str,
+        body: str,
+        attachments: list[str],
+        concurrency: int = 4,
+        batch_size: int = 1,
+        rate_limiter: TokenBucket | None = None,
+        retry_policy: RetryPolicy | None = None,
+        outbox: EmailOutbox | None = None,
+        resend_interrupted: bool = False,
+        metrics_folder: Path | None = None,
+        attachment_budget: AttachmentBudget | None = None,
+        log_func: Callable[..., Any] | None = None
+    ) -> None:
+        self.email_sender = email_sender
+        self.sender = sender
+        self.subject = subject
+        self.body = body
+        self.subject_template = MergeTemplate(subject, escape=False)
+        self.body_template = MergeTemplate(body)
+        self.attachments = attachments
+        self.concurrency = max(1, concurrency)
+        self.batch_size = max(1, min(batch_size, email_sender.BATCH_LIMIT))
+        self.rate_limiter = rate_limiter or email_sender.rate_limiter()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.outbox = outbox
+        self.resend_interrupted = resend_interrupted
+        self.campaign_id = campaign_id(sender, subject, body, attachments)
+        self.metrics_folder = metrics_folder
+        self.metrics = CampaignMetrics(self.campaign_id)
+        self.failed: dict[str, Exception] = {}
+        self.attachment_budget = attachment_budget
+        self.log_func = log_func
+
+    def send_certificates(
+        self,
+        progress_var: 'ttk.IntVar',
+        log: Callable[[bool, int], Any],
+        userlist: list[User],
+        certificate_paths: list[Path],
+        cleanup_func: Callable[[], Any] | None = None,
+        metrics: CampaignMetrics | None = None
+    ) -> None:
+        """ Sends each user in the `userlist` their certificate.
+
+        Args:
+            progress_var: An IntVar that represents the amount of emails sent.
+                Any object with the same `get` and `set` methods can be used.
+            log: Called with whether the email was sent and the user's index.
+            userlist: The list of Users.
+            certificate_paths: The certificate of each user.
+            cleanup_func: If given, run after all the emails have been sent.
+            metrics: See `send_entries`.
+        """
+
+        self.enqueue(userlist)
+        self.send_entries(
+            progress_var,
+            log,
+            zip(userlist, certificate_paths),
+            cleanup_func,
+            metrics=metrics
+        )
+
+    def send_entries(
+        self,
+        progress_var: 'ttk.IntVar',
+        log: Callable[[bool, int], Any],
+        entries: Iterable[tuple[User, Path | None]],
+        cleanup_func: Callable[[], Any] | None = None,
+        lock: 'threading.Lock | None' = None,
+        metrics: CampaignMetrics | None = None
+    ) -> None:
+        """ Sends each user their certificate, as the entries come in.
+        `entries` can be a generator that blocks until the next certificate
+        is ready, ex. while it's being created.
+
+        Args:
+            progress_var: An IntVar that represents the amount of emails sent.
+                Any object with the same `get` and `set` methods can be used.
+            log: Called with whether the email was sent and the user's index.
+            entries: Each user and the path of their certificate. The path
+                can be None if the user's email was already sent.
+            cleanup_func: If given, run after all the emails have been sent.
+            lock: The lock of the `progress_var`, if it's shared.
+            metrics: The metrics to record the run in, ex. shared by the
+                shards of a campaign. Their owner finishes and saves them.
+                By default the run has its own metrics.
+        """
+
+        self.metrics = metrics or CampaignMetrics(self.campaign_id)
+        self.failed = {}
+        lock = lock or threading.Lock()
+        report = partial(self._report, lock, progress_var, log)
+        entries = self._unsent(entries, report)
+
+        # The shared attachments are read and encoded once, every
+        # message only adds its user's certificate to them.
+        shared_parts = [
+            self.email_sender.encode_attachment(attachment)
+            for attachment in self.attachments
+        ]
+
+        # The shared attachments take their part of every email's budget.
+        budget = self.attachment_budget
+        if budget is not None:
+            budget = budget.minus(sum(map(os.path.getsize, self.attachments)))
+            if budget.max_bytes <= 0:
+                # No variant could fit, so shrinking every certificate
+                # would only make them worse.
+                self._log(
+                    'Attachment Budget',
+                    'The shared attachments use up the whole budget, '
+                    'the certificates are sent as they are.',
+                    LogLevel.WARNING
+                )
+                budget = None
+
+        build = partial(
+            EmailCampaign.create_message,
+            self.sender,
+            self.subject_template,
+            self.body_template,
+            shared_parts,
+            self.email_sender.create_message,
+            budget
+        )
+
+        # The messages are built by a thread of their own, ahead of the
+        # sending. The queue is bounded, so the built messages don't pile
+        # up in memory when sending is slow.
+        built: queue.Queue[tuple[User, Any, float] | BaseException | None] = \
+            queue.Queue(self.concurrency * self.batch_size)
+        stop = threading.Event()
+        producer = threading.Thread(
+            target=self._build_messages,
+            args=(build, entries, built, stop),
+            daemon=True
+        )
+        producer.start()
+
+        # Bound the jobs waiting for a thread too.
+        in_flight = threading.BoundedSemaphore(self.concurrency * 2)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                job_queue = _JobQueue(executor, partial(self._send_job, report=report))
+                for job in self._jobs(self._built(built)):
+                    in_flight.acquire()
+                    future = job_queue.submit(job)
+                    future.add_done_callback(lambda _: in_flight.release())
+                job_queue.join()
+        except BaseException:
+            # Unblock the producer, so it sees it's stopped.
+            stop.set()
+            while not built.empty():
+                built.get_nowait()
+            raise
+        producer.join()
+
+        if metrics is None:
+            self.metrics.finish()
+            if self.metrics_folder is not None:
+                self.metrics.save(self.metrics_folder)
+
+        if cleanup_func:
+            cleanup_func()
+
+    def _unsent(
+        self,
+        entries: Iterable[tuple[User, Path]],
+        report: Callable[[str, Exception | None], None]
+    ) -> Iterator[tuple[User, Path]]:
+        """ Yield the entries whose email wasn't sent yet, and report
+        the rest. Each user is only emailed once per campaign. """
+        statuses = {}
+        if self.outbox is not None:
+            statuses = self.outbox.statuses(self.campaign_id)
+
+        for user, path in entries:
+            status = statuses.get(message_key(user))
+            if status == SENT:
+                self.metrics.record_skipped()
+                report(user[0], None)
+            elif status == SENDING and not self.resend_interrupted:
+                report(user[0], RuntimeError(
+                    f'The email to {user[2]} was interrupted while sending '
+                    'and may have been delivered, so it wasn\'t sent again.'
+                ))
+            else:
+                if status is None and self.outbox is not None:
+                    self.outbox.enqueue(self.campaign_id, [user])
+                yield user, path
+
+    def enqueue(self, userlist: list[User]) -> None:
+        """ Queue the users in the outbox, if there is one. """
+        if self.outbox is not None:
+            self.outbox.enqueue(self.campaign_id, userlist)
+
+    def sent_keys(self) -> set[tuple[str, str]]:
+        """ Return the `message_key` of the users the campaign was already
+        sent to, according to the outbox. """
+        if self.outbox is None:
+            return set()
+        return {
+            key for key, status in
+            self.outbox.statuses(self.campaign_id).items()
+            if status == SENT
+        }
+
+    def interrupted(self) -> int:
+        """ Return the number of messages whose send was interrupted,
+        ex. by a crash, according to the outbox. """
+        if self.outbox is None:
+            return 0
+        return self.outbox.counts(self.campaign_id).get(SENDING, 0)
+
+    @staticmethod
+    def _build_messages(
+        build: Callable[[tuple[User, Path]], tuple[User, Any, float]],
+        entries: Iterable[tuple[User, Path]],
+        built: queue.Queue,
+        stop: threading.Event
+    ) -> None:
+        """ Build the message of each entry and put it in `built`, then
+        put None. If building fails, the error is put instead. """
+        try:
+            for entry in entries:
+                if stop.is_set():
+                    return
+                built.put(build(entry))
+        except BaseException as error:
+            built.put(error)
+            return
+        built.put(None)
+
+    @staticmethod
+    def _built(built: queue.Queue) -> Iterator[tuple[User, Any, float]]:
+        """ Yield the built messages until the last one, raising
+        the error of the producer if it failed. """
+        while (item := built.get()) is not None:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def _jobs(self, message_list):
+        """ Group the messages in jobs of up to `batch_size` messages. """
+        job = []
+        for user, message, seconds in message_list:
+            self.metrics.record_build(user[0], seconds)
+            job.append((user, message))
+            if len(job) == self.batch_size:
+                yield job
+                job = []
+        if job:
+            yield job
+
+    def _send_job(
+        self,
+        job: Job,
+        attempt: int,
+        report: Callable[[str, Exception | None], None]
+    ) -> tuple[Job, float]:
+        """ Send the messages of the `job` and report the ones that were
+        sent or failed for good.
+
+        Returns:
+            The messages to retry and the seconds to wait before that.
+        """
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(self.email_sender.SEND_COST * len(job))
+        if self.outbox is not None:
+            self.outbox.mark_sending(self.campaign_id, [user for user, _ in job])
+
+        start = perf_counter()
+        if len(job) == 1:
+            try:
+                results = [(self.email_sender.send_message(job[0][1]), None)]
+            except Exception as error:
+                results = [(None, error)]
+        else:
+            try:
+                results = self.email_sender.send_message_batch(
+                    [message for _, message in job],
+                    batch_size=len(job)
+                )
+            except Exception as error:
+                results = [(None, error)] * len(job)
+        latency = perf_counter() - start
+
+        retry, delay = [], 0.0
+        for (user, message), (response, error) in zip(job, results):
+            retried = error is not None and self.retry_policy.should_retry(error, attempt)
+            self.metrics.record_attempt(
+                user[0],
+                latency,
+                self.email_sender.payload_size(message),
+                attempt,
+                error,
+                retried
+            )
+            if retried:
+                retry.append((user, message))
+                delay = max(delay, self.retry_policy.delay(error, attempt))
+                self._record(user, response, error, retried=True)
+            else:
+                self._record(user, response, error)
+                report(user[0], error)
+
+        if retry:
+            self._log(
+                'Retrying Emails',
+                f'{len(retry)} email(s) in {delay:.1f}s '
+                f'(attempt {attempt + 1}/{self.retry_policy.max_attempts})',
+                LogLevel.WARNING
+            )
+        return retry, delay
+
+    def _record(
+        self,
+        user: User,
+        response: dict[str, str] | None,
+        error: Exception | None,
+        retried: bool = False
+    ) -> None:
+        """ Record the result of a send in the outbox. """
+        if self.outbox is None:
+            return
+        if error is None:
+            self.outbox.mark_sent(self.campaign_id, user, (response or {}).get('id'))
+        elif retried:
+            self.outbox.mark_queued(self.campaign_id, user, str(error))
+        else:
+            self.outbox.mark_failed(self.campaign_id, user, str(error))
+
+    def _report(
+        self,
+        lock: threading.Lock,
+        progress_var: 'ttk.IntVar',
+        log: Callable[[bool, int], Any],
+        index: str,
+        error: Exception | None
+    ) -> None:
+        with lock:
+            if error is not None:
+                self.failed[index] = error
+                self._log('Email Failed', f'index: {index} | {error}', LogLevel.ERROR)
+            log(error is None, int(index))
+            progress_var.set(progress_var.get() + 1)
+
+    def _log(self, title: str, message: str, level: LogLevel) -> None:
+        if self.log_func is not None:
+            self.log_func(title, message, level)
+
+    @staticmethod
+    def create_message(
+        sender: str,
+        subject: MergeTemplate,
+        body: MergeTemplate,
+        shared_parts: list[MIMEBase],
+        create_message,
+        attachment_budget: AttachmentBudget | None,
+        entry: tuple[User, Path]
+    ) -> tuple[User, dict[str, str], float]:
+        """ Return the user, their message and the seconds it took to build. """
+        start = perf_counter()
+        user, certificate_path = entry
+        values = user_values(user)
+
+        if attachment_budget is not None:
+            certificate_path = attachment_budget.fit(certificate_path)
+
+        message = create_message(
+            sender=sender,
+            to=user[2],
+            subject=subject.render(values),
+            msg_html=body.render(values),
+            attachments=[*shared_parts, str(certificate_path)]
+        )
+        return (user, message, perf_counter() - start)
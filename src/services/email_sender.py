@@ -1,23 +1,30 @@
+import io
 import os
 import base64
+import sys
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+
+from google_auth_httplib2 import AuthorizedHttp
 
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build, Resource
+from googleapiclient.discovery import build_from_document, Resource
 from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest, HttpRequest, MediaIoBaseUpload, build_http
+from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 
 from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email.mime.image import MIMEImage
-from email.mime.audio import MIMEAudio
-from email.mime.application import MIMEApplication
-import mimetypes
+
+from services.discovery import discovery_document
+from services.email_transport import EmailTransport
+from services.rate_limiting import SEND_QUOTA_UNITS, TokenBucket
 
 
 
-class EmailSender:
+class EmailSender(EmailTransport):
     """
     EmailSender serves as the entrypoint for the Gmail service API.
     Gmail service API documentation:
@@ -35,6 +42,16 @@ class EmailSender:
     _API_NAME = 'gmail'
     _API_VERSION = 'v1'
     _USER_ID = 'me'
+    # The Gmail API accepts up to 100 calls per batch request,
+    # but recommends no more than 50 to avoid rate limiting.
+    BATCH_LIMIT = 100
+    SEND_COST = SEND_QUOTA_UNITS
+    # Larger messages are uploaded as media, which can't be batched.
+    SIMPLE_UPLOAD_LIMIT = 5 * 1024 ** 2
+    UPLOAD_CHUNK_SIZE = 5 * 1024 ** 2
+    # The access token is refreshed this many seconds before it expires.
+    TOKEN_REFRESH_MARGIN = 5 * 60
+    TOKEN_RETRY_DELAY = 30
 
     # If you don't have a client secret file, follow the instructions at:
     # https://developers.google.com/gmail/api/quickstart/python
@@ -44,7 +61,9 @@ class EmailSender:
         self,
         client_secret_file: str = 'client_secret.json',
         creds_file: str = 'gmail_token.json',
-        _creds: Credentials | None = None
+        _creds: Credentials | None = None,
+        discovery_cache: Path | None = None,
+        refresh_in_background: bool = False
     ) -> None:
         """ Initializes EmailSender. Creates a googleapiclient.discovery resource
         for interacting with the Gmail API from a client secret file.
@@ -54,6 +73,11 @@ class EmailSender:
             creds_file: The serialized creds file that stores the user's
                 access and refresh tokens.
             _creads: The credentials to use.
+            discovery_cache: The file the Gmail discovery document is cached
+                in. If None, the document bundled with googleapiclient is used.
+            refresh_in_background: Whether to refresh the access token from
+                a background thread before it expires, so sends never wait
+                for a refresh. Stopped by `close`.
 
         Raises:
             FileNotFoundError: Could not find the requested file.
@@ -62,6 +86,16 @@ class EmailSender:
         self.client_secret_file = client_secret_file
         self.creds_file = creds_file
         self.creds : Credentials = None
+        # Overrides the batch endpoint of the discovery document,
+        # ex. to send batches to a local test server.
+        self.batch_uri: str | None = None
+        # httplib2 connections aren't thread-safe, so each sending
+        # thread gets its own.
+        self._local = threading.local()
+        # Only one thread refreshes the shared credentials at a time.
+        self._refresh_lock = threading.Lock()
+        self._stop_refresh = threading.Event()
+        self._refresher: threading.Thread | None = None
 
         try:
             # The file gmail_token.json stores the user's access and refresh
@@ -75,6 +109,16 @@ class EmailSender:
                     self._SCOPES
                 )
 
+            if self.creds is not None and self.creds.expired \
+                    and self.creds.refresh_token:
+                try:
+                    self.refresh_credentials()
+                except RefreshError:
+                    # The refresh token was revoked or expired, ex. after
+                    # 7 days for apps in testing, so the app is authorized
+                    # again below.
+                    self.creds = None
+
             if self.creds is None or not self.creds.valid:
                 flow = InstalledAppFlow.from_client_secrets_file(
                     self.client_secret_file,
@@ -95,136 +139,137 @@ class EmailSender:
             )
 
         try:
-            self._service = build(
-                self._API_NAME,
-                self._API_VERSION,
-                credentials=self.creds,
-                static_discovery=False
+            # Built from the cached discovery document,
+            # instead of downloading it every time.
+            self._service = build_from_document(
+                discovery_document(self._API_NAME, self._API_VERSION, discovery_cache),
+                credentials=self.creds
             )
 
-        except HttpError as error:
+        except (HttpError, FileNotFoundError) as error:
             message = 'Could not build googleapiclient.discovery service'\
                       f'for the {self._API_NAME}-{self._API_VERSION} API!'\
                       f'Error: {error}'
             print(message)
 
+        if refresh_in_background:
+            self._refresher = threading.Thread(
+                target=self._refresh_loop,
+                daemon=True
+            )
+            self._refresher.start()
+
     @property
     def service(self) -> Resource:
         # Since the token is only used through calls to the service object,
         # this ensure that the token is always refreshed before use.
         if self.creds.expired and self.creds.refresh_token:
-            self.creds.refresh(Request())
+            self.refresh_credentials()
 
         return self._service
 
-    def send_email(
-        self,
-        sender: str,
-        to: str,
-        subject: str = '',
-        msg_html: str | None = None,
-        msg_plain: str | None = None,
-        cc: list[str] | None = None,
-        bcc: list[str] | None = None,
-        attachments: list[str] | None = None
-    ) -> dict[str, str]:
-        """ Creates and sends the raw email message.
+    def refresh_credentials(self, margin: float = 0) -> None:
+        """ Refresh the access token if it expires within `margin` seconds,
+        and save it in the creds file. Safe to call from several threads,
+        the token is only refreshed once. """
+        with self._refresh_lock:
+            expiry = getattr(self.creds, 'expiry', None)
+            if expiry is not None and not self.creds.expired \
+                    and (expiry - _utcnow()).total_seconds() > margin:
+                # Another thread refreshed it in the meantime.
+                return
 
-        Args:
-            sender: The email address the message is being sent from.
-            to: The email address the message is being sent to.
-            subject: The subject line of the email.
-            msg_html: The HTML message of the email.
-            msg_plain: The plain text alternate message of the email (for slow
-                or old browsers).
-            cc: The list of email addresses to be Cc'd.
-            bcc: The list of email addresses to be Bcc'd
-            attachments: A list of attachment file paths.
+            self.creds.refresh(Request())
+            try:
+                with open(self.creds_file, 'w') as token:
+                    token.write(self.creds.to_json())
+            except (OSError, TypeError):
+                pass
+
+    def _refresh_loop(self) -> None:
+        """ Refresh the access token `TOKEN_REFRESH_MARGIN` seconds
+        before it expires, until `close` is called. """
+        while not self._stop_refresh.is_set():
+            expiry = getattr(self.creds, 'expiry', None)
+            if expiry is None or not getattr(self.creds, 'refresh_token', None):
+                return
+
+            wait = (expiry - _utcnow()).total_seconds() - self.TOKEN_REFRESH_MARGIN
+            if wait > 0:
+                self._stop_refresh.wait(wait)
+                continue
+
+            try:
+                self.refresh_credentials(margin=self.TOKEN_REFRESH_MARGIN)
+            except Exception as error:
+                print('Couldn\'t refresh the Gmail access token: ', error, file=sys.stderr)
+                self._stop_refresh.wait(self.TOKEN_RETRY_DELAY)
+
+    def close(self) -> None:
+        """ Stop refreshing the access token in the background. """
+        self._stop_refresh.set()
 
-        Returns:
-            The message dict.
-        """
+    @property
+    def http(self) -> AuthorizedHttp:
+        """ The authorized http connection of the calling thread. """
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = AuthorizedHttp(self.creds, http=build_http())
+        return http
+
+    def __getstate__(self) -> dict:
+        # Thread locals, locks and threads can't be pickled, ex. when the
+        # sender is passed to a process pool. Copies don't refresh the token.
+        state = self.__dict__.copy()
+        for name in ('_local', '_refresh_lock', '_stop_refresh', '_refresher'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._refresh_lock = threading.Lock()
+        self._stop_refresh = threading.Event()
+        self._refresher = None
+
+    def rate_limiter(self) -> TokenBucket:
+        return TokenBucket.for_gmail()
+
+    def encode_message(self, msg: MIMEMultipart) -> dict[str, str | bytes]:
+        """ Messages up to `SIMPLE_UPLOAD_LIMIT` are sent base64 encoded
+        in the json body, so they can be batched. Larger messages are
+        sent as a resumable media upload of their bytes. """
+        buffer = self.message_bytes(msg)
+        if buffer.getbuffer().nbytes <= self.SIMPLE_UPLOAD_LIMIT:
+            return {'raw': base64.urlsafe_b64encode(buffer.getbuffer()).decode('ascii')}
+        return {'media': buffer.getvalue()}
+
+    def payload_size(self, message: dict[str, str | bytes]) -> int:
+        return len(message.get('raw') or message.get('media') or '')
+
+    def _send_request(self, message: dict[str, str | bytes]) -> HttpRequest:
+        """ Return the messages.send request of the message. """
+        if 'media' in message:
+            media = MediaIoBaseUpload(
+                io.BytesIO(message['media']),
+                mimetype='message/rfc822',
+                chunksize=self.UPLOAD_CHUNK_SIZE,
+                resumable=True
+            )
+            return self.service.users().messages().send(
+                userId=self._USER_ID,
+                body={},
+                media_body=media
+            )
 
-        msg = self.create_message(
-            sender,
-            to,
-            subject,
-            msg_html,
-            msg_plain,
-            cc,
-            bcc,
-            attachments
+        return self.service.users().messages().send(
+            userId=self._USER_ID,
+            body=message
         )
 
-        res = self.send_message(msg)
-        return res
-
-    def create_message(
-        self,
-        sender: str,
-        to: str,
-        subject: str = '',
-        msg_html: str | None = None,
-        msg_plain: str | None = None,
-        cc: list[str] | None = None,
-        bcc: list[str] | None = None,
-        attachments: list[str] | None = None
-    ) -> dict[str, MIMEMultipart]:
-        """ Creates the raw email message to be sent.
-
-        Args:
-            sender: The email address the message is being sent from.
-            to: The email address the message is being sent to.
-            subject: The subject line of the email.
-            msg_html: The HTML message of the email.
-            msg_plain: The plain text alternate message of the email (for slow
-                or old browsers).
-            cc: The list of email addresses to be Cc'd.
-            bcc: The list of email addresses to be Bcc'd
-            attachments: A list of attachment file paths.
-
-        Returns:
-            The message dict.
-        """
-
-        msg = MIMEMultipart('mixed' if attachments else 'alternative')
-        msg['To'] = to
-        msg['From'] = sender
-        msg['Subject'] = subject
-
-        if cc:
-            msg['Cc'] = ', '.join(cc)
-
-        if bcc:
-            msg['Bcc'] = ', '.join(bcc)
-
-        if msg_html is None:
-            msg_html = ''
-
-        msg_html += "<br/><br/>"
-
-        attach_plain = MIMEMultipart('alternative') if attachments else msg
-        attach_html = MIMEMultipart('related') if attachments else msg
-
-        if msg_plain:
-            attach_plain.attach(MIMEText(msg_plain, 'plain'))
-
-        if msg_html:
-            attach_html.attach(MIMEText(msg_html, 'html'))
-
-        if attachments:
-            attach_plain.attach(attach_html)
-            msg.attach(attach_plain)
-            self._add_attachments(msg, attachments)
-
-        return {
-            'raw': base64.urlsafe_b64encode(msg.as_string()
-                .encode('utf-8')).decode('utf-8')
-        }
-
     def send_message(
         self,
-        message: dict[str, MIMEMultipart]
+        message: dict[str, str | bytes]
     ) -> dict[str, str]:
         """ Sends the provided message.
 
@@ -235,49 +280,67 @@ class EmailSender:
             googleapiclient.errors.HttpError: An Http error has occured.
         """
 
-        req = self.service.users().messages().send(
-            userId=self._USER_ID,
-            body=message
-        )
-        res = req.execute()
+        req = self._send_request(message)
+        res = req.execute(http=self.http)
         return res
 
-    def _add_attachments(
+    def send_message_batch(
         self,
-        msg: MIMEMultipart,
-        attachments: list[str]
-    ) -> None:
-        """ Converts attachment filepaths to MIME objects and adds them to msg.
+        messages: list[dict[str, str | bytes]],
+        batch_size: int = 50
+    ) -> list[tuple[dict[str, str] | None, HttpError | None]]:
+        """ Sends the provided messages, grouping up to `batch_size` of them
+        in a single multipart batch request. Messages too large to batch
+        are uploaded on their own.
 
         Args:
-            msg: The message to add attachments to.
-            attachments: A list of attachment file paths.
+            messages: The messages to send.
+            batch_size: The number of messages per batch request. Can't be
+                greater than `BATCH_LIMIT`.
+
+        Returns:
+            For each message, in the same order, the response of its send
+            call, or the HttpError that occured.
         """
 
-        for attachment in attachments:
-            content_type, encoding = mimetypes.guess_type(attachment)
-
-            if content_type is None or encoding is not None:
-                content_type = 'application/octet-stream'
-
-            main_type, sub_type = content_type.split('/', 1)
-            filename = os.path.basename(attachment)
-
-            with open(attachment, 'rb') as file:
-                raw_data = file.read()
-
-                attm : MIMEBase
-                if main_type == 'text':
-                    attm = MIMEText(raw_data.decode('utf-8'), _subtype=sub_type)
-                elif main_type == 'image':
-                    attm = MIMEImage(raw_data, _subtype=sub_type)
-                elif main_type == 'audio':
-                    attm = MIMEAudio(raw_data, _subtype=sub_type)
-                elif main_type == 'application':
-                    attm = MIMEApplication(raw_data, _subtype=sub_type)
-                else:
-                    attm = MIMEBase(main_type, sub_type)
-                    attm.set_payload(raw_data)
-
-            attm.add_header('Content-Disposition', 'attachment', filename=filename)
-            msg.attach(attm)
+        batch_size = max(1, min(batch_size, self.BATCH_LIMIT))
+        results: list[tuple[dict[str, str] | None, HttpError | None]] = \
+            [(None, None)] * len(messages)
+
+        def callback(request_id: str, response, exception) -> None:
+            results[int(request_id)] = (response, exception)
+
+        for start in range(0, len(messages), batch_size):
+            if self.batch_uri is not None:
+                batch = BatchHttpRequest(callback=callback, batch_uri=self.batch_uri)
+            else:
+                batch = self.service.new_batch_http_request(callback=callback)
+
+            for index in range(start, min(start + batch_size, len(messages))):
+                if 'media' in messages[index]:
+                    try:
+                        results[index] = (self.send_message(messages[index]), None)
+                    except HttpError as error:
+                        results[index] = (None, error)
+                    continue
+
+                batch.add(
+                    self._send_request(messages[index]),
+                    request_id=str(index)
+                )
+
+            try:
+                batch.execute(http=self.http)
+            except HttpError as error:
+                # The batch request itself failed, so did every
+                # message that didn't get a response.
+                for index in range(start, min(start + batch_size, len(messages))):
+                    if results[index] == (None, None):
+                        results[index] = (None, error)
+
+        return results
+
+
+def _utcnow() -> datetime:
+    # google.auth keeps the token expiry as a naive utc datetime.
+    return datetime.now(timezone.utc).replace(tzinfo=None)
@@ -0,0 +1,284 @@
+""" The interface of the email delivery backends. """
+import io
+import os
+import mimetypes
+from typing import Any
+
+from email import encoders
+from email.generator import BytesGenerator
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.base import MIMEBase
+from email.mime.image import MIMEImage
+from email.mime.audio import MIMEAudio
+from email.mime.application import MIMEApplication
+
+from services.rate_limiting import TokenBucket
+
+
+
+class EmailTransport:
+    """
+    Base class of the email delivery backends, ex. the Gmail API or an SMTP
+    relay. Builds the MIME messages, which subclasses encode in the form
+    they send, and defines how messages are sent.
+
+    Attributes:
+        BATCH_LIMIT (int): The maximum number of messages per batch.
+        SEND_COST (int): The rate limiter tokens each sent message takes.
+    """
+
+    BATCH_LIMIT = 100
+    SEND_COST = 1
+
+    def rate_limiter(self) -> TokenBucket | None:
+        """ Return the rate limiter of the backend's quota,
+        or None if it has no quota. """
+        return None
+
+    def close(self) -> None:
+        """ Release the connections of the backend. """
+
+    def send_email(
+        self,
+        sender: str,
+        to: str,
+        subject: str = '',
+        msg_html: str | None = None,
+        msg_plain: str | None = None,
+        cc: list[str] | None = None,
+        bcc: list[str] | None = None,
+        attachments: list[str | MIMEBase] | None = None
+    ) -> dict[str, str]:
+        """ Creates and sends the email message.
+
+        Args:
+            sender: The email address the message is being sent from.
+            to: The email address the message is being sent to.
+            subject: The subject line of the email.
+            msg_html: The HTML message of the email.
+            msg_plain: The plain text alternate message of the email (for slow
+                or old browsers).
+            cc: The list of email addresses to be Cc'd.
+            bcc: The list of email addresses to be Bcc'd
+            attachments: A list of attachment file paths, or encoded parts.
+
+        Returns:
+            The response of the backend, with the message's id.
+        """
+
+        msg = self.create_message(
+            sender,
+            to,
+            subject,
+            msg_html,
+            msg_plain,
+            cc,
+            bcc,
+            attachments
+        )
+
+        res = self.send_message(msg)
+        return res
+
+    def create_message(
+        self,
+        sender: str,
+        to: str,
+        subject: str = '',
+        msg_html: str | None = None,
+        msg_plain: str | None = None,
+        cc: list[str] | None = None,
+        bcc: list[str] | None = None,
+        attachments: list[str | MIMEBase] | None = None
+    ) -> Any:
+        """ Creates the email message to be sent.
+
+        Args:
+            sender: The email address the message is being sent from.
+            to: The email address the message is being sent to.
+            subject: The subject line of the email.
+            msg_html: The HTML message of the email.
+            msg_plain: The plain text alternate message of the email (for slow
+                or old browsers).
+            cc: The list of email addresses to be Cc'd.
+            bcc: The list of email addresses to be Bcc'd
+            attachments: A list of attachment file paths, or encoded parts.
+
+        Returns:
+            The message, encoded for `send_message`.
+        """
+
+        return self.encode_message(self.build_message(
+            sender,
+            to,
+            subject,
+            msg_html,
+            msg_plain,
+            cc,
+            bcc,
+            attachments
+        ))
+
+    @staticmethod
+    def build_message(
+        sender: str,
+        to: str,
+        subject: str = '',
+        msg_html: str | None = None,
+        msg_plain: str | None = None,
+        cc: list[str] | None = None,
+        bcc: list[str] | None = None,
+        attachments: list[str | MIMEBase] | None = None
+    ) -> MIMEMultipart:
+        """ Creates the MIME message. See `create_message`. Attachments
+        can also be parts made by `encode_attachment`, ex. to encode an
+        attachment shared by many messages only once. """
+
+        msg = MIMEMultipart('mixed' if attachments else 'alternative')
+        msg['To'] = to
+        msg['From'] = sender
+        msg['Subject'] = subject
+
+        if cc:
+            msg['Cc'] = ', '.join(cc)
+
+        if bcc:
+            msg['Bcc'] = ', '.join(bcc)
+
+        if msg_html is None:
+            msg_html = ''
+
+        msg_html += "<br/><br/>"
+
+        attach_plain = MIMEMultipart('alternative') if attachments else msg
+        attach_html = MIMEMultipart('related') if attachments else msg
+
+        if msg_plain:
+            attach_plain.attach(MIMEText(msg_plain, 'plain'))
+
+        if msg_html:
+            attach_html.attach(MIMEText(msg_html, 'html'))
+
+        if attachments:
+            attach_plain.attach(attach_html)
+            msg.attach(attach_plain)
+            EmailTransport._add_attachments(msg, attachments)
+
+        return msg
+
+    @staticmethod
+    def message_bytes(msg: MIMEMultipart) -> io.BytesIO:
+        """ Serializes the MIME message straight to bytes, with CRLF line
+        endings, without first building it as a string. The attachments
+        are written as they were encoded, so shared parts aren't copied. """
+        buffer = io.BytesIO()
+        generator = BytesGenerator(
+            buffer,
+            mangle_from_=False,
+            policy=msg.policy.clone(linesep='\r\n')
+        )
+        generator.flatten(msg)
+        return buffer
+
+    def encode_message(self, msg: MIMEMultipart) -> Any:
+        """ Encodes the MIME message in the form `send_message` takes. """
+        raise NotImplementedError
+
+    def payload_size(self, message: Any) -> int:
+        """ Return the size of the encoded message in bytes. """
+        return 0
+
+    def send_message(self, message: Any) -> dict[str, str]:
+        """ Sends the provided message.
+
+        Args:
+            message: The message to send, as returned by `create_message`.
+
+        Returns:
+            The response of the backend, with the message's id.
+        """
+        raise NotImplementedError
+
+    def send_message_batch(
+        self,
+        messages: list[Any],
+        batch_size: int = 50
+    ) -> list[tuple[dict[str, str] | None, Exception | None]]:
+        """ Sends the provided messages. Backends that can group messages
+        in a single request override this, by default they are sent one
+        by one.
+
+        Args:
+            messages: The messages to send.
+            batch_size: The number of messages per request. Can't be
+                greater than `BATCH_LIMIT`.
+
+        Returns:
+            For each message, in the same order, the response of its send
+            call, or the exception that occured.
+        """
+
+        results = []
+        for message in messages:
+            try:
+                results.append((self.send_message(message), None))
+            except Exception as error:
+                results.append((None, error))
+        return results
+
+    @staticmethod
+    def encode_attachment(attachment: str) -> MIMEBase:
+        """ Reads the file at the attachment path and wraps it in a MIME
+        part, encoded as it will be sent. The part can be attached to
+        any number of messages.
+
+        Args:
+            attachment: The attachment's file path.
+        """
+
+        content_type, encoding = mimetypes.guess_type(attachment)
+
+        if content_type is None or encoding is not None:
+            content_type = 'application/octet-stream'
+
+        main_type, sub_type = content_type.split('/', 1)
+        filename = os.path.basename(attachment)
+
+        with open(attachment, 'rb') as file:
+            raw_data = file.read()
+
+            attm : MIMEBase
+            if main_type == 'text':
+                attm = MIMEText(raw_data.decode('utf-8'), _subtype=sub_type)
+            elif main_type == 'image':
+                attm = MIMEImage(raw_data, _subtype=sub_type)
+            elif main_type == 'audio':
+                attm = MIMEAudio(raw_data, _subtype=sub_type)
+            elif main_type == 'application':
+                attm = MIMEApplication(raw_data, _subtype=sub_type)
+            else:
+                attm = MIMEBase(main_type, sub_type)
+                attm.set_payload(raw_data)
+                encoders.encode_base64(attm)
+
+        attm.add_header('Content-Disposition', 'attachment', filename=filename)
+        return attm
+
+    @staticmethod
+    def _add_attachments(
+        msg: MIMEMultipart,
+        attachments: list[str | MIMEBase]
+    ) -> None:
+        """ Converts attachment filepaths to MIME objects and adds them to msg.
+
+        Args:
+            msg: The message to add attachments to.
+            attachments: A list of attachment file paths, or already
+                encoded parts.
+        """
+
+        for attachment in attachments:
+            if not isinstance(attachment, MIMEBase):
+                attachment = EmailTransport.encode_attachment(attachment)
+            msg.attach(attachment)
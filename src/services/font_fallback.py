@@ -0,0 +1,159 @@
+""" Font fallback for characters the selected font lacks.
+
+`FontFallback` indexes the codepoints each font of the fonts folder covers,
+read from the fonts' cmap tables, and caches the index on disk, so fonts
+are only opened again when they change. The characters of a batch of
+names are then resolved against the index, each to the first font of the
+fallback chain that covers it: the selected font first, then the rest of
+the fonts folder.
+"""
+import json
+import threading
+from pathlib import Path
+
+from fontTools.ttLib import TTFont
+
+
+
+FONT_SUFFIXES = {'.ttf', '.otf'}
+CACHE_VERSION = 1
+
+
+def _to_ranges(codepoints: set[int]) -> list[list[int]]:
+    """ Compress codepoints to a list of [first, last] ranges. """
+    ranges = []
+    for codepoint in sorted(codepoints):
+        if ranges and ranges[-1][1] == codepoint - 1:
+            ranges[-1][1] = codepoint
+        else:
+            ranges.append([codepoint, codepoint])
+    return ranges
+
+
+def _from_ranges(ranges: list[list[int]]) -> frozenset[int]:
+    return frozenset(
+        codepoint
+        for first, last in ranges
+        for codepoint in range(first, last + 1)
+    )
+
+
+class FontFallback:
+    """ Codepoint coverage index of the fonts in `fonts_folder`.
+
+    Args:
+        fonts_folder: The folder of the fallback fonts.
+        cache_path: The json file the index is cached in.
+    """
+    def __init__(self, fonts_folder: Path, cache_path: Path) -> None:
+        self.fonts_folder = fonts_folder
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._coverage: dict[Path, frozenset[int]] = {}
+        self._cache: dict[str, dict] = self._load_cache()
+        self._dirty = False
+
+        for path in self.fonts():
+            self.coverage(path)
+        self.save()
+
+    def fonts(self) -> list[Path]:
+        """ Return the fonts of the fonts folder, sorted by name. """
+        return sorted(
+            path for path in self.fonts_folder.iterdir()
+            if path.suffix.lower() in FONT_SUFFIXES
+        )
+
+    def coverage(self, path: Path) -> frozenset[int]:
+        """ Return the codepoints the font at `path` has glyphs for. """
+        path = Path(path).resolve()
+        with self._lock:
+            if path in self._coverage:
+                return self._coverage[path]
+
+            stat = path.stat()
+            key = str(path)
+            entry = self._cache.get(key)
+            if entry is None or entry['mtime'] != stat.st_mtime \
+                    or entry['size'] != stat.st_size:
+                with TTFont(path, lazy=True, fontNumber=0) as font:
+                    codepoints = set(font.getBestCmap() or {})
+                entry = {
+                    'mtime': stat.st_mtime,
+                    'size': stat.st_size,
+                    'ranges': _to_ranges(codepoints)
+                }
+                self._cache[key] = entry
+                self._dirty = True
+
+            coverage = _from_ranges(entry['ranges'])
+            self._coverage[path] = coverage
+            return coverage
+
+    def chain(self, primary: Path) -> list[Path]:
+        """ Return the fallback chain of `primary`: the font itself,
+        followed by the other fonts of the fonts folder. """
+        primary = Path(primary).resolve()
+        return [primary] + [
+            path.resolve() for path in self.fonts()
+            if path.resolve() != primary
+        ]
+
+    def resolve(
+        self,
+        chars: set[str],
+        primary: Path
+    ) -> tuple[dict[str, Path], set[str]]:
+        """ Resolve the characters the `primary` font lacks.
+
+        Args:
+            chars: The characters to resolve.
+            primary: The path of the selected font.
+
+        Returns:
+            The fallback font of each character that needs one, and the
+            characters that no font covers. Whitespace is never reported.
+        """
+        chain = self.chain(primary)
+        primary_coverage = self.coverage(chain[0])
+        fallbacks = {}
+        missing = set()
+
+        for char in chars:
+            codepoint = ord(char)
+            if codepoint in primary_coverage or char.isspace():
+                continue
+
+            for path in chain[1:]:
+                if codepoint in self.coverage(path):
+                    fallbacks[char] = path
+                    break
+            else:
+                missing.add(char)
+
+        self.save()
+        return fallbacks, missing
+
+    def _load_cache(self) -> dict[str, dict]:
+        try:
+            with open(self.cache_path, 'r', encoding='UTF-8') as file:
+                cache = json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+        if cache.get('version') != CACHE_VERSION:
+            return {}
+        return cache.get('fonts', {})
+
+    def save(self) -> None:
+        """ Write the index to the cache file, if it changed. """
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                with open(self.cache_path, 'w', encoding='UTF-8') as file:
+                    json.dump({'version': CACHE_VERSION, 'fonts': self._cache}, file)
+                self._dirty = False
+            except OSError:
+                # The cache is only an optimization.
+                pass
@@ -0,0 +1,238 @@
+""" N-up imposition of certificates on print sheets.
+
+`ImpositionSink` places certificates on sheets as they are created and
+writes every full sheet to a multipage tiff right away, so only one sheet
+is kept in memory, no matter the size of the batch. Pdf sheets are written
+to a tiff first too, and converted a page at a time when the batch is done:
+pillow can only add a page to a pdf by rewriting it, which gets slower with
+every page.
+"""
+import os
+from io import BytesIO
+from pathlib import Path
+from typing import IO
+
+from PIL import Image, ImageDraw, TiffImagePlugin
+
+from services.certificate_creation import CertificateSink
+from services.constants import *
+
+
+
+MM_PER_INCH = 25.4
+
+# Sheet sizes in millimetres, portrait.
+SHEET_SIZES = {
+    'SRA3': (320, 450),
+    'SRA4': (225, 320),
+    'A3': (297, 420),
+    'A4': (210, 297),
+}
+
+
+class ImpositionSink(CertificateSink):
+    """ Imposes certificates `n_up` to a sheet, with crop marks.
+
+    Args:
+        output_path: The file to write the sheets to. The format is picked
+            by the suffix, `.pdf` or `.tif`/`.tiff`. A pdf is written when
+            the sink is closed, until then its sheets are kept in a tiff next
+            to it, named after it with a `.tif` suffix added, which is kept
+            if the run is stopped before that.
+        n_up: The number of certificates per sheet.
+        sheet_size: A key of `SHEET_SIZES`, or the (width, height)
+            of the sheet in millimetres.
+        dpi: The resolution of the sheets.
+        margin: The minimum distance of the certificates from the edges of
+            the sheet, in millimetres.
+        gutter: The distance between certificates, in millimetres.
+        mark_length: The length of the crop marks, in millimetres.
+        mark_offset: The distance of the crop marks from the certificates'
+            corners, in millimetres.
+    """
+    def __init__(
+        self,
+        output_path: Path,
+        n_up: int = 2,
+        sheet_size: str | tuple[float, float] = 'SRA3',
+        dpi: int = 300,
+        margin: float = 12,
+        gutter: float = 10,
+        mark_length: float = 3,
+        mark_offset: float = 1.5
+    ) -> None:
+        if output_path.suffix.lower() not in {'.pdf', '.tif', '.tiff'}:
+            raise NotImplementedError('Sheets can only be saved as pdf or tiff.')
+
+        if isinstance(sheet_size, str):
+            sheet_size = SHEET_SIZES[sheet_size]
+
+        self.output_path = output_path
+        self.frames_path = output_path
+        if output_path.suffix.lower() == '.pdf':
+            self.frames_path = output_path.with_name(output_path.name + '.tif')
+        self.n_up = n_up
+        self.dpi = dpi
+        self.sheet_size = tuple(self._to_px(mm) for mm in sheet_size)
+        self.margin = self._to_px(margin)
+        self.gutter = self._to_px(gutter)
+        self.mark_length = self._to_px(mark_length)
+        self.mark_offset = self._to_px(mark_offset)
+
+        # The layout depends on the size of the certificates,
+        # so it is computed when the first one arrives.
+        self.cells: list[tuple[int, int]] = []
+        self.page_size: tuple[int, int] = self.sheet_size
+        self.certificate_size: tuple[int, int] = (0, 0)
+
+        self.sheet: Image.Image | None = None
+        self.sheet_users: list[User] = []
+        self.num_of_sheets = 0
+        self._file: IO[bytes] | None = None
+        self._tiff: TiffImagePlugin.AppendingTiffWriter | None = None
+
+    def _to_px(self, mm: float) -> int:
+        return round(mm / MM_PER_INCH * self.dpi)
+
+    def add(self, user: User, data: bytes) -> None:
+        with Image.open(BytesIO(data)) as certificate:
+            if not self.cells:
+                self._compute_layout(certificate.size)
+
+            if self.sheet is None:
+                self.sheet = Image.new('RGB', self.page_size, 'white')
+
+            if certificate.size != self.certificate_size:
+                certificate = certificate.resize(
+                    self.certificate_size,
+                    Image.Resampling.LANCZOS
+                )
+
+            cell = self.cells[len(self.sheet_users)]
+            self.sheet.paste(certificate.convert('RGB'), cell)
+
+        self._draw_crop_marks(cell)
+        self.sheet_users.append(user)
+
+        if len(self.sheet_users) == self.n_up:
+            self._write_sheet()
+
+    def close(self) -> None:
+        """ Write the last, possibly partial, sheet and close the file. """
+        if self.sheet is not None:
+            self._write_sheet()
+
+        if self._tiff is not None:
+            self._tiff.close()
+            self._tiff = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+            if self.frames_path != self.output_path:
+                self._convert_to_pdf()
+
+    def _convert_to_pdf(self) -> None:
+        """ Convert the tiff of the sheets to the output pdf. The pages
+        are read one at a time, and the pdf is written to a temporary file
+        first, so an earlier pdf isn't lost if converting fails. """
+        temp_path = self.output_path.with_name(self.output_path.name + '.part')
+        with Image.open(self.frames_path) as frames:
+            frames.save(
+                temp_path,
+                format='PDF',
+                save_all=True,
+                resolution=self.dpi
+            )
+        os.replace(temp_path, self.output_path)
+        self.frames_path.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _compute_layout(self, size: tuple[int, int]) -> None:
+        """ Pick the sheet orientation and grid that fit
+        the certificates at the largest scale. """
+        best_scale = 0.0
+        for cols in range(1, self.n_up + 1):
+            if self.n_up % cols:
+                continue
+            rows = self.n_up // cols
+
+            width, height = self.sheet_size
+            for page in ((width, height), (height, width)):
+                cell_width = (page[0] - 2 * self.margin
+                    - (cols - 1) * self.gutter) / cols
+                cell_height = (page[1] - 2 * self.margin
+                    - (rows - 1) * self.gutter) / rows
+                scale = min(cell_width / size[0], cell_height / size[1])
+                if scale > best_scale:
+                    best_scale = scale
+                    best = (page, cols, rows)
+
+        if best_scale <= 0:
+            raise ValueError('The certificates don\'t fit on the sheet.')
+
+        page, cols, rows = best
+        self.page_size = page
+        # Keep the original size when it fits, only ever scale down.
+        scale = min(best_scale, 1.0)
+        self.certificate_size = (
+            int(size[0] * scale),
+            int(size[1] * scale)
+        )
+
+        # Center the grid on the sheet.
+        width, height = self.certificate_size
+        grid_width = cols * width + (cols - 1) * self.gutter
+        grid_height = rows * height + (rows - 1) * self.gutter
+        left = (page[0] - grid_width) // 2
+        top = (page[1] - grid_height) // 2
+        self.cells = [
+            (left + col * (width + self.gutter), top + row * (height + self.gutter))
+            for row in range(rows)
+            for col in range(cols)
+        ]
+
+    def _draw_crop_marks(self, cell: tuple[int, int]) -> None:
+        """ Draw crop marks outside the corners of the certificate at `cell`. """
+        draw = ImageDraw.Draw(self.sheet)
+        left, top = cell
+        right = left + self.certificate_size[0]
+        bottom = top + self.certificate_size[1]
+        start, end = self.mark_offset, self.mark_offset + self.mark_length
+
+        for x, x_dir in ((left, -1), (right, 1)):
+            for y, y_dir in ((top, -1), (bottom, 1)):
+                # Horizontal mark, aligned with the certificate's edge
+                draw.line(
+                    [(x + x_dir * start, y), (x + x_dir * end, y)],
+                    fill='black',
+                    width=1
+                )
+                # Vertical mark
+                draw.line(
+                    [(x, y + y_dir * start), (x, y + y_dir * end)],
+                    fill='black',
+                    width=1
+                )
+
+    def _write_sheet(self) -> None:
+        """ Append the current sheet to the tiff and drop it. """
+        if self._tiff is None:
+            self._file = open(self.frames_path, 'w+b')
+            self._tiff = TiffImagePlugin.AppendingTiffWriter(self._file)
+        self.sheet.save(
+            self._tiff,
+            format='TIFF',
+            dpi=(self.dpi, self.dpi),
+            compression='tiff_lzw'
+        )
+        self._tiff.newFrame()
+
+        self.num_of_sheets += 1
+        self.sheet = None
+        self.sheet_users = []
@@ -0,0 +1,92 @@
+""" Email delivery into a local Maildir, for dry runs.
+
+`MaildirTransport` writes each message as an `.eml` file instead of sending
+it, so a whole campaign can be built and checked without a network or a
+quota, ex. to review the personalised messages, diff them between two
+runs, or measure how fast they are built.
+"""
+import hashlib
+import os
+import re
+import threading
+from email.mime.multipart import MIMEMultipart
+from email.utils import getaddresses
+from pathlib import Path
+
+from services.email_transport import EmailTransport
+
+
+
+# The characters of an address that are kept in its file name.
+UNSAFE_FILENAME = re.compile(r'[^\w.@+-]')
+
+
+class MaildirTransport(EmailTransport):
+    """ Writes messages into a Maildir. Each message is saved in the
+    `new` folder as `<recipient>.eml`, with the same bytes the Gmail API
+    backend would upload, except that the MIME boundaries are derived from
+    the recipient, so the output of two runs can be diffed. A file is never
+    replaced: another message to the same recipient, ex. a user listed
+    twice, is saved as `<recipient>.2.eml`, `<recipient>.3.eml` and so on.
+    Files are written to the `tmp` folder first, so a reader of `new`
+    never sees a partial message.
+
+    Args:
+        folder: The Maildir. It's created if it doesn't exist.
+    """
+
+    # Writing files has no request to group messages in.
+    BATCH_LIMIT = 1000
+    SEND_COST = 1
+
+    def __init__(self, folder: Path) -> None:
+        self.folder = Path(folder)
+        for subfolder in ('tmp', 'new', 'cur'):
+            (self.folder / subfolder).mkdir(parents=True, exist_ok=True)
+
+    def encode_message(self, msg: MIMEMultipart) -> dict[str, str | bytes]:
+        addresses = getaddresses(msg.get_all('To', []))
+        to = addresses[0][1] if addresses else ''
+
+        # The boundaries are random by default, which would make
+        # every file of two runs differ.
+        for number, part in enumerate(msg.walk()):
+            if part.is_multipart():
+                digest = hashlib.sha256(f'{to}/{number}'.encode()).hexdigest()[:19]
+                part.set_boundary(f'==============={digest}==')
+
+        return {'to': to, 'data': self.message_bytes(msg).getvalue()}
+
+    def payload_size(self, message: dict[str, str | bytes]) -> int:
+        return len(message['data'])
+
+    def send_message(self, message: dict[str, str | bytes]) -> dict[str, str]:
+        """ Saves the provided message.
+
+        Args:
+            message: The message to save, as returned by `create_message`.
+
+        Returns:
+            The message's id, its file name without the extension,
+            and its path.
+        """
+        name = UNSAFE_FILENAME.sub('_', message['to']) or 'unknown'
+        temp_path = self.folder / 'tmp' / f'{name}.{os.getpid()}.{threading.get_ident()}.eml'
+
+        with open(temp_path, 'wb') as file:
+            file.write(message['data'])
+
+        # Linking fails if the file exists, unlike replacing, so two
+        # messages to the same recipient can't overwrite each other,
+        # even when they are saved at the same time.
+        number = 1
+        while True:
+            message_id = name if number == 1 else f'{name}.{number}'
+            path = self.folder / 'new' / f'{message_id}.eml'
+            try:
+                os.link(temp_path, path)
+                break
+            except FileExistsError:
+                number += 1
+        temp_path.unlink()
+        return {'id': message_id, 'path': str(path)}
@@ -0,0 +1,74 @@
+""" Per-recipient personalisation of the emails.
+
+The subject and body of an email can contain merge fields, ex. "Dear {name}",
+that are replaced with each user's values. A template is parsed once into
+a format string, so personalising a message is a single `format_map` call.
+"""
+import html
+import re
+from typing import Mapping
+
+from services.constants import *
+
+
+
+FIELD = re.compile(r'\{(\w+)\}')
+# The merge fields of a user.
+USER_FIELDS = ('id', 'name', 'email')
+
+
+def user_values(user: User) -> dict[str, str]:
+    """ Return the merge field values of the `user`. """
+    return dict(zip(USER_FIELDS, map(str, user)))
+
+
+class MergeTemplate:
+    """ A text with merge fields, compiled for fast substitution.
+
+    Only `{field}` placeholders of known fields are replaced, any other
+    text, including other braces (ex. the css of an HTML signature), is
+    kept as it is.
+
+    Args:
+        text: The template text.
+        escape: Whether to escape the values for HTML.
+        fields: The known fields.
+    """
+    def __init__(
+        self,
+        text: str,
+        escape: bool = True,
+        fields: tuple[str, ...] = USER_FIELDS
+    ) -> None:
+        self.text = text
+        self.escape = escape
+
+        parts = []
+        used = []
+        position = 0
+        for match in FIELD.finditer(text):
+            if match[1] not in fields:
+                continue
+            parts.append(_escape_braces(text[position:match.start()]))
+            parts.append('{' + match[1] + '}')
+            if match[1] not in used:
+                used.append(match[1])
+            position = match.end()
+        parts.append(_escape_braces(text[position:]))
+
+        self._format = ''.join(parts)
+        self.fields = tuple(used)
+
+    def render(self, values: Mapping[str, str]) -> str:
+        """ Return the text with the merge fields replaced by `values`. """
+        if not self.fields:
+            return self.text
+        if self.escape:
+            return self._format.format_map(
+                {field: html.escape(values[field]) for field in self.fields}
+            )
+        return self._format.format_map(values)
+
+
+def _escape_braces(text: str) -> str:
+    return text.replace('{', '{{').replace('}', '}}')
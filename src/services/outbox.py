@@ -0,0 +1,197 @@
+""" SQLite outbox of the emailed certificates.
+
+Every message of a campaign is recorded in the outbox before it's sent and
+again after, with the Gmail id of the sent message. A campaign that was
+interrupted, ex. by a crash, can then be sent again: only the messages
+that weren't sent are, and no user gets the same campaign twice.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+from services.constants import *
+
+
+
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    campaign_id TEXT NOT NULL,
+    email TEXT NOT NULL,
+    row_key TEXT NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    message_id TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (campaign_id, name, email)
+);
+CREATE INDEX IF NOT EXISTS messages_status ON messages (campaign_id, status);
+"""
+
+
+def message_key(user: User) -> tuple[str, str]:
+    """ Return the key of the message to the `user` in a campaign, their
+    name and address. Users that share an address, ex. in test mode, each
+    get their own message, and a user keeps their key when the list is
+    sorted or edited, which changes their row. """
+    return (user[1], user[2])
+
+
+def campaign_id(
+    sender: str,
+    subject: str,
+    body: str,
+    attachments: list[str]
+) -> str:
+    """ Return the id of the campaign with these contents. Sending the
+    same email again resumes the campaign instead of starting a new one. """
+    digest = hashlib.sha256()
+    for part in (sender, subject, body, *map(str, attachments)):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:16]
+
+
+class EmailOutbox:
+    """ Records the state of each message of a campaign in a SQLite
+    database. Messages are keyed by campaign, name and address, and go from
+    queued to sending, then to sent or failed. Every state change is
+    committed right away. Can be shared between threads.
+
+    Args:
+        path: The database file. Created if it doesn't exist.
+    """
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._migrate()
+        self._conn.executescript(_SCHEMA)
+
+    def _migrate(self) -> None:
+        """ Rekey the messages of an outbox created when they were keyed
+        by campaign and address, or by campaign, row and address. """
+        keys = {
+            row['name']: row['pk'] for row
+            in self._conn.execute('PRAGMA table_info(messages)')
+        }
+        if not keys or keys['name']:
+            return
+        with self._conn:
+            self._conn.execute('ALTER TABLE messages RENAME TO messages_old')
+            self._conn.execute('DROP INDEX IF EXISTS messages_status')
+            self._conn.execute(_SCHEMA.split(';')[0])
+            # Rows of the same user, ex. listed twice, become one message,
+            # which is sent if any of them was.
+            self._conn.execute(
+                'INSERT OR IGNORE INTO messages SELECT * FROM messages_old '
+                'ORDER BY status = ? DESC, updated_at DESC',
+                (SENT,)
+            )
+            self._conn.execute('DROP TABLE messages_old')
+
+    def enqueue(self, campaign: str, userlist: list[User]) -> None:
+        """ Queue a message to each user that isn't in the campaign yet. """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO messages '
+                '(campaign_id, email, row_key, name, status, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [
+                    (campaign, user[2], str(user[0]), user[1], QUEUED, now)
+                    for user in userlist
+                ]
+            )
+
+    def statuses(self, campaign: str) -> dict[tuple[str, str], str]:
+        """ Return the state of each message of the campaign,
+        by `message_key`. """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT name, email, status FROM messages WHERE campaign_id = ?',
+                (campaign,)
+            ).fetchall()
+        return {(name, email): status for name, email, status in rows}
+
+    def get(self, campaign: str, user: User) -> dict[str, Any] | None:
+        """ Return the outbox row of the message to the `user`. """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT * FROM messages WHERE campaign_id = ? '
+                'AND name = ? AND email = ?',
+                (campaign, *message_key(user))
+            ).fetchone()
+        return None if row is None else dict(row)
+
+    def counts(self, campaign: str) -> dict[str, int]:
+        """ Return the number of messages of the campaign in each state. """
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT status, COUNT(*) FROM messages '
+                'WHERE campaign_id = ? GROUP BY status',
+                (campaign,)
+            ).fetchall()
+        return {status: count for status, count in rows}
+
+    def sent_since(self, since: float) -> int:
+        """ Return the number of messages of every campaign sent since
+        the `since` timestamp, ex. to know how much of a daily sending
+        limit is used. """
+        with self._lock:
+            (count,) = self._conn.execute(
+                'SELECT COUNT(*) FROM messages WHERE status = ? AND updated_at >= ?',
+                (SENT, since)
+            ).fetchone()
+        return count
+
+    def mark_sending(self, campaign: str, userlist: list[User]) -> None:
+        """ Record that the messages to the users are about to be sent. """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'UPDATE messages SET status = ?, attempts = attempts + 1, '
+                'updated_at = ? WHERE campaign_id = ? AND name = ? AND email = ?',
+                [(SENDING, time.time(), campaign, *message_key(user)) for user in userlist]
+            )
+
+    def mark_sent(self, campaign: str, user: User, message_id: str | None) -> None:
+        """ Record that the message to the `user` was sent as `message_id`. """
+        self._update(campaign, user, SENT, message_id=message_id)
+
+    def mark_failed(self, campaign: str, user: User, error: str) -> None:
+        """ Record that the message to the `user` couldn't be sent. """
+        self._update(campaign, user, FAILED, error=error)
+
+    def mark_queued(self, campaign: str, user: User, error: str) -> None:
+        """ Record that the message to the `user` failed, but will be retried. """
+        self._update(campaign, user, QUEUED, error=error)
+
+    def _update(
+        self,
+        campaign: str,
+        user: User,
+        status: str,
+        message_id: str | None = None,
+        error: str | None = None
+    ) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE messages SET status = ?, message_id = ?, error = ?, '
+                'updated_at = ? WHERE campaign_id = ? AND name = ? AND email = ?',
+                (status, message_id, error, time.time(), campaign, *message_key(user))
+            )
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,16 @@
+""" Progress counting for the runs without a progressbar. """
+
+
+
+class SilentProgress:
+    """ Stand-in for the progressbar IntVar, that only counts, ex. for
+    the campaigns whose owner reports the progress itself, or benchmarks.
+    The runs take any object with the same `get` and `set` methods. """
+    def __init__(self) -> None:
+        self.value = 0
+
+    def get(self) -> int:
+        return self.value
+
+    def set(self, value: int) -> None:
+        self.value = value
@@ -0,0 +1,63 @@
+""" Rate limiting of the Gmail API calls. """
+import threading
+import time
+
+
+
+# Gmail API per user rate limit, in quota units per second, and the
+# cost of a messages.send call. See
+# https://developers.google.com/gmail/api/reference/quota
+GMAIL_QUOTA_UNITS_PER_SECOND = 250
+SEND_QUOTA_UNITS = 100
+
+
+class TokenBucket:
+    """ Thread-safe token bucket. Tokens are added at `rate` per second,
+    up to `capacity`. Taking more tokens than the bucket has puts it in
+    debt, so later callers wait until it is paid off. That way a cost
+    larger than the capacity, ex. a whole batch request, can still be taken.
+
+    Args:
+        rate: Tokens added per second.
+        capacity: The maximum number of tokens. Defaults to `rate`,
+            allowing a burst of one second.
+    """
+    def __init__(self, rate: float, capacity: float | None = None) -> None:
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_gmail(cls) -> 'TokenBucket':
+        """ Return a bucket of Gmail quota units for a single user. """
+        return cls(GMAIL_QUOTA_UNITS_PER_SECOND)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity,
+            self._tokens + (now - self._last) * self.rate
+        )
+        self._last = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """ Take `tokens` if the bucket isn't in debt.
+
+        Returns:
+            0 if the tokens were taken, otherwise the seconds to wait
+            before trying again.
+        """
+        with self._lock:
+            self._refill()
+            needed = min(tokens, self.capacity)
+            if self._tokens >= needed:
+                self._tokens -= tokens
+                return 0.0
+            return (needed - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1) -> None:
+        """ Block until `tokens` are taken. """
+        while (wait := self.try_acquire(tokens)) > 0:
+            time.sleep(wait)
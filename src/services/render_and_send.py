@@ -0,0 +1,140 @@
+""" Creating the certificates and emailing them in one go.
+
+Creating certificates is cpu bound and sending them is network bound, so
+instead of creating every certificate before the first email is sent, each
+certificate is handed to the emailing as soon as it's saved.
+"""
+import queue
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Iterator
+
+from services.certificate_creation import CertificateCreator
+from services.constants import *
+from services.email_campaign import EmailCampaign
+from services.outbox import message_key
+from services.sharded_campaign import ShardedCampaign
+
+if TYPE_CHECKING:
+    import ttkbootstrap as ttk
+
+
+
+class RenderAndSend:
+    """ Creates certificates with the `creator` and emails each one with
+    the `campaign` once it's saved. The certificates are passed through a
+    bounded queue, so when sending falls behind, the creation waits for it
+    instead of piling up certificates.
+
+    Args:
+        creator: Creates the certificates. It must save them in its output
+            folder, not hand them to a sink.
+        campaign: Emails the certificates.
+        max_queued: The number of saved certificates that can wait to be
+            sent before the creation waits.
+    """
+    def __init__(
+        self,
+        creator: CertificateCreator,
+        campaign: EmailCampaign | ShardedCampaign,
+        max_queued: int = 64
+    ) -> None:
+        if creator.sink is not None:
+            raise ValueError('The certificates must be saved to be emailed.')
+
+        self.creator = creator
+        self.campaign = campaign
+        self.max_queued = max_queued
+
+    def run(
+        self,
+        progress_var: 'ttk.IntVar',
+        log: Callable[[bool, int], Any],
+        user_list: list[User],
+        cleanup_func: Callable[[], Any] | None = None
+    ) -> None:
+        """ Creates and emails the certificate of each user in the `user_list`.
+        Users that were already emailed in the campaign aren't created again.
+
+        Args:
+            progress_var: An IntVar that represents the amount of certificates
+                created plus the amount of emails sent. Its maximum should be
+                `steps(user_list)`.
+            log: Called with whether the email was sent and the user's index.
+                Users whose certificate couldn't be created are logged as
+                not sent.
+            user_list: The list of Users.
+            cleanup_func: If given, run after all the emails have been sent.
+        """
+        lock = threading.Lock()
+        saved: queue.Queue[tuple[User, Path | None] | None] = queue.Queue(self.max_queued)
+        errors: list[BaseException] = []
+
+        self.campaign.enqueue(user_list)
+        sent = self.campaign.sent_keys()
+        to_create = [user for user in user_list if message_key(user) not in sent]
+
+        sender = threading.Thread(
+            target=self._send,
+            args=(saved, progress_var, log, lock, errors),
+            daemon=True
+        )
+        sender.start()
+
+        # Emailed users only go through the campaign, which reports them.
+        for user in user_list:
+            if message_key(user) in sent:
+                saved.put((user, None))
+
+        self.creator.saved_func = lambda user, path: saved.put((user, path))
+        try:
+            self.creator.create_certificates_from_list(lock, progress_var, to_create)
+        finally:
+            self.creator.saved_func = None
+            saved.put(None)
+        sender.join()
+
+        if errors:
+            raise errors[0]
+
+        # Users without a certificate never reach the campaign, so
+        # they're reported here, to finish the progress of each user.
+        for user in self.creator.failed:
+            with lock:
+                log(False, int(user[0]))
+                progress_var.set(progress_var.get() + 1)
+
+        if cleanup_func is not None:
+            cleanup_func()
+
+    def steps(self, user_list: list[User]) -> int:
+        """ Return the progress steps of running the `user_list`. """
+        sent = self.campaign.sent_keys()
+        return len(user_list) + sum(message_key(user) not in sent for user in user_list)
+
+    def _send(
+        self,
+        saved: queue.Queue[tuple[User, Path | None] | None],
+        progress_var: 'ttk.IntVar',
+        log: Callable[[bool, int], Any],
+        lock: threading.Lock,
+        errors: list[BaseException]
+    ) -> None:
+        try:
+            self.campaign.send_entries(
+                progress_var, log, self._entries(saved), lock=lock
+            )
+        except BaseException as error:
+            # Raised again by `run`, once the creation is done.
+            errors.append(error)
+            # Keep taking the saved certificates, so the
+            # creation isn't blocked by the full queue.
+            for _ in self._entries(saved):
+                pass
+
+    @staticmethod
+    def _entries(
+        saved: queue.Queue[tuple[User, Path | None] | None]
+    ) -> Iterator[tuple[User, Path | None]]:
+        while (entry := saved.get()) is not None:
+            yield entry
@@ -0,0 +1,131 @@
+""" Retrying of failed email sends. """
+import random
+import re
+import smtplib
+import socket
+import time
+from email.utils import parsedate_to_datetime
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+
+# Statuses worth retrying. See
+# https://developers.google.com/gmail/api/guides/handle-errors
+TRANSIENT_STATUSES = {408, 429, 500, 502, 503, 504}
+# A 403 is only transient if it's a rate limit.
+TRANSIENT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'backendError'}
+# A 403 or 429 with these reasons means the account is out of quota.
+QUOTA_REASONS = {
+    'rateLimitExceeded',
+    'userRateLimitExceeded',
+    'dailyLimitExceeded',
+    'quotaExceeded'
+}
+# Network errors, the request never got an answer.
+TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    socket.timeout,
+    httplib2.ServerNotFoundError,
+    smtplib.SMTPServerDisconnected
+)
+
+
+def _error_reasons(error: HttpError) -> set[str]:
+    details = error.error_details
+    if not isinstance(details, list):
+        return set()
+    return {
+        detail.get('reason') for detail in details
+        if isinstance(detail, dict)
+    }
+
+
+def is_quota_error(error: Exception) -> bool:
+    """ Return whether the send failed because the account ran out of
+    quota, so another account could still send the message. """
+    if isinstance(error, HttpError):
+        if error.status_code == 429:
+            return True
+        return error.status_code == 403 and bool(_error_reasons(error) & QUOTA_REASONS)
+    if isinstance(error, smtplib.SMTPResponseException):
+        reply = error.smtp_error
+        if isinstance(reply, bytes):
+            reply = reply.decode(errors='replace')
+        return re.search(r'(?i)quota|rate limit|limit exceeded', reply) is not None
+    return False
+
+
+def retry_after(error: Exception) -> float | None:
+    """ Return the seconds the `Retry-After` header of the error's
+    response asks to wait, or None if it has none. """
+    if not isinstance(error, HttpError):
+        return None
+
+    value = error.resp.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """ Decides which failed sends are retried, and when.
+
+    Transient failures are retried after a jittered exponential backoff
+    ("full jitter": a random delay between 0 and `base_delay * 2 ** attempt`,
+    capped at `max_delay`), so threads that failed together don't retry
+    together. A `Retry-After` header is honoured when the server sends one.
+
+    Args:
+        max_attempts: The attempts of a send, including the first one.
+        base_delay: The backoff of the first retry, in seconds.
+        max_delay: The maximum backoff, in seconds.
+    """
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 64.0
+    ) -> None:
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @staticmethod
+    def is_transient(error: Exception) -> bool:
+        """ Return whether the send might succeed if retried. """
+        if isinstance(error, HttpError):
+            if error.status_code in TRANSIENT_STATUSES:
+                return True
+            return error.status_code == 403 \
+                and bool(_error_reasons(error) & TRANSIENT_REASONS)
+        # SMTP replies in the 4xx range are temporary failures.
+        if isinstance(error, smtplib.SMTPResponseException):
+            return 400 <= error.smtp_code < 500
+        if isinstance(error, smtplib.SMTPRecipientsRefused):
+            return all(400 <= code < 500 for code, _ in error.recipients.values())
+        return isinstance(error, TRANSIENT_ERRORS)
+
+    def should_retry(self, error: Exception, attempt: int) -> bool:
+        """ Return whether a send that failed on its `attempt`th
+        attempt, counting from 1, should be retried. """
+        return attempt < self.max_attempts and self.is_transient(error)
+
+    def delay(self, error: Exception, attempt: int) -> float:
+        """ Return the seconds to wait before retrying a send that
+        failed on its `attempt`th attempt, counting from 1. """
+        backoff = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        )
+        if (wait := retry_after(error)) is not None:
+            return max(wait, backoff)
+        return backoff
@@ -0,0 +1,265 @@
+""" Sending a campaign from several accounts.
+
+The daily sending limit of a single account caps how fast a large list can
+go out, so the list is sharded over several accounts instead. Each account
+sends its shard as its own `EmailCampaign`, with its own transport, rate
+limiter and outbox state. Users whose account ran out of quota, or whose
+send kept failing, are moved to the accounts that still have quota.
+"""
+import hashlib
+import queue
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator
+
+from services.campaign_metrics import CampaignMetrics
+from services.constants import *
+from services.email_campaign import EmailCampaign
+from services.outbox import message_key
+from services.progress import SilentProgress
+from services.retrying import is_quota_error
+
+if TYPE_CHECKING:
+    import ttkbootstrap as ttk
+
+Entry = tuple[User, Path | None]
+
+
+
+def shard_of(email: str, shards: int) -> int:
+    """ Return the shard of the `email`. An address always lands in the
+    same shard, so sending the campaign again uses the same accounts. """
+    digest = hashlib.sha256(email.strip().lower().encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % shards
+
+
+class ShardedCampaign:
+    """ Sends a campaign from several accounts, each sending a shard of
+    the users. Has the same interface as `EmailCampaign`, so it can be
+    used in its place.
+
+    Args:
+        campaigns: The campaign of each account. They should have the same
+            subject, body and attachments, and each is sent from its
+            account's address with its account's transport. The outbox
+            state of the accounts is kept apart, since the id of a
+            campaign depends on its sender.
+        metrics_folder: If given, the metrics of every run of the campaign
+            are saved in it as json.
+        log_func: Log func with the signature of `Logger.log`.
+
+    Attributes:
+        metrics (CampaignMetrics): The delivery metrics of the current, or
+            last, run, of all the accounts.
+        failed (dict[str, Exception]): The index of each user whose email
+            failed from every account it was tried from, and the error.
+    """
+    def __init__(
+        self,
+        campaigns: list[EmailCampaign],
+        metrics_folder: Path | None = None,
+        log_func: Callable[..., Any] | None = None
+    ) -> None:
+        if not campaigns:
+            raise ValueError('A sharded campaign needs at least one account.')
+
+        self.campaigns = campaigns
+        self.metrics_folder = metrics_folder
+        self.log_func = log_func
+        self.campaign_id = hashlib.sha256(
+            ''.join(campaign.campaign_id for campaign in campaigns).encode()
+        ).hexdigest()[:16]
+        self.metrics = CampaignMetrics(self.campaign_id)
+        self.failed: dict[str, Exception] = {}
+
+    def send_certificates(
+        self,
+        progress_var: 'ttk.IntVar',
+        log: Callable[[bool, int], Any],
+        userlist: list[User],
+        certificate_paths: list[Path],
+        cleanup_func: Callable[[], Any] | None = None
+    ) -> None:
+        """ See `EmailCampaign.send_certificates`. """
+        self.enqueue(userlist)
+        self.send_entries(
+            progress_var,
+            log,
+            zip(userlist, certificate_paths),
+            cleanup_func
+        )
+
+    def send_entries(
+        self,
+        progress_var: 'ttk.IntVar',
+        log: Callable[[bool, int], Any],
+        entries: Iterable[Entry],
+        cleanup_func: Callable[[], Any] | None = None,
+        lock: 'threading.Lock | None' = None
+    ) -> None:
+        """ Sends each user their certificate from the account of their
+        shard, as the entries come in. The users that couldn't be sent
+        because their account ran out of quota, or because of errors that
+        might not happen from another account, are then sent from the
+        accounts they weren't tried from yet, until none is left.
+        See `EmailCampaign.send_entries`.
+        """
+        self.metrics = CampaignMetrics(self.campaign_id)
+        self.failed = {}
+        lock = lock or threading.Lock()
+
+        def report(user: User, error: Exception | None) -> None:
+            with lock:
+                if error is not None:
+                    self.failed[user[0]] = error
+                log(error is None, int(user[0]))
+                progress_var.set(progress_var.get() + 1)
+
+        sent = self.sent_keys()
+        exhausted: set[int] = set()
+        tried: dict[str, set[int]] = {}
+
+        def first_round() -> Iterator[tuple[int, Entry]]:
+            for user, path in entries:
+                if message_key(user) in sent:
+                    self.metrics.record_skipped()
+                    report(user, None)
+                    continue
+                account = shard_of(user[2], len(self.campaigns))
+                tried[user[0]] = {account}
+                yield account, (user, path)
+
+        shards: Iterable[tuple[int, Entry]] = first_round()
+        while True:
+            deferred = self._send_round(shards, report)
+            if not deferred:
+                break
+
+            exhausted.update(
+                account for account, _, error in deferred if is_quota_error(error)
+            )
+            moved: list[tuple[int, Entry]] = []
+            load = [0] * len(self.campaigns)
+            for _, entry, error in deferred:
+                user = entry[0]
+                accounts = [
+                    account for account in range(len(self.campaigns))
+                    if account not in exhausted and account not in tried[user[0]]
+                ]
+                if not accounts:
+                    report(user, error)
+                    continue
+                account = min(accounts, key=load.__getitem__)
+                load[account] += 1
+                tried[user[0]].add(account)
+                self.campaigns[account].enqueue([user])
+                moved.append((account, entry))
+
+            if moved and self.log_func is not None:
+                self.log_func(
+                    'Moving Emails',
+                    f'{len(moved)} email(s) to the accounts with quota left',
+                    LogLevel.INFO
+                )
+            shards = moved
+
+        self.metrics.finish()
+        if self.metrics_folder is not None:
+            self.metrics.save(self.metrics_folder)
+
+        if cleanup_func:
+            cleanup_func()
+
+    def enqueue(self, userlist: list[User]) -> None:
+        """ Queue the users in the outbox of their account. """
+        shards: list[list[User]] = [[] for _ in self.campaigns]
+        for user in userlist:
+            shards[shard_of(user[2], len(self.campaigns))].append(user)
+        for campaign, users in zip(self.campaigns, shards):
+            if users:
+                campaign.enqueue(users)
+
+    def sent_keys(self) -> set[tuple[str, str]]:
+        """ Return the `message_key` of the users already emailed
+        from any account. """
+        return set().union(*(campaign.sent_keys() for campaign in self.campaigns))
+
+    def interrupted(self) -> int:
+        """ Return the number of messages whose send was interrupted,
+        from any account. """
+        return sum(campaign.interrupted() for campaign in self.campaigns)
+
+    def _send_round(
+        self,
+        shards: Iterable[tuple[int, Entry]],
+        report: Callable[[User, Exception | None], None]
+    ) -> list[tuple[int, Entry, Exception]]:
+        """ Send each entry from its account, every account from its own
+        thread, and report the users that were sent or failed for good.
+
+        Returns:
+            The account, entry and error of each user to try from another
+            account.
+        """
+        deferred: list[tuple[int, Entry, Exception]] = []
+        errors: list[BaseException] = []
+        deferred_lock = threading.Lock()
+        queues: list[queue.Queue[Entry | None]] = [
+            queue.Queue(64) for _ in self.campaigns
+        ]
+
+        def send(account: int) -> None:
+            campaign = self.campaigns[account]
+            users: dict[int, Entry] = {}
+            entries = self._entries(queues[account], users)
+
+            # Called by the campaign after recording the error in `failed`.
+            def shard_log(success: bool, index: int) -> None:
+                entry = users.pop(index)
+                error = campaign.failed.get(entry[0][0])
+                if success or error is None:
+                    report(entry[0], None)
+                elif is_quota_error(error) or campaign.retry_policy.is_transient(error):
+                    with deferred_lock:
+                        deferred.append((account, entry, error))
+                else:
+                    report(entry[0], error)
+
+            try:
+                # The sharded campaign reports the progress itself.
+                campaign.send_entries(
+                    SilentProgress(), shard_log, entries, metrics=self.metrics)
+            except BaseException as error:
+                errors.append(error)
+                # Keep taking the entries, so the dispatch isn't
+                # blocked by the full queue.
+                for _ in entries:
+                    pass
+
+        threads = [
+            threading.Thread(target=send, args=(account,), daemon=True)
+            for account in range(len(self.campaigns))
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for account, entry in shards:
+                queues[account].put(entry)
+        finally:
+            for account_queue in queues:
+                account_queue.put(None)
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+        return deferred
+
+    @staticmethod
+    def _entries(
+        account_queue: queue.Queue[Entry | None],
+        users: dict[int, Entry]
+    ) -> Iterator[Entry]:
+        while (entry := account_queue.get()) is not None:
+            users[int(entry[0][0])] = entry
+            yield entry
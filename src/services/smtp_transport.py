@@ -0,0 +1,378 @@
+""" Email delivery through an SMTP relay.
+
+`SmtpTransport` keeps a pool of authenticated connections and sends many
+messages over each of them. When the server supports PIPELINING (RFC 2920)
+the envelope commands of a message are sent in a single write, so a
+message costs two round trips instead of one per command.
+
+Addresses that aren't ASCII are sent with SMTPUTF8 (RFC 6531) when the
+server supports it. Otherwise their domain is IDNA encoded, and those whose
+local part isn't ASCII are refused, like the server would refuse them.
+
+To try it without a relay, run a local stand-in with aiosmtpd:
+
+    python -m aiosmtpd -n -l localhost:8025
+
+`src/transport_check.py` checks it, with and without PIPELINING, against
+a stand-in of its own.
+"""
+import queue
+import re
+import smtplib
+import ssl
+import threading
+from email.mime.multipart import MIMEMultipart
+from email.utils import getaddresses, make_msgid
+
+from services.email_transport import EmailTransport
+
+
+
+PLAIN = 'plain'
+STARTTLS = 'starttls'
+SSL = 'ssl'
+
+# The refusal of an address the server can't take without SMTPUTF8.
+_NEEDS_SMTPUTF8 = (553, b'The server does not support non-ASCII addresses')
+
+
+class SmtpTransport(EmailTransport):
+    """ Sends messages through an SMTP server.
+
+    Args:
+        host: The host of the SMTP server.
+        port: The port of the SMTP server.
+        security: `STARTTLS` to upgrade the connection to TLS, `SSL` to
+            connect with TLS (usually port 465), `PLAIN` for neither.
+        username: The username to log in with, if the server needs it.
+        password: The password to log in with.
+        pool_size: The maximum number of open connections.
+        messages_per_connection: The connection is closed and opened
+            again after sending this many messages.
+        timeout: The timeout of the socket operations, in seconds.
+        ssl_context: The TLS settings. Defaults to verifying the server.
+    """
+
+    BATCH_LIMIT = 100
+    SEND_COST = 1
+
+    def __init__(
+        self,
+        host: str,
+        port: int = 587,
+        security: str = STARTTLS,
+        username: str | None = None,
+        password: str | None = None,
+        pool_size: int = 4,
+        messages_per_connection: int = 100,
+        timeout: float = 30,
+        ssl_context: ssl.SSLContext | None = None
+    ) -> None:
+        if security not in (PLAIN, STARTTLS, SSL):
+            raise ValueError(f'Unknown SMTP security: {security}')
+
+        self.host = host
+        self.port = port
+        self.security = security
+        self.username = username
+        self.password = password
+        self.pool_size = max(1, pool_size)
+        self.messages_per_connection = max(1, messages_per_connection)
+        self.timeout = timeout
+        self.ssl_context = ssl_context
+        self._init_pool()
+
+    def _init_pool(self) -> None:
+        self._idle: queue.LifoQueue[smtplib.SMTP] = queue.LifoQueue()
+        self._sent: dict[smtplib.SMTP, int] = {}
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # Connections and locks can't be pickled, ex. when the transport
+        # is passed to a process pool.
+        state = self.__dict__.copy()
+        for name in ('_idle', '_sent', '_slots', '_lock', 'ssl_context'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.ssl_context = None
+        self._init_pool()
+
+    def encode_message(self, msg: MIMEMultipart) -> dict:
+        if 'Message-ID' not in msg:
+            msg['Message-ID'] = make_msgid()
+
+        recipients = [
+            address for _, address in
+            getaddresses(msg.get_all('To', []) + msg.get_all('Cc', [])
+                + msg.get_all('Bcc', []))
+        ]
+        del msg['Bcc']
+
+        return {
+            'id': msg['Message-ID'],
+            'from': getaddresses([msg['From']])[0][1],
+            'to': recipients,
+            'data': _end_with_crlf(self.message_bytes(msg).getvalue())
+        }
+
+    def payload_size(self, message: dict) -> int:
+        return len(message['data'])
+
+    def send_message(self, message: dict) -> dict[str, str]:
+        """ Sends the provided message.
+
+        Args:
+            message: The message to send, as returned by `create_message`.
+
+        Returns:
+            The message's id and the recipients the server refused.
+
+        Raises:
+            smtplib.SMTPException: The server refused the message.
+        """
+        return self.send_message_batch([message], raise_errors=True)[0][0]
+
+    def send_message_batch(
+        self,
+        messages: list[dict],
+        batch_size: int = 50,
+        raise_errors: bool = False
+    ) -> list[tuple[dict[str, str] | None, Exception | None]]:
+        """ Sends the provided messages over a single connection.
+
+        Args:
+            messages: The messages to send.
+            batch_size: Unused, SMTP has no batch requests.
+            raise_errors: Raise the first error instead of returning it.
+
+        Returns:
+            For each message, in the same order, the message's id and the
+            recipients the server refused, or the exception that occured.
+        """
+        results = []
+        conn = None
+        self._slots.acquire()
+        try:
+            for message in messages:
+                conn, response, error = self._send_with_retry(conn, message)
+                if raise_errors and error is not None:
+                    raise error
+                results.append((response, error))
+        finally:
+            if conn is not None:
+                self._idle.put(conn)
+            self._slots.release()
+        return results
+
+    def _send_with_retry(
+        self,
+        conn: smtplib.SMTP | None,
+        message: dict
+    ) -> tuple[smtplib.SMTP | None, dict[str, str] | None, Exception | None]:
+        """ Send the message over `conn`, or a pooled connection if None.
+        A reused connection the server has closed in the meantime is
+        replaced once.
+
+        Returns:
+            The connection to send the next message over, and the
+            response or the exception that occured.
+        """
+        reused = conn is not None
+        for attempt in range(2):
+            try:
+                if conn is None:
+                    conn, reused = self._connection()
+                refused = self._send(conn, message)
+            except smtplib.SMTPServerDisconnected as error:
+                self._discard(conn)
+                conn = None
+                if reused and attempt == 0:
+                    continue
+                return None, None, error
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as error:
+                # The connection is still usable after a refusal.
+                if conn is not None:
+                    self._reset(conn)
+                return conn, None, error
+            except (smtplib.SMTPException, OSError) as error:
+                self._discard(conn)
+                return None, None, error
+            except BaseException:
+                # The connection is in an unknown state, don't pool it.
+                self._discard(conn)
+                raise
+            return self._count(conn), {'id': message['id'], 'refused': refused}, None
+
+    def close(self) -> None:
+        """ Close the idle connections. """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn, quit=True)
+
+    def _connection(self) -> tuple[smtplib.SMTP, bool]:
+        """ Return an idle connection, or a new one if there is none,
+        and whether it was reused. """
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+
+    def _connect(self) -> smtplib.SMTP:
+        context = self.ssl_context or ssl.create_default_context()
+        if self.security == SSL:
+            conn = smtplib.SMTP_SSL(
+                self.host, self.port, timeout=self.timeout, context=context
+            )
+        else:
+            conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+        try:
+            conn.ehlo()
+            if self.security == STARTTLS:
+                conn.starttls(context=context)
+                conn.ehlo()
+            if self.username:
+                conn.login(self.username, self.password or '')
+        except BaseException:
+            conn.close()
+            raise
+
+        with self._lock:
+            self._sent[conn] = 0
+        return conn
+
+    def _count(self, conn: smtplib.SMTP) -> smtplib.SMTP | None:
+        """ Count a message sent over `conn`. Returns the connection,
+        or None if it was closed for having sent enough messages. """
+        with self._lock:
+            self._sent[conn] += 1
+            worn_out = self._sent[conn] >= self.messages_per_connection
+        if worn_out:
+            self._discard(conn, quit=True)
+            return None
+        return conn
+
+    def _reset(self, conn: smtplib.SMTP) -> None:
+        try:
+            conn.rset()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    def _discard(self, conn: smtplib.SMTP | None, quit: bool = False) -> None:
+        if conn is None:
+            return
+        with self._lock:
+            self._sent.pop(conn, None)
+        try:
+            if quit:
+                conn.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def _send(self, conn: smtplib.SMTP, message: dict) -> dict[str, tuple[int, bytes]]:
+        """ Send the message over `conn`.
+
+        Returns:
+            The recipients the server refused, with its reply to each.
+        """
+        smtputf8 = conn.has_extn('smtputf8')
+        sender = _envelope_address(message['from'], smtputf8)
+        if sender is None:
+            raise smtplib.SMTPSenderRefused(*_NEEDS_SMTPUTF8, message['from'])
+
+        # The recipient of each address of the envelope.
+        recipients: dict[str, str] = {}
+        refused: dict[str, tuple[int, bytes]] = {}
+        for address in message['to']:
+            if (envelope := _envelope_address(address, smtputf8)) is None:
+                refused[address] = _NEEDS_SMTPUTF8
+            else:
+                recipients[envelope] = address
+        if not recipients:
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        mail_options = [] if (sender + ''.join(recipients)).isascii() else ['SMTPUTF8']
+
+        if not conn.has_extn('pipelining'):
+            try:
+                server_refused = conn.sendmail(
+                    sender, list(recipients), message['data'], mail_options)
+            except smtplib.SMTPRecipientsRefused as error:
+                refused.update((recipients[address], reply)
+                    for address, reply in error.recipients.items())
+                raise smtplib.SMTPRecipientsRefused(refused) from error
+            refused.update((recipients[address], reply)
+                for address, reply in server_refused.items())
+            return refused
+
+        # Send the envelope in one write, then read the replies in order.
+        commands = [f'MAIL FROM:<{sender}>' + ''.join(f' {option}' for option in mail_options)]
+        commands += [f'RCPT TO:<{address}>' for address in recipients]
+        commands.append('DATA')
+        conn.send(''.join(command + '\r\n' for command in commands).encode('utf-8'))
+
+        mail_reply = conn.getreply()
+        rcpt_replies = [conn.getreply() for _ in recipients]
+        data_reply = conn.getreply()
+
+        refused.update(
+            (recipient, reply)
+            for recipient, reply in zip(recipients.values(), rcpt_replies)
+            if reply[0] not in (250, 251)
+        )
+
+        if data_reply[0] == 354 and (mail_reply[0] != 250
+                or len(refused) == len(message['to'])):
+            # The server took DATA even though the message can't be
+            # delivered, end it without content.
+            conn.send(b'.\r\n')
+            conn.getreply()
+            data_reply = (554, b'No valid recipients')
+
+        if mail_reply[0] != 250:
+            raise smtplib.SMTPSenderRefused(*mail_reply, message['from'])
+        if len(refused) == len(message['to']):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if data_reply[0] != 354:
+            raise smtplib.SMTPDataError(*data_reply)
+
+        conn.send(_quote_periods(message['data']) + b'.\r\n')
+        code, reply = conn.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, reply)
+        return refused
+
+
+def _envelope_address(address: str, smtputf8: bool) -> str | None:
+    """ Return the `address` as it's sent in the envelope, or None if the
+    server can't take it, because its local part isn't ASCII and the server
+    doesn't support SMTPUTF8. Without SMTPUTF8 the domain is IDNA encoded. """
+    if address.isascii() or smtputf8:
+        return address
+
+    local, _, domain = address.rpartition('@')
+    if not local.isascii():
+        return None
+    try:
+        return f'{local}@{domain.encode("idna").decode("ascii")}'
+    except UnicodeError:
+        return None
+
+
+def _end_with_crlf(data: bytes) -> bytes:
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return data
+
+
+def _quote_periods(data: bytes) -> bytes:
+    return re.sub(rb'(?m)^\.', b'..', data)
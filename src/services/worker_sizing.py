@@ -0,0 +1,172 @@
+""" Sizing of the certificate creation process pool.
+
+The pool size is limited both by the cpus the process may run on and by
+the memory that is available for the workers. Cpu quotas and memory limits
+of cgroups are honoured, so containers get a pool that fits them.
+"""
+import ctypes
+import math
+import os
+import sys
+from pathlib import Path
+
+from PIL import Image
+
+
+
+# Rough footprint of an idle pool worker (interpreter, PIL and the modules
+# imported by the main module, which spawned workers import again).
+WORKER_BASE_MEMORY = 96 * 1024 ** 2
+# A worker holds the template, its copy and the png encoder's buffers.
+IMAGE_COPIES_PER_WORKER = 3
+# Part of the available memory the pool is allowed to use.
+MEMORY_HEADROOM = 0.8
+
+CGROUP = Path('/sys/fs/cgroup')
+
+
+def _read_cgroup_file(*parts: str) -> str | None:
+    try:
+        return CGROUP.joinpath(*parts).read_text().strip()
+    except (OSError, ValueError):
+        return None
+
+
+def cgroup_cpu_limit() -> float | None:
+    """ Return the cpu quota of the process' cgroup in cpus,
+    or None if there is no quota. """
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    if (cpu_max := _read_cgroup_file('cpu.max')) is not None:
+        quota, _, period = cpu_max.partition(' ')
+        if quota != 'max' and period:
+            return int(quota) / int(period)
+        return None
+
+    # cgroup v1
+    quota = _read_cgroup_file('cpu', 'cpu.cfs_quota_us')
+    period = _read_cgroup_file('cpu', 'cpu.cfs_period_us')
+    if quota is not None and period is not None and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def available_cpus() -> tuple[int, str]:
+    """ Return the number of cpus the process can use and where
+    that number comes from. """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+        reason = f'{cpus} cpus in the affinity mask'
+    else:
+        cpus = os.cpu_count() or 1
+        reason = f'{cpus} cpus'
+
+    if (limit := cgroup_cpu_limit()) is not None and limit < cpus:
+        cpus = max(1, math.floor(limit))
+        reason = f'cgroup cpu quota of {limit:g} cpus'
+
+    return cpus, reason
+
+
+def cgroup_memory_limit() -> int | None:
+    """ Return the memory that is left in the process' cgroup
+    in bytes, or None if there is no limit. """
+    # cgroup v2
+    limit = _read_cgroup_file('memory.max')
+    usage = _read_cgroup_file('memory.current')
+    if limit is None:
+        # cgroup v1, where no limit is reported as a huge number
+        limit = _read_cgroup_file('memory', 'memory.limit_in_bytes')
+        usage = _read_cgroup_file('memory', 'memory.usage_in_bytes')
+
+    if limit is None or not limit.isdigit() or int(limit) >= 2 ** 60:
+        return None
+    return int(limit) - int(usage or 0)
+
+
+def system_available_memory() -> int | None:
+    """ Return the memory the system can give to new processes
+    in bytes, or None if it can't be determined. """
+    if sys.platform == 'win32':
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [
+                ('dwLength', ctypes.c_ulong),
+                ('dwMemoryLoad', ctypes.c_ulong),
+                ('ullTotalPhys', ctypes.c_ulonglong),
+                ('ullAvailPhys', ctypes.c_ulonglong),
+                ('ullTotalPageFile', ctypes.c_ulonglong),
+                ('ullAvailPageFile', ctypes.c_ulonglong),
+                ('ullTotalVirtual', ctypes.c_ulonglong),
+                ('ullAvailVirtual', ctypes.c_ulonglong),
+                ('ullAvailExtendedVirtual', ctypes.c_ulonglong),
+            ]
+
+        status = MemoryStatus()
+        status.dwLength = ctypes.sizeof(MemoryStatus)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullAvailPhys
+        return None
+
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def available_memory() -> int | None:
+    """ Return the memory available to the process in bytes,
+    or None if it can't be determined. """
+    sizes = [
+        size for size in (system_available_memory(), cgroup_memory_limit())
+        if size is not None
+    ]
+    return min(sizes) if sizes else None
+
+
+def estimate_worker_memory(image: Image.Image, threads: bool = False) -> int:
+    """ Return the estimated peak memory of a pool worker
+    that creates certificates from `image`, in bytes.
+
+    Thread workers share the interpreter and the template,
+    so they only need memory for their copies of it.
+    """
+    image_size = image.width * image.height * len(image.getbands())
+    if threads:
+        return (IMAGE_COPIES_PER_WORKER - 1) * image_size
+    return WORKER_BASE_MEMORY + IMAGE_COPIES_PER_WORKER * image_size
+
+
+def choose_num_of_processes(
+    image: Image.Image,
+    threads: bool = False
+) -> tuple[int, str]:
+    """ Return the number of pool workers to create certificates from
+    `image` with, and the reasoning behind it. If `threads` is true,
+    the workers are threads instead of processes.
+
+    One cpu is left to the main process, but there is always at least one
+    worker, even if that one doesn't fit in the available memory.
+    """
+    cpus, cpu_reason = available_cpus()
+    cpu_workers = max(1, cpus - 1)
+    reason = f'{cpu_reason}, {cpu_workers} worker(s) by cpu'
+
+    worker_memory = estimate_worker_memory(image, threads)
+    memory = available_memory()
+    if memory is None:
+        return cpu_workers, f'{reason}, available memory unknown'
+
+    memory_workers = max(1, int(memory * MEMORY_HEADROOM) // worker_memory)
+    reason += (
+        f', {memory / 1024 ** 2:.0f} MiB available at '
+        f'~{worker_memory / 1024 ** 2:.0f} MiB per worker, '
+        f'{memory_workers} worker(s) by memory'
+    )
+    return min(cpu_workers, memory_workers), reason
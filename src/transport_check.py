@@ -0,0 +1,331 @@
+""" Check of the email transports against local stand-ins.
+
+Sends messages through the `SmtpTransport` to a local SMTP server, with
+PIPELINING advertised and not, to addresses that aren't ASCII with
+SMTPUTF8 advertised and not, and through the batch requests of the
+`EmailSender` to a local stand-in of the Gmail batch endpoint. Nothing
+leaves the machine and no account is needed. Prints the result of each
+check as a json line, and exits with 1 if any of them failed.
+
+    python src/transport_check.py
+"""
+import base64
+import json
+import re
+import socketserver
+import sys
+import threading
+from email import message_from_bytes
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from smtplib import SMTPRecipientsRefused
+
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.errors import HttpError
+
+from services.email_sender import EmailSender
+from services.smtp_transport import PLAIN, SmtpTransport
+
+
+
+SENDER = 'sender@example.com'
+# Recipients starting with this are refused by the stand-ins.
+REFUSED = 'refused'
+
+
+class _SmtpServer(socketserver.ThreadingTCPServer):
+    """ Local SMTP server that keeps the messages it receives.
+
+    Args:
+        pipelining: Whether to advertise PIPELINING.
+        smtputf8: Whether to advertise SMTPUTF8. Without it, addresses
+            that aren't ASCII are refused.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, pipelining: bool, smtputf8: bool = False) -> None:
+        super().__init__(('127.0.0.1', 0), _SmtpHandler)
+        self.pipelining = pipelining
+        self.smtputf8 = smtputf8
+        self.lock = threading.Lock()
+        self.messages: list[tuple[list[str], bytes]] = []
+        # The envelopes whose commands came in a single write.
+        self.pipelined = 0
+        self.connections = 0
+
+
+class _SmtpHandler(socketserver.BaseRequestHandler):
+    server: _SmtpServer
+
+    def handle(self) -> None:
+        self.buffer = b''
+        recipients: list[str] = []
+        # Whether the current envelope was started with SMTPUTF8.
+        utf8 = False
+        with self.server.lock:
+            self.server.connections += 1
+        self.reply('220 localhost ready')
+
+        while (line := self.read_line()) is not None:
+            command = line[:4].upper()
+            if command == 'EHLO':
+                extensions = ['localhost', '8BITMIME']
+                if self.server.pipelining:
+                    extensions.append('PIPELINING')
+                if self.server.smtputf8:
+                    extensions.append('SMTPUTF8')
+                self.reply(*(f'250-{extension}' for extension in extensions[:-1]),
+                    f'250 {extensions[-1]}')
+            elif command == 'MAIL':
+                recipients = []
+                if b'\r\n' in self.buffer:
+                    with self.server.lock:
+                        self.server.pipelined += 1
+                utf8 = self.server.smtputf8 and line.upper().endswith(' SMTPUTF8')
+                if not line.isascii() and not utf8:
+                    self.reply('553 Non-ASCII address without SMTPUTF8')
+                else:
+                    self.reply('250 OK')
+            elif command == 'RCPT':
+                address = line.partition('<')[2].rstrip('>')
+                if address.startswith(REFUSED):
+                    self.reply('550 No such user')
+                elif not address.isascii() and not utf8:
+                    self.reply('553 Non-ASCII address without SMTPUTF8')
+                else:
+                    recipients.append(address)
+                    self.reply('250 OK')
+            elif command == 'DATA':
+                if not recipients:
+                    self.reply('554 No valid recipients')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = self.read_data()
+                with self.server.lock:
+                    self.server.messages.append((recipients, data))
+                self.reply('250 OK')
+            elif command in ('RSET', 'NOOP', 'HELO'):
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+    def reply(self, *lines: str) -> None:
+        self.request.sendall(''.join(line + '\r\n' for line in lines).encode())
+
+    def read_line(self) -> str | None:
+        while b'\r\n' not in self.buffer:
+            if not (chunk := self.request.recv(65536)):
+                return None
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(b'\r\n', 1)
+        return line.decode()
+
+    def read_data(self) -> bytes:
+        lines = []
+        while (line := self.read_line()) != '.':
+            if line is None:
+                break
+            # Undo the dot-stuffing of the client.
+            lines.append(line[1:] if line.startswith('.') else line)
+        return ''.join(line + '\r\n' for line in lines).encode()
+
+
+class _BatchHandler(BaseHTTPRequestHandler):
+    """ Stand-in for the Gmail batch endpoint. Every message gets an id,
+    except the ones to refused recipients, that get a 429. """
+    requests = 0
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        boundary = self.headers.get_param('boundary')
+        type(self).requests += 1
+
+        responses = []
+        for part in body.split(f'--{boundary}')[1:-1]:
+            content_id = re.search(r'Content-ID: <([^>]+)>', part).group(1)
+            # Ends with the request id, the index of the message.
+            index = content_id.rpartition('+')[2].strip()
+            request = json.loads(part[part.index('{'):part.rindex('}') + 1])
+            message = message_from_bytes(base64.urlsafe_b64decode(request['raw']))
+            if message['To'].startswith(REFUSED):
+                status, payload = '429 Too Many Requests', \
+                    {'error': {'code': 429, 'message': 'Rate limit exceeded'}}
+            else:
+                status, payload = '200 OK', {'id': f'id-{index}'}
+            responses.append(
+                f'--batch_response\r\nContent-Type: application/http\r\n'
+                f'Content-ID: <response-{content_id}>\r\n\r\n'
+                f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n\r\n'
+                f'{json.dumps(payload)}\r\n'
+            )
+
+        data = (''.join(responses) + '--batch_response--\r\n').encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/mixed; boundary=batch_response')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def _recipients(count: int) -> list[str]:
+    """ Return `count` recipients, the second of which is refused. """
+    return [
+        f'{REFUSED}{i}@example.com' if i == 1 else f'user{i}@example.com'
+        for i in range(count)
+    ]
+
+
+def check_smtp(pipelining: bool, count: int = 6) -> dict:
+    """ Send `count` messages to a local SMTP server, over connections
+    of up to 4 messages. """
+    server = _SmtpServer(pipelining)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    transport = SmtpTransport(
+        '127.0.0.1',
+        server.server_address[1],
+        security=PLAIN,
+        messages_per_connection=4
+    )
+
+    recipients = _recipients(count)
+    messages = [
+        # The leading dots check the dot-stuffing of the data.
+        transport.create_message(SENDER, to, 'Check', msg_plain='.\n..dots\n.')
+        for to in recipients
+    ]
+    results = transport.send_message_batch(messages)
+    transport.close()
+    server.shutdown()
+    server.server_close()
+
+    expected = {
+        to: message['data'] for to, message in zip(recipients, messages)
+        if not to.startswith(REFUSED)
+    }
+    received = {to[0]: data for to, data in server.messages}
+    refused = [
+        to for to, (_, error) in zip(recipients, results)
+        if isinstance(error, SMTPRecipientsRefused)
+    ]
+    return {
+        'check': 'smtp',
+        'pipelining': pipelining,
+        'ok': received == expected
+            and refused == [to for to in recipients if to.startswith(REFUSED)]
+            and server.pipelined == (count if pipelining else 0),
+        'sent': len(received),
+        'refused': len(refused),
+        'pipelined': server.pipelined
+    }
+
+
+def check_smtp_utf8(pipelining: bool, smtputf8: bool) -> dict:
+    """ Send messages to addresses that aren't ASCII over a single
+    connection. Without SMTPUTF8, the domains are sent IDNA encoded and
+    the local parts that aren't ASCII are refused, without losing the
+    connection. """
+    server = _SmtpServer(pipelining, smtputf8)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    transport = SmtpTransport('127.0.0.1', server.server_address[1], security=PLAIN)
+
+    recipients = [
+        'user0@example.com',
+        'üser1@example.com',
+        'user2@bücher.example',
+        'user3@example.com'
+    ]
+    # The envelope address of each recipient, None if it's refused.
+    envelopes = dict(zip(recipients, recipients)) if smtputf8 else {
+        'user0@example.com': 'user0@example.com',
+        'üser1@example.com': None,
+        'user2@bücher.example': 'user2@xn--bcher-kva.example',
+        'user3@example.com': 'user3@example.com'
+    }
+    messages = [
+        transport.create_message(SENDER, to, 'Check', msg_plain='Check')
+        for to in recipients
+    ]
+    results = transport.send_message_batch(messages)
+    transport.close()
+    server.shutdown()
+    server.server_close()
+
+    expected = {
+        envelopes[to]: message['data'] for to, message in zip(recipients, messages)
+        if envelopes[to] is not None
+    }
+    received = {to[0]: data for to, data in server.messages}
+    refused = [
+        to for to, (_, error) in zip(recipients, results)
+        if isinstance(error, SMTPRecipientsRefused)
+            and error.recipients[to][0] == 553
+    ]
+    return {
+        'check': 'smtp_utf8',
+        'pipelining': pipelining,
+        'smtputf8': smtputf8,
+        'ok': received == expected
+            and refused == [to for to in recipients if envelopes[to] is None]
+            and server.connections == 1,
+        'sent': len(received),
+        'refused': len(refused),
+        'connections': server.connections
+    }
+
+
+def check_gmail_batch(count: int = 7, batch_size: int = 3) -> dict:
+    """ Send `count` messages in batch requests of `batch_size`
+    to a local stand-in of the Gmail batch endpoint. """
+    _BatchHandler.requests = 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _BatchHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sender = EmailSender(_creds=AnonymousCredentials())
+    sender.batch_uri = f'http://127.0.0.1:{server.server_address[1]}/batch/gmail/v1'
+
+    recipients = _recipients(count)
+    messages = [
+        sender.create_message(SENDER, to, 'Check', msg_plain='Check')
+        for to in recipients
+    ]
+    results = sender.send_message_batch(messages, batch_size=batch_size)
+    server.shutdown()
+    server.server_close()
+
+    ids = [response['id'] for response, _ in results if response is not None]
+    statuses = [
+        error.resp.status for _, error in results if isinstance(error, HttpError)
+    ]
+    return {
+        'check': 'gmail_batch',
+        'ok': _BatchHandler.requests == -(-count // batch_size)
+            and ids == [f'id-{i}' for i, to in enumerate(recipients)
+                if not to.startswith(REFUSED)]
+            and statuses == [429],
+        'requests': _BatchHandler.requests,
+        'sent': len(ids),
+        'rate_limited': len(statuses)
+    }
+
+
+def main() -> int:
+    results = [
+        check_smtp(True),
+        check_smtp(False),
+        check_smtp_utf8(True, True),
+        check_smtp_utf8(True, False),
+        check_smtp_utf8(False, False),
+        check_gmail_batch()
+    ]
+    for result in results:
+        print(json.dumps(result), flush=True)
+    return 0 if all(result['ok'] for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -47,6 +47,8 @@ class EmailCreator(ttk.Frame):
         self._body.insert(END, body.strip())
 
         self._body.bind('<KeyPress-t>', lambda _: self.get_email())
+        msg = 'Merge fields like {name} and {email} are replaced with each user\'s values.'
+        ToolTip(self._body, msg=msg, delay=1)
 
         self._columns = ('file', 'path')
 
@@ -89,7 +91,8 @@ class EmailCreator(ttk.Frame):
         """ Return the email info in a form of a dict.
         Email info consists of the title, the recipient and the body of
         the email in HTML form. If the personalEmail flag is false, the
-        recipient is empty.
+        recipient is empty. The subject and body can contain merge fields,
+        see services.merge_template.
 
             Returns:
                 dict: email info